@@ -16,18 +16,19 @@
 #   print = get from web site and print
 # ============================================================================
 import logging
-import requests
 import argparse
 import sys
-import time
+import threading
 import webbrowser
+from concurrent.futures import ThreadPoolExecutor
 from lxml import html
 import psycopg2
 import psycopg2.errorcodes
 from airbnb_config import ABConfig
 from airbnb_survey import ABSurveyByBoundingBox
 from airbnb_survey import ABSurveyByNeighborhood, ABSurveyByZipcode
-from airbnb_listing import ABListing
+from airbnb_listing import ABListing, copy_sighted_rooms
+from airbnb_queue import ABSurveyQueue, ABFillQueue
 from airbnb_geocoding import BoundingBox
 from airbnb_geocoding import Location
 import airbnb_ws
@@ -212,6 +213,8 @@ def db_delete_survey(config, survey_id):
     try:
         conn = config.connect()
         cur = conn.cursor()
+        if config.ROOM_SIGHTINGS:
+            db_delete_survey_sightings(cur, survey_id)
         # Delete the listings from the room table
         sql = """
         delete from room where survey_id = %s
@@ -224,6 +227,10 @@ def db_delete_survey(config, survey_id):
         delete from survey_progress_log_bb where survey_id = %s
         """
         cur.execute(sql, (survey_id,))
+        sql = """
+        delete from survey_progress_log_quadtree where survey_id = %s
+        """
+        cur.execute(sql, (survey_id,))
         # No need to report: it's just a log table
 
         # Update the survey entry
@@ -246,49 +253,38 @@ def db_delete_survey(config, survey_id):
     pass
 
 
-def db_get_room_to_fill(config, survey_id):
+def db_delete_survey_sightings(cur, survey_id):
     """
-    For "fill" runs (loops over room pages), choose a random room that has
-    not yet been visited in this "fill".
+    Before the rooms of a survey are deleted: delete its sightings, and
+    keep the sightings of later surveys that point to its rooms. For each
+    such room, the first later survey that saw it gets a full copy of the
+    row, and the other sightings are pointed to the copy.
     """
-    for attempt in range(config.MAX_CONNECTION_ATTEMPTS):
-        try:
-            conn = config.connect()
-            cur = conn.cursor()
-            if survey_id == 0:  # no survey specified
-                sql = """
-                    select room_id, survey_id
-                    from room
-                    where deleted is null
-                    order by random()
-                    limit 1
-                    """
-                cur.execute(sql)
-            else:
-                sql = """
-                    select room_id, survey_id
-                    from room
-                    where deleted is null
-                    and survey_id = %s
-                    order by random()
-                    limit 1
-                    """
-                cur.execute(sql, (survey_id,))
-            (room_id, survey_id) = cur.fetchone()
-            listing = ABListing(config, room_id, survey_id)
-            cur.close()
-            conn.commit()
-            return listing
-        except TypeError:
-            logging.info("Finishing: no unfilled rooms in database --")
-            conn.rollback()
-            del config.connection
-            return None
-        except Exception:
-            logging.exception("Error retrieving room to fill from db")
-            conn.rollback()
-            del config.connection
-    return None
+    copied = copy_sighted_rooms(cur, """s.source_survey_id = %(survey_id)s
+    and s.survey_id <> %(survey_id)s""", {"survey_id": survey_id})
+    print("{} listings copied to 'room' table for the sightings of "
+          "later surveys".format(copied))
+    sql = """
+    update room_sighting s
+    set source_survey_id = copied.survey_id
+    from (
+        select room_id, min(survey_id) as survey_id
+        from room_sighting
+        where source_survey_id = %(survey_id)s
+        and survey_id <> %(survey_id)s
+        group by room_id) as copied
+    where s.room_id = copied.room_id
+    and s.source_survey_id = %(survey_id)s
+    """
+    cur.execute(sql, {"survey_id": survey_id})
+    # the sightings that have just become full rows, and the sightings of
+    # the survey itself
+    sql = """
+    delete from room_sighting
+    where source_survey_id = survey_id
+    or survey_id = %(survey_id)s
+    """
+    cur.execute(sql, {"survey_id": survey_id})
 
 
 def db_add_search_area(config, search_area, flag): # version of tom slee
@@ -359,38 +355,133 @@ def display_host(config, host_id):
     webbrowser.open(config.URL_HOST_ROOT + str(host_id))
 
 
-def fill_loop_by_room(config, survey_id):
+class FillProgress():
     """
-    Master routine for looping over rooms (after a search)
-    to fill in the properties.
+    Room counts shared by the workers of a fill (-f). Workers reserve rooms
+    before claiming them, so that together they fill no more than
+    fill_max_room_count rooms.
+    """
+
+    def __init__(self, max_room_count):
+        self.max_room_count = max_room_count
+        self.reserved = 0
+        self.filled = 0
+        self.deleted = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, room_count):
+        """ Reserve up to room_count rooms: returns the number reserved """
+        with self.lock:
+            room_count = max(0, min(room_count,
+                                    self.max_room_count - self.reserved))
+            self.reserved += room_count
+            return room_count
+
+    def release(self, room_count):
+        """ Give back reserved rooms that were not claimed """
+        with self.lock:
+            self.reserved -= room_count
+
+    def record(self, filled, deleted):
+        with self.lock:
+            self.filled += filled
+            self.deleted += deleted
+            # log every hundred rooms
+            if (self.filled + self.deleted) % 100 < filled + deleted:
+                logging.info("Fill: %s rooms filled, %s deleted",
+                             self.filled, self.deleted)
+
+
+def fill_rooms(config, fill_queue, progress):
+    """
+    Claim batches of rooms from the fill queue, request their pages
+    together and save them, until the queue is empty or progress says
+    enough rooms have been filled.
     """
-    room_count = 0
-    while room_count < config.FILL_MAX_ROOM_COUNT:
+    while True:
         try:
-            if not config.HTTP_PROXY_LIST:
-                logging.info(
-                    "No proxies left: re-initialize after %s seconds",
-                    config.RE_INIT_SLEEP_TIME)
-                time.sleep(config.RE_INIT_SLEEP_TIME)  # be nice
-                config = ABConfig()
-            room_count += 1
-            listing = db_get_room_to_fill(config, survey_id)
-            if listing is None:
+            # Claim a batch of rooms and request their pages together
+            batch_size = progress.reserve(max(1, config.FILL_BATCH_SIZE))
+            if batch_size == 0:
                 return None
-            else:
-                if listing.ws_get_room_info(config.FLAGS_ADD):
-                    pass
-                else:  # Airbnb now seems to return nothing if a room has gone
+            listings = fill_queue.claim(batch_size)
+            if len(listings) < batch_size:
+                progress.release(batch_size - len(listings))
+            if not listings:
+                logging.info("Finishing: no unfilled rooms in database --")
+                return None
+            responses = airbnb_ws.ws_request_batch(
+                config, [(config.URL_ROOM_ROOT + str(listing.room_id), None)
+                         for listing in listings])
+            deleted = 0
+            for (listing, response) in zip(listings, responses):
+                try:
+                    if listing.get_room_info_from_response(response,
+                                                           config.FLAGS_ADD):
+                        pass
+                    else:  # Airbnb now seems to return nothing if a room has gone
+                        listing.save_as_deleted()
+                        deleted += 1
+                except AttributeError:
+                    logging.error("Attribute error: marking room as deleted.")
                     listing.save_as_deleted()
-        except AttributeError:
-            logging.error("Attribute error: marking room as deleted.")
-            listing.save_as_deleted()
+                    deleted += 1
+            fill_queue.mark_done(listings)
+            progress.record(len(listings) - deleted, deleted)
+            if len(listings) < batch_size:
+                # no unfilled rooms left
+                return None
         except Exception as e:
             logging.error("Error in fill_loop_by_room: %s", str(type(e)))
             raise
 
 
-def search_sublocalities_by_bounding_box(config, city):
+def fill_rooms_in_thread(config, fill_queue, progress):
+    # each worker thread has a database connection of its own
+    try:
+        return fill_rooms(config, fill_queue, progress)
+    finally:
+        if config.connection is not None:
+            config.connection.close()
+            del config.connection
+
+
+def fill_loop_by_room(config, survey_id, workers=1, restart=False):
+    """
+    Master routine for looping over rooms (after a search)
+    to fill in the properties. With more than one worker, the workers
+    claim rooms from the fill queue independently, so that one worker's
+    requests, page parsing and database writes overlap with the others';
+    they share the proxy scheduler and the fill_max_room_count limit.
+    With restart, rooms filled by earlier fills are filled again.
+    """
+    fill_queue = ABFillQueue(config, survey_id)
+    if restart:
+        fill_queue.restart()
+    fill_queue.add_new_rooms()
+    progress = FillProgress(config.FILL_MAX_ROOM_COUNT)
+    if workers <= 1:
+        fill_rooms(config, fill_queue, progress)
+    else:
+        logging.info("Filling rooms with %s workers", workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(fill_rooms_in_thread, config,
+                                       fill_queue, progress)
+                       for i in range(workers)]
+            for future in futures:
+                # raise any exception from a worker
+                future.result()
+    logging.info("Fill finished: %s rooms filled, %s deleted",
+                 progress.filled, progress.deleted)
+    return None
+
+
+def search_sublocalities_by_bounding_box(config, city, queue=False):
+    """
+    Add a super survey of city, with a bounding box survey of each of
+    its sublocalities, and run them one after another, or, if queue is
+    True, put them in the survey queue for workers (-w) to run.
+    """
     try:
         rowcount = -1
         logging.info("Initializing search by sublocalities")
@@ -430,8 +521,13 @@ def search_sublocalities_by_bounding_box(config, city):
                 sql = """UPDATE survey set ss_id = %s where survey_id = %s"""
                 cur.execute(sql, (ss_id, survey_id))
 
-                survey = ABSurveyByBoundingBox(config, survey_id)
-                survey.search(config.FLAGS_ADD)
+                if not queue:
+                    survey = ABSurveyByBoundingBox(config, survey_id)
+                    survey.search(config.FLAGS_ADD)
+            if queue:
+                conn.commit()
+                ABSurveyQueue(config).add_super_survey(ss_id)
+                logging.info("Super survey %s queued", ss_id)
 
     except Exception:
         logging.error("Failed to search from sublocalities")
@@ -647,10 +743,14 @@ def search_reviews1(config, survey_id):
         cur = conn.cursor()
 
 
-        sql = """SELECT room_id from room where survey_id  in
+        # with room sightings, the rooms of a survey are in the
+        # room_by_survey view
+        sql = """SELECT room_id from {room_table} where survey_id  in
                     ( select survey_id from survey where ss_id >= %s )
                     and room_id not in ( select distinct(room_id) from reviews )
-                    and room_id in ( select distinct(room_id) from room where reviews > 0 ) order by room_id"""
+                    and room_id in ( select distinct(room_id) from room where reviews > 0 ) order by room_id""".format(
+                        room_table="room_by_survey"
+                        if config.ROOM_SIGHTINGS else "room")
 
         cur.execute(sql, (survey_id,))
         rowcount = cur.rowcount
@@ -700,7 +800,8 @@ def search_reviews(config, survey_id):
                 host_id = result[2]
                 listing = ABListing(config, room_id, survey_id)
 
-                response = requests.get('https://www.airbnb.com.br/users/show/' + str(host_id))
+                response = airbnb_ws.ws_request_with_repeats(
+                    config, 'https://www.airbnb.com.br/users/show/' + str(host_id))
                 if response is not None:
                     print(response.status_code)
                     
@@ -859,16 +960,44 @@ def delete_room_repeats(config, super_survey_id):
         cur = conn.cursor()
 
 
-        sql = """DELETE from room
-                where room_id in
-                    (select room_id from room
-                    group by room_id
-                    having Count(room_id)>1)
-                and not last_modified in
-                    (select max(last_modified) from room
-                    group by room_id
-                     having Count(room_id)>1)
-                """
+        if config.ROOM_SIGHTINGS:
+            # count the repeats in the room_by_survey view, delete the
+            # repeated sightings first, and keep the rows that sightings
+            # still point to
+            sql = """DELETE from room_sighting
+                    where room_id in
+                        (select room_id from room_by_survey
+                        group by room_id
+                        having Count(room_id)>1)
+                    and not last_modified in
+                        (select max(last_modified) from room_by_survey
+                        group by room_id
+                         having Count(room_id)>1)
+                    """
+            cur.execute(sql)
+            sql = """DELETE from room
+                    where room_id in
+                        (select room_id from room_by_survey
+                        group by room_id
+                        having Count(room_id)>1)
+                    and not last_modified in
+                        (select max(last_modified) from room_by_survey
+                        group by room_id
+                         having Count(room_id)>1)
+                    and (room_id, survey_id) not in
+                        (select room_id, source_survey_id from room_sighting)
+                    """
+        else:
+            sql = """DELETE from room
+                    where room_id in
+                        (select room_id from room
+                        group by room_id
+                        having Count(room_id)>1)
+                    and not last_modified in
+                        (select max(last_modified) from room
+                        group by room_id
+                         having Count(room_id)>1)
+                    """
 
         cur.execute(sql, (super_survey_id,))
         rowcount = cur.rowcount
@@ -903,6 +1032,14 @@ def parse_args():
                         metavar="config_file", action="store", default=None,
                         help="""explicitly set configuration file, instead of
                         using the default <username>.config""")
+    parser.add_argument("-fw", "--fill_workers",
+                        metavar="workers", type=int, default=1,
+                        help="""with -f, the number of workers filling
+                        rooms at the same time""")
+    parser.add_argument("-fr", "--fill_restart",
+                        action="store_true", default=False,
+                        help="""with -f, fill again the rooms that earlier
+                        fills have filled""")
     # Only one argument!
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-asa', '--addsearcharea',
@@ -1009,6 +1146,18 @@ def parse_args():
     group.add_argument('-csr', '--continue_super_survey_by_route',
                        metavar='super_survey_id', type=int,
                        help="""continue super survey by route""")
+    group.add_argument('-qss', '--queue_super_survey',
+                       metavar='super_survey_id', type=int,
+                       help="""queue the surveys of a super survey, to be
+                       run by workers (-w)""")
+    group.add_argument('-qsbs', '--queue_sublocalities_by_bounding_box',
+                       metavar='city_name', type=str,
+                       help="""as -sbs, but queue the surveys, to be run
+                       by workers (-w)""")
+    group.add_argument('-w', '--worker',
+                       action='store_true', default=False,
+                       help="""run queued surveys until none are left
+                       (any number of workers can run at once)""")
     group.add_argument('-V', '--version',
                        action='version',
                        version='%(prog)s, version ' +
@@ -1027,6 +1176,7 @@ def main():
     (parser, args) = parse_args()
     logging.basicConfig(format='%(levelname)-8s%(message)s')
     ab_config = ABConfig(args)
+    logging.getLogger().setLevel(ab_config.log_level)
 
     try:
         if args.search:
@@ -1047,7 +1197,8 @@ def main():
             survey = ABSurveyByBoundingBox(ab_config, survey_id)
             survey.search(ab_config.FLAGS_ADD)
         elif args.fill is not None:
-            fill_loop_by_room(ab_config, args.fill)
+            fill_loop_by_room(ab_config, args.fill, args.fill_workers,
+                              args.fill_restart)
         elif args.addsearcharea:
             bounding_box = BoundingBox.from_google(ab_config, args.addsearcharea)
             bounding_box.add_search_area(ab_config, args.addsearcharea)
@@ -1101,6 +1252,13 @@ def main():
             continue_super_survey_by_route(ab_config, args.continue_super_survey_by_route)
         elif args.continue_super_survey_by_sublocality:
             continue_super_survey_by_sublocality(ab_config, args.continue_super_survey_by_sublocality)
+        elif args.queue_super_survey:
+            ABSurveyQueue(ab_config).add_super_survey(args.queue_super_survey)
+        elif args.queue_sublocalities_by_bounding_box:
+            search_sublocalities_by_bounding_box(
+                ab_config, args.queue_sublocalities_by_bounding_box, queue=True)
+        elif args.worker:
+            ABSurveyQueue(ab_config).work()
         else:
             parser.print_help()
     except (SystemExit, KeyboardInterrupt):
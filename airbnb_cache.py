@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+"""
+An on-disk cache of web responses, so that pages already downloaded can be
+used again: to re-run a survey that crashed, to re-parse pages after a
+parser fix, or to run a survey with no network at all.
+
+Responses are stored under a key computed from the URL and the (sorted)
+request parameters: the body is gzip-compressed, next to a small JSON file
+of metadata (URL, parameters, status code, headers, encoding and time).
+Secrets (the API key, the session id and cookies) are left out of the
+metadata.
+
+The cache has these modes (cache_mode in the [NETWORK] section of the
+config file):
+    off           no cache
+    record        every request goes to the network; successful responses
+                  are saved in the cache
+    replay        offline: responses come only from the cache, whatever
+                  their age, and pages that are not in the cache fail
+    read-through  responses come from the cache if they are younger than
+                  cache_ttl seconds; otherwise the request goes to the
+                  network and the response is saved in the cache
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+import requests
+import requests.structures
+
+# Set up logging
+logger = logging.getLogger()
+
+MODE_OFF = "off"
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+MODE_READ_THROUGH = "read-through"
+CACHE_MODES = (MODE_OFF, MODE_RECORD, MODE_REPLAY, MODE_READ_THROUGH)
+
+# Request parameters and response headers not saved in the metadata
+SECRET_PARAMS = ("key", "client_session_id")
+SECRET_HEADERS = ("set-cookie",)
+
+
+class ResponseCache():
+    """
+    A content-addressed cache of web responses. See the module docstring
+    for the modes. One cache is shared by every thread that uses the same
+    config: see get_response_cache.
+    """
+
+    def __init__(self, config):
+        self.mode = config.CACHE_MODE
+        if self.mode not in CACHE_MODES:
+            logger.warning("Unknown cache_mode %s: not using the cache",
+                           self.mode)
+            self.mode = MODE_OFF
+        self.cache_dir = config.CACHE_DIR
+        self.ttl = config.CACHE_TTL
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if self.mode != MODE_OFF:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            logger.info("Response cache in %s: mode %s", self.cache_dir,
+                        self.mode)
+
+    @property
+    def offline(self):
+        """ True if requests must not go to the network """
+        return self.mode == MODE_REPLAY
+
+    @staticmethod
+    def key(url, params=None):
+        """ The cache key for a request: a hash of URL and sorted params """
+        if params:
+            params = sorted((str(k), v) for (k, v) in dict(params).items())
+        else:
+            params = []
+        text = json.dumps([url, params], default=str)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _without_secrets(params):
+        return dict((name, value) for (name, value) in dict(params).items()
+                    if name not in SECRET_PARAMS)
+
+    @classmethod
+    def _url_without_secrets(cls, url):
+        parts = urllib.parse.urlsplit(url)
+        if not parts.query:
+            return url
+        query = urllib.parse.urlencode(cls._without_secrets(
+            urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+        return urllib.parse.urlunsplit(parts._replace(query=query))
+
+    def _paths(self, key):
+        directory = os.path.join(self.cache_dir, key[:2])
+        return (directory,
+                os.path.join(directory, key + ".json"),
+                os.path.join(directory, key + ".gz"))
+
+    def get(self, url, params=None):
+        """
+        Return the cached response for this request as a requests.Response,
+        or None if there is none (or the mode does not read the cache).
+        """
+        if self.mode not in (MODE_REPLAY, MODE_READ_THROUGH):
+            return None
+        (_, meta_path, body_path) = self._paths(self.key(url, params))
+        try:
+            with open(meta_path, encoding="utf-8") as meta_file:
+                meta = json.load(meta_file)
+            if (self.mode == MODE_READ_THROUGH and self.ttl
+                    and time.time() - meta["created"] > self.ttl):
+                self._count(hit=False)
+                return None
+            with gzip.open(body_path, "rb") as body_file:
+                body = body_file.read()
+        except FileNotFoundError:
+            self._count(hit=False)
+            if self.offline:
+                logger.warning("Not in cache: %s", url)
+            return None
+        except Exception:
+            logger.exception("Could not read cached page for %s", url)
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        logger.debug("From cache: %s", url)
+        response = requests.Response()
+        response.status_code = meta["status_code"]
+        response.reason = meta.get("reason")
+        response.url = meta.get("response_url", url)
+        response.encoding = meta.get("encoding")
+        response.headers = requests.structures.CaseInsensitiveDict(
+            meta.get("headers", {}))
+        response._content = body
+        response.from_cache = True
+        return response
+
+    def put(self, url, params, response):
+        """ Save a successful response, if the mode writes the cache """
+        if self.mode not in (MODE_RECORD, MODE_READ_THROUGH):
+            return
+        if getattr(response, "from_cache", False):
+            return
+        (directory, meta_path, body_path) = self._paths(self.key(url, params))
+        meta = {
+            "url": url,
+            "params": self._without_secrets(params) if params else None,
+            "response_url": self._url_without_secrets(response.url),
+            "status_code": response.status_code,
+            "reason": response.reason,
+            "encoding": response.encoding,
+            "headers": dict((name, value) for (name, value)
+                            in response.headers.items()
+                            if name.lower() not in SECRET_HEADERS),
+            "created": time.time(),
+        }
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # write to temporary files and rename, so that a crash never
+            # leaves a partial entry; the body goes first, so that a
+            # metadata file always has its body
+            self._write_atomic(directory, body_path,
+                               gzip.compress(response.content))
+            self._write_atomic(directory, meta_path,
+                               json.dumps(meta, default=str).encode("utf-8"))
+        except Exception:
+            logger.exception("Could not save page in cache: %s", url)
+
+    @staticmethod
+    def _write_atomic(directory, path, data):
+        (handle, temp_path) = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(handle, "wb") as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def log_summary(self):
+        """ Log the cache hit rate """
+        if self.mode == MODE_OFF:
+            return
+        logger.info("Response cache (%s): %s hits, %s misses",
+                    self.mode, self.hits, self.misses)
+
+
+CACHE_LOCK = threading.Lock()
+
+
+def get_response_cache(config):
+    """ Return the response cache for this config, creating it if need be """
+    with CACHE_LOCK:
+        cache = getattr(config, "response_cache", None)
+        if cache is None:
+            cache = ResponseCache(config)
+            config.response_cache = cache
+        return cache
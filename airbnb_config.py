@@ -6,6 +6,7 @@ import logging
 import os
 import configparser
 import sys
+import threading
 import psycopg2
 import psycopg2.errorcodes
 
@@ -18,6 +19,8 @@ class ABConfig():
         """
         self.config_file = None
         self.log_level = logging.INFO
+        # database connections are kept per thread: see connection, below
+        self._thread_local = threading.local()
         if args is not None:
             self.config_file = args.config_file
             try:
@@ -46,10 +49,59 @@ class ABConfig():
         self.SEARCH_LISTINGS_ON_FULL_PAGE = 18
         self.SEARCH_DO_LOOP_OVER_PRICES = False
         self.SEARCH_DO_LOOP_OVER_ROOM_TYPES = False
+        self.SEARCH_ROOM_TYPES_HYBRID = 2
+        # None: search_max_rectangle_zoom
+        self.SEARCH_ROOM_TYPE_SPLIT_ZOOM = None
+        self.SEARCH_TRAVERSAL_DEPTH_FIRST = 'depth_first'  # default
+        self.SEARCH_TRAVERSAL_CONCURRENT = 'concurrent'
+        self.SEARCH_TRAVERSAL_BEST_FIRST = 'best_first'
+        self.SEARCH_TRAVERSAL = self.SEARCH_TRAVERSAL_DEPTH_FIRST
+        self.SEARCH_CONCURRENCY = 4
+        self.SEARCH_BRANCH_WORKERS = 1
+        self.SEARCH_BUDGET_SECONDS = 0
+        self.SEARCH_BUDGET_REQUESTS = 0
+        self.ZOOM_CUTOFF_LEVELS = 0
+        self.ZOOM_CUTOFF_YIELD = 1.0
+        self.ZOOM_CUTOFF_MIN_ZOOM = 2
+        self.SEARCH_SPLIT_GEOMETRIC = 'geometric'  # default
+        self.SEARCH_SPLIT_MEDIAN = 'median'
+        self.SEARCH_SPLIT_MODE = self.SEARCH_SPLIT_GEOMETRIC
+        self.SEARCH_WARM_START = False
+        self.ROOM_FILTER = 'set'
+        self.ROOM_FILTER_CAPACITY = 1000000
+        self.ROOM_FILTER_ERROR_RATE = 0.0001
+        self.ROOM_SIGHTINGS = False
+        self.QUEUE_LEASE = 600
+        self.QUEUE_HEARTBEAT = 60
+        self.QUEUE_POLL = 30
+        self.QUEUE_MAX_ATTEMPTS = 3
         self.HTTP_PROXY_LIST = []
         self.HTTP_PROXY_LIST_COMPLETE = []
         self.GOOGLE_API_KEY = None
         self.ATTEMPTS_TO_FIND_PAGE = 10
+        self.MAX_CONCURRENT_REQUESTS = 1
+        self.MAX_REQUESTS_PER_PROXY = 1
+        self.HTTP_POOL_CONNECTIONS = 10
+        self.HTTP_POOL_MAXSIZE = 10
+        self.PROXY_EWMA_ALPHA = 0.2
+        self.PROXY_FAILURE_THRESHOLD = 3
+        self.PROXY_COOLDOWN = None
+        self.PROXY_MAX_COOLDOWN = None
+        self.REQUEST_RATE = None
+        self.REQUEST_RATE_MIN = 0.05
+        self.REQUEST_RATE_MAX = 20.0
+        self.REQUEST_BURST = 1.0
+        self.REQUEST_RATE_INCREASE = 0.1
+        self.REQUEST_RATE_DECREASE = 0.5
+        self.CACHE_MODE = "off"
+        self.CACHE_DIR = "ws_cache"
+        self.CACHE_TTL = 604800
+        self.METRICS_FORMAT = "prometheus"
+        self.METRICS_FILE = None
+        self.SEARCH_PAGE_BATCH = 1
+        self.FILL_BATCH_SIZE = 1
+        self.FILL_ORDER = "random"
+        self.INSERT_BATCH_SIZE = 18
         self.SEARCH_WITH_DATE = True
         '''if args.check_date is not None and not args.check_date:
             self.SEARCH_WITH_DATE = False
@@ -109,6 +161,115 @@ class ABConfig():
                 int(config["NETWORK"]["max_connection_attempts"])
             self.REQUEST_SLEEP = float(config["NETWORK"]["request_sleep"])
             self.HTTP_TIMEOUT = float(config["NETWORK"]["http_timeout"])
+            try:
+                self.MAX_CONCURRENT_REQUESTS = int(
+                    config["NETWORK"]["max_concurrent_requests"])
+            except:
+                logger.warning("Missing config file entry: max_concurrent_requests.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.MAX_REQUESTS_PER_PROXY = int(
+                    config["NETWORK"]["max_requests_per_proxy"])
+            except:
+                logger.warning("Missing config file entry: max_requests_per_proxy.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.HTTP_POOL_CONNECTIONS = int(
+                    config["NETWORK"]["pool_connections"])
+            except:
+                logger.warning("Missing config file entry: pool_connections.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.HTTP_POOL_MAXSIZE = int(config["NETWORK"]["pool_maxsize"])
+            except:
+                logger.warning("Missing config file entry: pool_maxsize.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.PROXY_EWMA_ALPHA = float(config["NETWORK"]["proxy_ewma_alpha"])
+            except:
+                logger.warning("Missing config file entry: proxy_ewma_alpha.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.PROXY_FAILURE_THRESHOLD = int(
+                    config["NETWORK"]["proxy_failure_threshold"])
+            except:
+                logger.warning("Missing config file entry: proxy_failure_threshold.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.PROXY_COOLDOWN = float(config["NETWORK"]["proxy_cooldown"])
+            except:
+                logger.warning("Missing config file entry: proxy_cooldown.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.PROXY_MAX_COOLDOWN = float(
+                    config["NETWORK"]["proxy_max_cooldown"])
+            except:
+                logger.warning("Missing config file entry: proxy_max_cooldown.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.REQUEST_RATE_MIN = float(config["NETWORK"]["request_rate_min"])
+            except:
+                logger.warning("Missing config file entry: request_rate_min.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.REQUEST_RATE_MAX = float(config["NETWORK"]["request_rate_max"])
+            except:
+                logger.warning("Missing config file entry: request_rate_max.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.REQUEST_RATE = float(config["NETWORK"]["request_rate"])
+            except:
+                logger.warning("Missing config file entry: request_rate.")
+                logger.warning("For more information, see example.config")
+            if self.REQUEST_RATE is None or self.REQUEST_RATE <= 0:
+                # request_sleep was a random pause in [0, request_sleep]:
+                # start at the same average rate
+                if self.REQUEST_SLEEP > 0:
+                    self.REQUEST_RATE = 2.0 / self.REQUEST_SLEEP
+                else:
+                    self.REQUEST_RATE = self.REQUEST_RATE_MAX
+            try:
+                self.REQUEST_BURST = float(config["NETWORK"]["request_burst"])
+            except:
+                logger.warning("Missing config file entry: request_burst.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.REQUEST_RATE_INCREASE = float(
+                    config["NETWORK"]["request_rate_increase"])
+            except:
+                logger.warning("Missing config file entry: request_rate_increase.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.REQUEST_RATE_DECREASE = float(
+                    config["NETWORK"]["request_rate_decrease"])
+            except:
+                logger.warning("Missing config file entry: request_rate_decrease.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.CACHE_MODE = config["NETWORK"]["cache_mode"].strip()
+            except:
+                logger.warning("Missing config file entry: cache_mode.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.CACHE_DIR = config["NETWORK"]["cache_dir"].strip()
+            except:
+                logger.warning("Missing config file entry: cache_dir.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.CACHE_TTL = float(config["NETWORK"]["cache_ttl"])
+            except:
+                logger.warning("Missing config file entry: cache_ttl.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.METRICS_FORMAT = config["NETWORK"]["metrics_format"].strip()
+            except:
+                logger.warning("Missing config file entry: metrics_format.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.METRICS_FILE = config["NETWORK"]["metrics_file"].strip()
+            except:
+                logger.warning("Missing config file entry: metrics_file.")
+                logger.warning("For more information, see example.config")
             try:
                 self.URL_API_SEARCH_ROOT = config["NETWORK"]["url_api_search_root"]
             except: 
@@ -151,7 +312,21 @@ class ABConfig():
                 logger.warning(
                     "Missing config file entry: search_do_loop_over_room_types.")
                 logger.warning("For more information, see example.config")
+            try:
+                self.SEARCH_ROOM_TYPE_SPLIT_ZOOM = int(
+                    config["SURVEY"]["search_room_type_split_zoom"])
+            except:
+                logger.warning(
+                    "Missing config file entry: search_room_type_split_zoom.")
+                logger.warning("For more information, see example.config")
+            if self.SEARCH_ROOM_TYPE_SPLIT_ZOOM is None:
+                self.SEARCH_ROOM_TYPE_SPLIT_ZOOM = self.SEARCH_MAX_RECTANGLE_ZOOM
             self.RE_INIT_SLEEP_TIME = float(config["SURVEY"]["re_init_sleep_time"])
+            # proxy cooldowns default to the old wait for a blocked address
+            if self.PROXY_COOLDOWN is None:
+                self.PROXY_COOLDOWN = self.RE_INIT_SLEEP_TIME
+            if self.PROXY_MAX_COOLDOWN is None:
+                self.PROXY_MAX_COOLDOWN = 16 * self.PROXY_COOLDOWN
             try:
                 self.SEARCH_RECTANGLE_EDGE_BLUR = float(
                     config["SURVEY"]["search_rectangle_edge_blur"])
@@ -160,6 +335,150 @@ class ABConfig():
                     "Missing config file entry: search_rectangle_edge_blur.")
                 logger.warning("For more information, see example.config")
 
+            try:
+                self.SEARCH_PAGE_BATCH = int(config["SURVEY"]["search_page_batch"])
+            except:
+                logger.warning(
+                    "Missing config file entry: search_page_batch.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.FILL_BATCH_SIZE = int(config["SURVEY"]["fill_batch_size"])
+            except:
+                logger.warning(
+                    "Missing config file entry: fill_batch_size.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.FILL_ORDER = config["SURVEY"]["fill_order"]
+            except:
+                logger.warning(
+                    "Missing config file entry: fill_order.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.INSERT_BATCH_SIZE = int(config["SURVEY"]["insert_batch_size"])
+            except:
+                logger.warning(
+                    "Missing config file entry: insert_batch_size.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.SEARCH_TRAVERSAL = config["SURVEY"]["search_traversal"].strip()
+            except:
+                logger.warning(
+                    "Missing config file entry: search_traversal.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.SEARCH_CONCURRENCY = int(
+                    config["SURVEY"]["search_concurrency"])
+            except:
+                logger.warning(
+                    "Missing config file entry: search_concurrency.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.SEARCH_BRANCH_WORKERS = int(
+                    config["SURVEY"]["search_branch_workers"])
+            except:
+                logger.warning(
+                    "Missing config file entry: search_branch_workers.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.SEARCH_SPLIT_MODE = config["SURVEY"]["search_split_mode"].strip()
+            except:
+                logger.warning(
+                    "Missing config file entry: search_split_mode.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.SEARCH_WARM_START = int(
+                    config["SURVEY"]["search_warm_start"])
+            except:
+                logger.warning(
+                    "Missing config file entry: search_warm_start.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.SEARCH_BUDGET_SECONDS = int(
+                    config["SURVEY"]["search_budget_seconds"])
+            except:
+                logger.warning(
+                    "Missing config file entry: search_budget_seconds.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.SEARCH_BUDGET_REQUESTS = int(
+                    config["SURVEY"]["search_budget_requests"])
+            except:
+                logger.warning(
+                    "Missing config file entry: search_budget_requests.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.ZOOM_CUTOFF_LEVELS = int(
+                    config["SURVEY"]["zoom_cutoff_levels"])
+            except:
+                logger.warning(
+                    "Missing config file entry: zoom_cutoff_levels.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.ZOOM_CUTOFF_YIELD = float(
+                    config["SURVEY"]["zoom_cutoff_yield"])
+            except:
+                logger.warning(
+                    "Missing config file entry: zoom_cutoff_yield.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.ZOOM_CUTOFF_MIN_ZOOM = int(
+                    config["SURVEY"]["zoom_cutoff_min_zoom"])
+            except:
+                logger.warning(
+                    "Missing config file entry: zoom_cutoff_min_zoom.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.ROOM_FILTER = config["SURVEY"]["room_filter"].strip()
+            except:
+                logger.warning(
+                    "Missing config file entry: room_filter.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.ROOM_FILTER_CAPACITY = int(
+                    config["SURVEY"]["room_filter_capacity"])
+            except:
+                logger.warning(
+                    "Missing config file entry: room_filter_capacity.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.ROOM_FILTER_ERROR_RATE = float(
+                    config["SURVEY"]["room_filter_error_rate"])
+            except:
+                logger.warning(
+                    "Missing config file entry: room_filter_error_rate.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.ROOM_SIGHTINGS = bool(int(
+                    config["SURVEY"]["room_sightings"]))
+            except:
+                logger.warning(
+                    "Missing config file entry: room_sightings.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.QUEUE_LEASE = int(config["SURVEY"]["queue_lease"])
+            except:
+                logger.warning(
+                    "Missing config file entry: queue_lease.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.QUEUE_HEARTBEAT = int(config["SURVEY"]["queue_heartbeat"])
+            except:
+                logger.warning(
+                    "Missing config file entry: queue_heartbeat.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.QUEUE_POLL = int(config["SURVEY"]["queue_poll"])
+            except:
+                logger.warning(
+                    "Missing config file entry: queue_poll.")
+                logger.warning("For more information, see example.config")
+            try:
+                self.QUEUE_MAX_ATTEMPTS = int(config["SURVEY"]["queue_max_attempts"])
+            except:
+                logger.warning(
+                    "Missing config file entry: queue_max_attempts.")
+                logger.warning("For more information, see example.config")
+
             # account
             try:
                 self.GOOGLE_API_KEY = config["ACCOUNT"]["google_api_key"]
@@ -173,12 +492,30 @@ class ABConfig():
             logger.exception("Failed to read config file properly")
             raise
 
+    @property
+    def connection(self):
+        """
+        The database connection for the current thread. psycopg2 connections
+        must not be shared by threads that run transactions at the same time,
+        so each thread that calls connect() gets a connection of its own.
+        """
+        return getattr(self._thread_local, "connection", None)
+
+    @connection.setter
+    def connection(self, connection):
+        self._thread_local.connection = connection
+
+    @connection.deleter
+    def connection(self):
+        # callers drop a broken connection with del(config.connection):
+        # the next connect() opens a new one
+        self._thread_local.connection = None
+
     def connect(self):
     # get a database connection
-        """ Return a connection to the database"""
+        """ Return a connection to the database for the current thread"""
         try:
-            if (not hasattr(self, "connection") or
-                    self.connection is None or
+            if (self.connection is None or
                     self.connection.closed != 0):
                 cattr = dict(
                     user=self.DB_USER,
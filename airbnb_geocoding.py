@@ -7,6 +7,7 @@ import googlemaps
 import argparse
 import json
 from airbnb_config import ABConfig
+import airbnb_ws
 import sys
 import logging
 import os
@@ -113,7 +114,9 @@ class Location():
         # lat = 41.782
         # lng = -72.693
 
-        results = gmaps.reverse_geocode((self.lat_round, self.lng_round))
+        results = airbnb_ws.ws_rate_limited_call(
+            config, airbnb_ws.GOOGLE_GEOCODING_HOST,
+            gmaps.reverse_geocode, (self.lat_round, self.lng_round))
 
         # Parsing the result is described at
         # https://developers.google.com/maps/documentation/geocoding/web-service-best-practices#ParsingJSON
@@ -261,7 +264,9 @@ class BoundingBox():
         """
         try:
             gmaps = googlemaps.Client(key=config.GOOGLE_API_KEY)
-            results = gmaps.geocode((search_area))
+            results = airbnb_ws.ws_rate_limited_call(
+                config, airbnb_ws.GOOGLE_GEOCODING_HOST,
+                gmaps.geocode, (search_area))
 
             bounds = results[0]["geometry"]["bounds"]
             bounding_box = (bounds["southwest"]["lat"],
@@ -295,7 +300,9 @@ class BoundingBox():
             # lat = 41.782
             # lng = -72.693
 
-            results = gmaps.reverse_geocode((lat, lng))
+            results = airbnb_ws.ws_rate_limited_call(
+                config, airbnb_ws.GOOGLE_GEOCODING_HOST,
+                gmaps.reverse_geocode, (lat, lng))
 
             # Parsing the result is described at
             # https://developers.google.com/maps/documentation/geocoding/web-service-best-practices#ParsingJSON
@@ -403,7 +410,9 @@ class BoundingBox():
 
 
             gmaps = googlemaps.Client(key=config.GOOGLE_API_KEY)
-            results = gmaps.geocode((search_area))
+            results = airbnb_ws.ws_rate_limited_call(
+                config, airbnb_ws.GOOGLE_GEOCODING_HOST,
+                gmaps.geocode, (search_area))
 
             print("Search area {} added: search_area_id = {}"
                   .format(search_area, search_area_id))
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+"""
+Decode the JSON of Airbnb responses, and find the JSON that web pages
+carry inside their script tags.
+
+The fastest JSON decoder installed is used: orjson, then ujson, then the
+standard library json module.
+"""
+import json
+import logging
+
+try:
+    import orjson
+    _loads = orjson.loads
+    JSON_DECODER = "orjson"
+except ImportError:
+    try:
+        import ujson
+        _loads = ujson.loads
+        JSON_DECODER = "ujson"
+    except ImportError:
+        _loads = json.loads
+        JSON_DECODER = "json"
+
+logger = logging.getLogger()
+
+
+def loads(document):
+    """ Decode a JSON document (str or bytes) """
+    return _loads(document)
+
+
+def strip_comment(text):
+    # the JSON is wrapped in a comment: keep everything between the
+    # outermost curly braces
+    start = text.find(b"{" if isinstance(text, bytes) else "{")
+    end = text.rfind(b"}" if isinstance(text, bytes) else "}")
+    if start < 0 or end < start:
+        return None
+    return text[start:end + 1]
+
+
+def json_text_from_script(content, attribute):
+    """
+    Return the JSON text of the first script tag with attribute (for
+    example, 'id="data-state"') in a web page, or None if the page does not
+    have one. content is the page as bytes, which is scanned for the tag
+    without being parsed.
+    """
+    key = attribute.encode("ascii")
+    key_position = content.find(key)
+    while key_position >= 0:
+        # the attribute may be on other tags as well (hypernova puts its key
+        # on a div for the rendered page, and on the script for the data):
+        # use the script
+        tag_start = content.rfind(b"<", 0, key_position)
+        if content.startswith(b"<script", tag_start):
+            tag_end = content.find(b">", key_position)
+            script_end = content.find(b"</script>", tag_end)
+            if tag_end >= 0 and script_end >= 0:
+                return strip_comment(content[tag_end + 1:script_end])
+            return None
+        key_position = content.find(key, key_position + len(key))
+    return None
@@ -4,12 +4,16 @@
 #
 # An ABListing represents and individual Airbnb listing
 # ============================================================================
+import hashlib
 import logging
+import math
 import re
+import threading
 from lxml import html
 import psycopg2
 import json
 import airbnb_ws
+import airbnb_room_parser
 from airbnb_geocoding import Location
 import sys
 import random
@@ -22,6 +26,153 @@ from airbnb_reviews import ABReview
 
 logger = logging.getLogger()
 
+# The room columns of a listing, in one order shared by the insert and
+# update statements, the rows of search results (see airbnb_search_parser)
+# and ListingRecord.values
+ROOM_COLUMNS = (
+    "room_id", "host_id", "room_type", "country", "city",
+    "neighborhood", "address", "reviews", "overall_satisfaction",
+    "accommodates", "bedrooms", "bathrooms", "price", "deleted",
+    "minstay", "latitude", "longitude", "survey_id",
+    "coworker_hosted", "extra_host_languages", "name",
+    "property_type", "currency", "rate_type",
+    "sublocality", "route", "is_superhost",
+    "max_nights", "avg_rating", "pictures",
+)
+ROOM_KEY_COLUMNS = ("room_id", "survey_id")
+# Every column but the key, in the order of ROOM_COLUMNS
+ROOM_UPDATE_COLUMNS = tuple(column for column in ROOM_COLUMNS
+                            if column not in ROOM_KEY_COLUMNS)
+# The columns fingerprinted by content_hash: the content, without the key
+ROOM_CONTENT_INDEXES = tuple(ROOM_COLUMNS.index(column)
+                             for column in ROOM_UPDATE_COLUMNS)
+ROOM_ROOM_ID_INDEX = ROOM_COLUMNS.index("room_id")
+ROOM_SURVEY_ID_INDEX = ROOM_COLUMNS.index("survey_id")
+# The fields that every room page should have: if the JSON embedded in a
+# page lacks one of them, the page is parsed for it with XPath
+ROOM_REQUIRED_FIELDS = ("host_id", "room_type", "latitude", "longitude")
+# A listing with more fields than this unassigned was not parsed properly
+# (the room has probably gone): see ABListing.status_check
+MAX_UNASSIGNED_FIELDS = 9
+
+
+def content_hash(row):
+    """
+    The fingerprint of a room row (the values of ROOM_COLUMNS): an md5
+    digest, in hex, of every column but the key. Two rows of a room with
+    the same fingerprint differ only in their survey.
+    """
+    content = tuple(row[i] for i in ROOM_CONTENT_INDEXES)
+    return hashlib.md5(repr(content).encode("utf-8")).hexdigest()
+
+
+def copy_sighted_rooms(cur, condition, args):
+    """
+    Give sightings full rows in the room table: for each room with
+    sightings (room_sighting s) that match condition, the first of them
+    gets a copy of the row it points to, with its own survey_id and
+    last_modified. The sightings themselves are left in place. Returns the
+    number of rows copied.
+    """
+    cur.execute("""
+    select column_name
+    from information_schema.columns
+    where table_name = 'room'
+    order by ordinal_position
+    """)
+    columns = [row[0] for row in cur.fetchall()]
+    sighting_columns = {"survey_id": "s.survey_id",
+                        "last_modified": "s.last_modified"}
+    sql = """
+    insert into room ({columns})
+    select distinct on (s.room_id) {values}
+    from room_sighting s
+    join room r
+    on r.room_id = s.room_id and r.survey_id = s.source_survey_id
+    where {condition}
+    order by s.room_id, s.survey_id
+    on conflict on constraint room_pkey do nothing
+    """.format(columns=", ".join(columns),
+               values=", ".join(sighting_columns.get(column, "r." + column)
+                                for column in columns),
+               condition=condition)
+    cur.execute(sql, args)
+    return cur.rowcount
+
+
+def detach_room_sightings(cur, room_id, survey_id):
+    """
+    Before the row of a room in a survey is changed, make it a full row
+    that no sighting points to. If the room was only sighted in the
+    survey, the sighting becomes a copy of the row it points to. If
+    sightings of later surveys point to the row, the first of them gets a
+    copy of it and the others are pointed to that copy.
+    """
+    args = {"room_id": room_id, "survey_id": survey_id}
+    copy_sighted_rooms(cur, """s.room_id = %(room_id)s
+    and s.survey_id = %(survey_id)s""", args)
+    copy_sighted_rooms(cur, """s.room_id = %(room_id)s
+    and s.source_survey_id = %(survey_id)s""", args)
+    cur.execute("""
+    update room_sighting
+    set source_survey_id = (
+        select min(survey_id)
+        from room_sighting
+        where room_id = %(room_id)s
+        and source_survey_id = %(survey_id)s)
+    where room_id = %(room_id)s
+    and source_survey_id = %(survey_id)s
+    """, args)
+    # the sighting in the survey, and the sighting that has just become
+    # a full row
+    cur.execute("""
+    delete from room_sighting
+    where room_id = %(room_id)s
+    and (survey_id = %(survey_id)s or source_survey_id = survey_id)
+    """, args)
+
+
+class ListingRecord():
+    """
+    The values of one listing, in slots: one for each of ROOM_COLUMNS, and
+    two that are not stored. Surveys and fills handle very many listings,
+    so a record carries nothing else (no config, no __dict__).
+    """
+    __slots__ = ROOM_COLUMNS + ("reviews_text", "person_capacity")
+
+    def __init__(self, room_id, survey_id):
+        for field in self.__slots__:
+            setattr(self, field, None)
+        self.room_id = room_id
+        self.survey_id = survey_id
+        self.reviews_text = False
+
+    @classmethod
+    def from_row(cls, row):
+        """ A record from the values of ROOM_COLUMNS, in order """
+        record = cls.__new__(cls)
+        for (field, value) in zip(ROOM_COLUMNS, row):
+            setattr(record, field, value)
+        record.reviews_text = False
+        record.person_capacity = None
+        return record
+
+    def values(self):
+        """ The values of ROOM_COLUMNS, in order """
+        return tuple(getattr(self, column) for column in ROOM_COLUMNS)
+
+    def unassigned(self):
+        """ The names of the fields that have no value """
+        return [field for field in self.__slots__
+                if getattr(self, field) is None]
+
+
+def _record_property(field):
+    # an ABListing attribute that is kept in its record
+    return property(lambda listing: getattr(listing.record, field),
+                    lambda listing, value: setattr(listing.record, field,
+                                                   value))
+
 
 class ABListing():
     """
@@ -29,90 +180,38 @@ class ABListing():
     # room_id, survey_id is the primary key.
     # Occasionally, a survey_id = None will happen, but for retrieving data
     # straight from the web site, and not stored in the database.
+    # The values are kept in a ListingRecord (record), and can be read and
+    # set as attributes of the ABListing.
     """
+    __slots__ = ("config", "record")
+
     def __init__(self, config, room_id, survey_id):
         self.config = config
-        self.room_id = room_id
-        self.host_id = None
-        self.room_type = None
-        self.country = None
-        self.city = None
-        self.neighborhood = None
-        self.address = None
-        self.reviews = None
-        self.reviews_text = False
-        self.overall_satisfaction = None
-        self.accommodates = None
-        self.bedrooms = None
-        self.bathrooms = None
-        self.price = None
-        self.deleted = None
-        self.minstay = None
-        self.latitude = None
-        self.longitude = None
-        self.survey_id = survey_id
-        #  extra fields added from search json:
-        # coworker_hosted (bool)
-        self.coworker_hosted = None
-        # extra_host_languages (list)
-        self.extra_host_languages = None
-        # name (str)
-        self.name = None
-        # property_type (str)
-        self.property_type = None
-        # currency (str)
-        self.currency = None
-        # rate_type (str) - "nightly" or other?
-        self.rate_type = None
-        self.sublocality = None
-        self.route = None
-        self.is_superhost = None
-        self.max_nights = None
-        self.avg_rating = None
-        self.person_capacity = None
-        self.pictures = None
-
-        logger.setLevel(config.log_level)
+        self.record = ListingRecord(room_id, survey_id)
 
     def status_check(self):
         # if sufficient of the values are None or don't exist, the room 
         # entry was not properly parsed and we may as well throw the whole
         # thing away.
         status = True  # OK
-        unassigned_values = {key: value
-                             for key, value in vars(self).items()
-                             if not key.startswith('__') and
-                             not callable(key) and
-                             value is None
-                             }
-        if len(unassigned_values) > 9:  # just a value indicating deleted
+        unassigned_values = self.record.unassigned()
+        if len(unassigned_values) > MAX_UNASSIGNED_FIELDS:
             logger.info("Room " + str(self.room_id) + ": marked deleted")
             status = False  # probably deleted
             self.deleted = 1
         else:
-            for key, val in unassigned_values.items():
+            for key in unassigned_values:
                 if (key == "overall_satisfaction" and "reviews" not in
                         unassigned_values):
-                    if val is None and self.reviews > 2:
+                    if self.reviews > 2:
                         logger.debug("Room " + str(self.room_id) + ": No value for " + key)
-                elif val is None:
+                else:
                     logger.debug("Room " + str(self.room_id) + ": No value for " + key)
         return status
 
     def get_columns(self):
-        """
-        Hack: callable(attr) includes methods with (self) as argument.
-        Need to find a way to avoid these.
-        This hack does also provide the proper order, which matters
-        """
-        # columns = [attr for attr in dir(self) if not
-        # callable(attr) and not attr.startswith("__")]
-        columns = ("room_id", "host_id", "room_type", "country",
-                   "city", "neighborhood", "address", "reviews",
-                   "overall_satisfaction", "accommodates", "bedrooms",
-                   "bathrooms", "price", "deleted", "minstay",
-                   "latitude", "longitude", "survey_id", "last_modified",)
-        return columns
+        """ The columns of the room table, in order, for export """
+        return ROOM_COLUMNS + ("last_modified",)
 
     def save_as_deleted(self):
         try:
@@ -120,20 +219,34 @@ class ABListing():
             if self.survey_id is None:
                 return
             conn = self.config.connect()
+            cur = conn.cursor()
+            if self.config.ROOM_SIGHTINGS:
+                detach_room_sightings(cur, self.room_id, self.survey_id)
             sql = """
                 update room
                 set deleted = 1, last_modified = now()::timestamp
                 where room_id = %s
                 and survey_id = %s
-            """
-            cur = conn.cursor()
+                returning {columns}
+            """.format(columns=", ".join(ROOM_COLUMNS))
             cur.execute(sql, (self.room_id, self.survey_id))
+            row = cur.fetchone()
+            if self.config.ROOM_SIGHTINGS and row is not None:
+                # the row has changed, and so has its fingerprint
+                cur.execute("""
+                    update room set content_hash = %s
+                    where room_id = %s and survey_id = %s
+                """, (content_hash(row), self.room_id, self.survey_id))
             cur.close()
             conn.commit()
         except Exception:
             logger.error("Failed to save room as deleted")
             raise
 
+    def get_insert_args(self):
+        """ The values of ROOM_COLUMNS for this listing """
+        return self.record.values()
+
     def save(self, insert_replace_flag):
         """
         Save a listing in the database. Delegates to lower-level methods
@@ -261,16 +374,7 @@ class ABListing():
                         ": getting from Airbnb web site")
             room_url = self.config.URL_ROOM_ROOT + str(self.room_id)
             response = airbnb_ws.ws_request_with_repeats(self.config, room_url)
-            if response is not None:
-                page = response.text
-                tree = html.fromstring(page)  
-
-                self.__get_room_info_from_tree(tree, flag)
-                logger.info("Room %s: found", self.room_id)
-                return True
-            else:
-                logger.info("Room %s: not found", self.room_id)
-                return False
+            return self.get_room_info_from_response(response, flag)
         except (KeyboardInterrupt, SystemExit):
             raise
         except Exception as ex:
@@ -279,6 +383,29 @@ class ABListing():
             logger.error("Exception: " + str(type(ex)))
             raise
 
+    def get_room_info_from_response(self, response, flag):
+        """ Get the room properties from a room page that has already been
+        requested (for example, as part of a batch: see
+        airbnb_ws.ws_request_batch). response is None if the request failed."""
+        if response is not None:
+            room_page = airbnb_room_parser.parse_room_page(response.content)
+            tree = None
+            if room_page is not None:
+                for (name, value) in room_page.fields.items():
+                    if getattr(self, name) is None:
+                        setattr(self, name, value)
+                self.__save_reviews(room_page.reviews)
+            if room_page is None or self.__missing_fields():
+                # a layout we do not know, or a page without some of the
+                # fields that every room should have: fall back to XPath
+                tree = html.fromstring(response.text)
+            self.__get_room_info_from_tree(tree, flag)
+            logger.info("Room %s: found", self.room_id)
+            return True
+        else:
+            logger.info("Room %s: not found", self.room_id)
+            return False
+
     def __insert(self):
         """ Insert a room into the database. Raise an error if it fails """
         try:
@@ -287,31 +414,16 @@ class ABListing():
             logger.debug("\thost_id: {}".format(self.host_id))
             conn = self.config.connect()
             cur = conn.cursor()
+            columns = ROOM_COLUMNS
+            insert_args = self.get_insert_args()
+            if self.config.ROOM_SIGHTINGS:
+                columns += ("content_hash",)
+                insert_args += (content_hash(insert_args),)
             sql = """
-                insert into room (
-                    room_id, host_id, room_type, country, city,
-                    neighborhood, address, reviews, overall_satisfaction,
-                    accommodates, bedrooms, bathrooms, price, deleted,
-                    minstay, latitude, longitude, survey_id,
-                    coworker_hosted, extra_host_languages, name,
-                    property_type, currency, rate_type,
-                    sublocality, route, is_superhost,
-                    max_nights, avg_rating, pictures)
-                values (%s, %s, %s, %s, %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-                )"""
-            insert_args = (
-                self.room_id, self.host_id, self.room_type, self.country,
-                self.city, self.neighborhood, self.address, self.reviews,
-                self.overall_satisfaction, self.accommodates, self.bedrooms,
-                self.bathrooms, self.price, self.deleted, self.minstay,
-                self.latitude, self.longitude, self.survey_id,
-                self.coworker_hosted, self.extra_host_languages, self.name,
-                self.property_type, self.currency, self.rate_type,
-                self.sublocality, self.route, self.is_superhost,
-                self.max_nights, self.avg_rating, self.pictures
-                )
+                insert into room ({columns})
+                values ({values})""".format(
+                    columns=", ".join(columns),
+                    values=", ".join(["%s"] * len(columns)))
             cur.execute(sql, insert_args)
             cur.close()
             conn.commit()
@@ -334,31 +446,21 @@ class ABListing():
             conn = self.config.connect()
             cur = conn.cursor()
             logger.debug("Updating...")
+            columns = ROOM_UPDATE_COLUMNS
+            update_args = tuple(getattr(self.record, column)
+                                for column in ROOM_UPDATE_COLUMNS)
+            if self.config.ROOM_SIGHTINGS:
+                detach_room_sightings(cur, self.room_id, self.survey_id)
+                columns += ("content_hash",)
+                update_args += (content_hash(self.get_insert_args()),)
             sql = """
                 update room
-                set host_id = %s, room_type = %s,
-                    country = %s, city = %s, neighborhood = %s,
-                    address = %s, reviews = %s, overall_satisfaction = %s,
-                    accommodates = %s, bedrooms = %s, bathrooms = %s,
-                    price = %s, deleted = %s, last_modified = now()::timestamp,
-                    minstay = %s, latitude = %s, longitude = %s,
-                    coworker_hosted = %s, extra_host_languages = %s, name = %s,
-                    property_type = %s, currency = %s, rate_type = %s, pictures = %s
+                set {columns}, last_modified = now()::timestamp
                 where room_id = %s
-                and survey_id = %s"""
-            update_args = (
-                self.host_id, self.room_type,
-                self.country, self.city, self.neighborhood,
-                self.address, self.reviews, self.overall_satisfaction,
-                self.accommodates, self.bedrooms, self.bathrooms,
-                self.price, self.deleted,
-                self.minstay, self.latitude,
-                self.longitude,
-                self.coworker_hosted, self.extra_host_languages, self.name,
-                self.property_type, self.currency, self.rate_type, self.pictures,
-                self.room_id,
-                self.survey_id,
-                )
+                and survey_id = %s""".format(
+                    columns=", ".join(column + " = %s"
+                                      for column in columns))
+            update_args += (self.room_id, self.survey_id)
             logger.debug("Executing...")
             cur.execute(sql, update_args)
             rowcount = cur.rowcount
@@ -586,61 +688,28 @@ class ABListing():
             logger.exception(e)
             self.reviews = None
 
-    def __get_reviews_text(self, tree):
+    def __save_reviews(self, reviews):
+        """ Save the reviews found on a room page """
         try:
-        
-            # 2020-05-10
-            s = tree.xpath("//script[@id='data-state']/text()")
-            
-            if s is not None:
-                print(s)
-                print("<- s")
-                j = json.loads(s[0])
+            for individual_review in reviews:
+                ABReview(self.config, individual_review, self.room_id)
+        except Exception:
+            logger.exception("Room %s: could not save reviews", self.room_id)
 
-                r = j["bootstrapData"]["reduxData"]["homePDP"]["listingInfo"]["listing"]["sorted_reviews"]
-                if r is not None:
-                    if self.reviews is None:
-                        return False
-                    elif int(self.reviews) > 7:
-                        qtd_reviews = 7
-                    elif int(self.reviews) <= 7:
-                        qtd_reviews = int(self.reviews)
-                    for individual_review in r:
-                        review = ABReview(self.config, individual_review, self.room_id)
-                    return True
-        except IndexError:
-            return True
-        except KeyError:
-            # 2020-05-17
-            try: # get reviews from guests
-                x = j["bootstrapData"]["reduxData"]["userProfile"]["api"]["serverData"]["user_profile"]["recent_reviews_from_guest"]
-                print(x)
-                if x is not None:
-                    logger.info("Reviews from host page")
-                    
-                    for individual_review in x:
-                        review = ABReview(self.config, individual_review, self.room_id)
-                    return True
-            except KeyError:
-                print("Page has unexpected structure")
-                return False
-            try: # get reviews from hosts
-                x = j["bootstrapData"]["reduxData"]["userProfile"]["api"]["serverData"]["user_profile"]["recent_reviews_from_host"]
-                
-                if x is not None:
-                    logger.info("Reviews from host page")
-                    
-                    print(x)
-                    for individual_review in x:
-                        review = ABReview(self.config, individual_review, self.room_id)
-                    return True
-            except KeyError:
-                print("Page has unexpected structure")
-                return False
-        except Exception as e:
-            logger.exception(e)
+    def __get_reviews_text(self, response):
+        """ Save the reviews on a room (or host) page """
+        if self.reviews is None:
             return False
- 
+        room_page = airbnb_room_parser.parse_room_page(response.content)
+        if room_page is not None:
+            self.__save_reviews(room_page.reviews)
+        return True
+
+    def __missing_fields(self):
+        # the fields that should be present for every room
+        return [name for name in ROOM_REQUIRED_FIELDS
+                if getattr(self, name) is None]
+
     def __get_accommodates(self, tree):
         try:
             # 2016-04-10
@@ -785,44 +854,10 @@ class ABListing():
 
     def __get_room_info_from_tree(self, tree, flag):
         try:
-            # Some of these items do not appear on every page (eg,
-            # ratings, bathrooms), and so their absence is marked with
-            # logger.info. Others should be present for every room (eg,
-            # latitude, room_type, host_id) and so are marked with a
-            # warning.  Items coded in <meta
-            # property="airbedandbreakfast:*> elements -- country --
-            
-            if self.country is None:
-                self.__get_country(tree)
-            if self.city is None:
-                self.__get_city(tree)
-            if self.overall_satisfaction is None:
-                self.__get_rating(tree)
-            if self.latitude is None:
-                self.__get_latitude(tree)
-            if self.longitude is None:
-                self.__get_longitude(tree)
-            if self.host_id is None:
-                self.__get_host_id(tree)
-            if self.room_type is None:
-                self.__get_room_type(tree)
-            if self.neighborhood is None:
-                self.__get_neighborhood(tree)
-            if self.address is None:
-                self.__get_address(tree)
-            if self.reviews is None:
-                self.__get_reviews(tree)
-            self.__get_reviews_text(tree)
-            if self.accommodates is None:
-                self.__get_accommodates(tree)
-            if self.bedrooms is None:
-                self.__get_bedrooms(tree)
-            if self.bathrooms is None:
-                self.__get_bathrooms(tree)
-            # self.__get_minstay(tree) # get min_nights in json listing
-            if self.price is None:
-                self.__get_price(tree)
-            # self.__get_location()
+            # tree is None when the fields came from the JSON embedded in
+            # the page (see get_room_info_from_response)
+            if tree is not None:
+                self.__get_fields_from_tree(tree)
             self.deleted = 0
 
             # NOT FILLING HERE, but maybe should? have to write helper methods:
@@ -853,6 +888,46 @@ class ABListing():
         except Exception:
             logger.exception("Error parsing web page.")
             raise
+
+    def __get_fields_from_tree(self, tree):
+        """
+        The XPath helpers, for pages whose layout airbnb_room_parser does
+        not know: fill in the fields that are still missing.
+        Some of these items do not appear on every page (eg, ratings,
+        bathrooms). Others should be present for every room (eg, latitude,
+        room_type, host_id). Items coded in <meta
+        property="airbedandbreakfast:*> elements -- country --
+        """
+        if self.country is None:
+            self.__get_country(tree)
+        if self.city is None:
+            self.__get_city(tree)
+        if self.overall_satisfaction is None:
+            self.__get_rating(tree)
+        if self.latitude is None:
+            self.__get_latitude(tree)
+        if self.longitude is None:
+            self.__get_longitude(tree)
+        if self.host_id is None:
+            self.__get_host_id(tree)
+        if self.room_type is None:
+            self.__get_room_type(tree)
+        if self.neighborhood is None:
+            self.__get_neighborhood(tree)
+        if self.address is None:
+            self.__get_address(tree)
+        if self.reviews is None:
+            self.__get_reviews(tree)
+        if self.accommodates is None:
+            self.__get_accommodates(tree)
+        if self.bedrooms is None:
+            self.__get_bedrooms(tree)
+        if self.bathrooms is None:
+            self.__get_bathrooms(tree)
+        # self.__get_minstay(tree) # get min_nights in json listing
+        if self.price is None:
+            self.__get_price(tree)
+        # self.__get_location()
     
     def get_location(self):
         location = Location(self.latitude, self.longitude) # initialize a location with coordinates
@@ -889,7 +964,7 @@ class ABListing():
                     print("No reviews to find")
                     return True
                 else:
-                    return self.__get_reviews_text(tree)
+                    return self.__get_reviews_text(response)
             else:
                 logger.info("Room %s: not found", self.room_id)
                 return False
@@ -920,7 +995,7 @@ class ABListing():
                     print("No reviews to find")
                     return True
                 else:
-                    return self.__get_reviews_text(tree)
+                    return self.__get_reviews_text(response)
             else:
                 logger.info("Room %s: not found", self.room_id)
                 return False
@@ -930,4 +1005,383 @@ class ABListing():
             logger.exception("Room " + str(self.room_id) +
                              ": failed to retrieve from web site.")
             logger.error("Exception: " + str(type(ex)))
-            raise
\ No newline at end of file
+            raise
+
+
+for _field in ListingRecord.__slots__:
+    setattr(ABListing, _field, _record_property(_field))
+
+
+class ABListingBatchWriter():
+    """
+    Insert listings into the room table in batches: one statement (and one
+    commit) for each batch, rather than one for each listing. Listings that
+    are already in the table for the survey are skipped, as they are by
+    ABListing.save, and are not counted as new.
+
+    If a room_filter (an ABRoomIdFilter) is given, listings it already
+    knows are dropped before they reach the database, and the rooms of
+    each batch written are added to it. A Bloom filter may take a new room
+    for a known one, so the rooms it knows are looked up in the database
+    (one query for each batch) and dropped only if they are there.
+
+    With room_sightings set in the config file, each row is written with
+    its content_hash, and a room whose content is the same as in the last
+    row stored for it (from an earlier survey) is written as a sighting
+    instead: a room_sighting row that points to the stored row. The
+    room_by_survey view puts the two together again.
+    """
+
+    def __init__(self, config, batch_size=None, room_filter=None):
+        self.config = config
+        if batch_size is None:
+            batch_size = config.INSERT_BATCH_SIZE
+        self.batch_size = max(1, batch_size)
+        self.room_filter = room_filter
+        self.rows = {}
+        # keys of rows that a Bloom filter reports as known
+        self.maybe_known = set()
+        self.new_room_count = 0
+        # listings offered, and those dropped by the room filter
+        self.listing_count = 0
+        self.known_room_count = 0
+        # new rooms written as sightings of unchanged rows
+        self.sighting_count = 0
+
+    def add(self, listing):
+        """ Add a listing, writing the batch if it is full """
+        self.add_row(listing.get_insert_args())
+
+    def add_row(self, row):
+        """
+        Add the values of ROOM_COLUMNS for a listing, writing the
+        batch if it is full
+        """
+        self.listing_count += 1
+        key = (row[ROOM_ROOM_ID_INDEX], row[ROOM_SURVEY_ID_INDEX])
+        if (self.room_filter is not None
+                and self.room_filter.check(row[ROOM_ROOM_ID_INDEX])):
+            if self.room_filter.exact:
+                self.known_room_count += 1
+                return
+            self.maybe_known.add(key)
+        # a room may appear on more than one page of a search
+        self.rows[key] = row
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def known_room_percent(self):
+        """ The percentage of listings dropped by the room filter """
+        if not self.listing_count:
+            return 0.0
+        return 100.0 * self.known_room_count / self.listing_count
+
+    def flush(self):
+        """
+        Write the listings added since the last flush. Returns the number
+        of new rooms written.
+        """
+        if not self.rows:
+            return 0
+        rows = list(self.rows.values())
+        self.rows = {}
+        if self.maybe_known:
+            rows = self.__drop_saved(rows)
+            self.maybe_known = set()
+            if not rows:
+                return 0
+        new_rooms = self.__write(rows)
+        self.new_room_count += new_rooms
+        return new_rooms
+
+    def __drop_saved(self, rows):
+        # Return rows without those that a Bloom filter reports as known
+        # and that are in the survey. If the lookup fails, every row is
+        # written: the insert skips rooms already saved.
+        room_ids = [row[ROOM_ROOM_ID_INDEX] for row in rows
+                    if (row[ROOM_ROOM_ID_INDEX], row[ROOM_SURVEY_ID_INDEX])
+                    in self.maybe_known]
+        try:
+            conn = self.config.connect()
+            cur = conn.cursor()
+            saved = self.room_filter.saved_room_ids(cur, room_ids)
+            cur.close()
+            conn.commit()
+        except psycopg2.Error as pge:
+            logger.error("Database error looking up %s rooms: %s",
+                         len(room_ids), pge.diag.message_primary)
+            try:
+                self.config.connection.rollback()
+            except (psycopg2.Error, AttributeError):
+                del(self.config.connection)
+            return rows
+        self.known_room_count += len(saved)
+        return [row for row in rows if row[ROOM_ROOM_ID_INDEX] not in saved]
+
+    def __write(self, rows):
+        # Write rows in one statement, and return the number of new rooms.
+        # If the statement fails because of a bad row (a bad value, or one
+        # too long), the two halves of the batch are written separately,
+        # so that only the bad rows are lost.
+        try:
+            conn = self.config.connect()
+            cur = conn.cursor()
+            if self.config.ROOM_SIGHTINGS:
+                new_rooms = self.__write_rows_and_sightings(cur, rows)
+            else:
+                new_rooms = self.__insert_rows(cur, rows)
+            cur.close()
+            conn.commit()
+            logger.debug("%s rooms written: %s new", len(rows), new_rooms)
+            if self.room_filter is not None:
+                # only once they are in the table: a batch that fails is
+                # offered again if its rooms turn up again
+                self.room_filter.add_all(row[ROOM_ROOM_ID_INDEX]
+                                         for row in rows)
+            return new_rooms
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except psycopg2.Error as pge:
+            # database error: rollback operations and resume
+            try:
+                self.config.connection.rollback()
+            except (psycopg2.Error, AttributeError):
+                del(self.config.connection)
+            if len(rows) > 1 and not isinstance(
+                    pge, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                middle = len(rows) // 2
+                return self.__write(rows[:middle]) + self.__write(rows[middle:])
+            logger.error("Database error writing %s rooms: %s", len(rows),
+                         pge.diag.message_primary)
+            if len(rows) == 1:
+                logger.error("Room %s not saved", rows[0][ROOM_ROOM_ID_INDEX])
+            return 0
+
+    def __insert_rows(self, cur, rows, hashes=None):
+        # one multi-row insert (built with mogrify, which works with
+        # every psycopg2 version: execute_values needs 2.8 to return rows).
+        # Returns the number of rows inserted.
+        columns = ROOM_COLUMNS
+        if hashes is not None:
+            columns += ("content_hash",)
+            rows = [row + (row_hash,) for (row, row_hash) in zip(rows, hashes)]
+        row_template = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        values = b",".join(cur.mogrify(row_template, row) for row in rows)
+        sql = """
+            insert into room ({columns})
+            values """.format(columns=", ".join(columns))
+        cur.execute(sql.encode("utf-8") + values + b"""
+            on conflict on constraint room_pkey do nothing
+            returning room_id""")
+        return len(cur.fetchall())
+
+    def __write_rows_and_sightings(self, cur, rows):
+        # Compare each row with the last row stored for its room, and write
+        # it in full only if its content has changed. Returns the number of
+        # rows and sightings inserted.
+        cur.execute("""
+            select distinct on (room_id) room_id, survey_id, content_hash
+            from room
+            where room_id = any(%s)
+            order by room_id, survey_id desc
+            """, ([row[ROOM_ROOM_ID_INDEX] for row in rows],))
+        stored = dict((room_id, (survey_id, stored_hash))
+                      for (room_id, survey_id, stored_hash) in cur.fetchall())
+        changed_rows = []
+        changed_hashes = []
+        sightings = []
+        for row in rows:
+            row_hash = content_hash(row)
+            (room_id, survey_id) = (row[ROOM_ROOM_ID_INDEX],
+                                    row[ROOM_SURVEY_ID_INDEX])
+            (stored_survey_id, stored_hash) = stored.get(room_id,
+                                                         (None, None))
+            if stored_hash != row_hash:
+                changed_rows.append(row)
+                changed_hashes.append(row_hash)
+            elif stored_survey_id != survey_id:
+                sightings.append((room_id, survey_id, stored_survey_id))
+            # else: already stored for this survey
+        inserted = 0
+        if changed_rows:
+            inserted += self.__insert_rows(cur, changed_rows, changed_hashes)
+        if sightings:
+            values = b",".join(cur.mogrify("(%s, %s, %s)", sighting)
+                               for sighting in sightings)
+            cur.execute(b"""
+                insert into room_sighting
+                    (room_id, survey_id, source_survey_id)
+                values """ + values + b"""
+                on conflict on constraint room_sighting_pkey do nothing
+                returning room_id""")
+            sighting_count = len(cur.fetchall())
+            self.sighting_count += sighting_count
+            inserted += sighting_count
+        return inserted
+
+
+class ABRoomIdFilter():
+    """
+    The rooms already saved in a survey, kept in memory so that listings
+    seen again (in overlapping rectangles, or as pages shift while they
+    are being read) can be dropped without a trip to the database.
+
+    Modes (room_filter in the [SURVEY] section of the config file):
+        set     an exact set of room ids (the default)
+        bloom   a Bloom filter sized for room_filter_capacity rooms, for
+                surveys too big to hold every id. It uses a fixed amount
+                of memory, but it can report a room it has never seen as
+                known, with probability up to room_filter_error_rate once
+                it holds its capacity, so the rooms it reports are not
+                exact: ABListingBatchWriter looks them up in the database
+                (see saved_room_ids) rather than dropping them.
+        off     no filter
+    """
+    MODE_OFF = "off"
+    MODE_SET = "set"
+    MODE_BLOOM = "bloom"
+
+    def __init__(self, config, survey_id):
+        self.config = config
+        self.survey_id = survey_id
+        self.mode = config.ROOM_FILTER
+        if self.mode not in (self.MODE_OFF, self.MODE_SET, self.MODE_BLOOM):
+            logger.warning("Unknown room_filter %s: using %s",
+                           self.mode, self.MODE_SET)
+            self.mode = self.MODE_SET
+        self.room_ids = set()
+        if self.mode == self.MODE_BLOOM:
+            capacity = max(1, config.ROOM_FILTER_CAPACITY)
+            error_rate = min(max(config.ROOM_FILTER_ERROR_RATE, 1e-9), 0.5)
+            # the usual sizes for a Bloom filter of capacity items
+            self.bit_count = int(math.ceil(
+                -capacity * math.log(error_rate) / math.log(2) ** 2))
+            self.hash_count = max(1, int(round(
+                self.bit_count / capacity * math.log(2))))
+            self.bits = bytearray((self.bit_count + 7) // 8)
+        self.size = 0
+        self.lookups = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.mode != self.MODE_OFF
+
+    @property
+    def exact(self):
+        """ True if a room that check reports as known is saved """
+        return self.mode == self.MODE_SET
+
+    def _positions(self, room_id):
+        # double hashing: k positions from the two halves of one digest
+        digest = hashlib.md5(str(room_id).encode("ascii")).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bit_count
+                for i in range(self.hash_count)]
+
+    def _contains(self, room_id):
+        if self.mode == self.MODE_SET:
+            return room_id in self.room_ids
+        return all(self.bits[p >> 3] & (1 << (p & 7))
+                   for p in self._positions(room_id))
+
+    def _add(self, room_id):
+        if self.mode == self.MODE_SET:
+            self.room_ids.add(room_id)
+        else:
+            for p in self._positions(room_id):
+                self.bits[p >> 3] |= 1 << (p & 7)
+        self.size += 1
+
+    def check(self, room_id):
+        """
+        True if the room is known to be saved in the survey. Unless the
+        filter is exact, the room may not be saved after all.
+        """
+        if not self.enabled:
+            return False
+        with self._lock:
+            self.lookups += 1
+            if self._contains(room_id):
+                self.hits += 1
+                return True
+            return False
+
+    def add_all(self, room_ids):
+        """ Record rooms as saved in the survey """
+        if not self.enabled:
+            return
+        with self._lock:
+            for room_id in room_ids:
+                if not self._contains(room_id):
+                    self._add(room_id)
+
+    def saved_room_ids(self, cur, room_ids):
+        """
+        Return the set of room_ids that are saved in the survey, looked up
+        in the database with cursor cur.
+        """
+        if not room_ids:
+            return set()
+        if self.config.ROOM_SIGHTINGS:
+            cur.execute("""
+                select room_id from room
+                where survey_id = %s and room_id = any(%s)
+                union all
+                select room_id from room_sighting
+                where survey_id = %s and room_id = any(%s)
+                """, (self.survey_id, room_ids, self.survey_id, room_ids))
+        else:
+            cur.execute("""
+                select room_id from room
+                where survey_id = %s and room_id = any(%s)
+                """, (self.survey_id, room_ids))
+        return set(row[0] for row in cur.fetchall())
+
+    def load(self):
+        """
+        Add the rooms already saved for the survey (when it is being
+        resumed). Returns the number of rooms loaded.
+        """
+        if not self.enabled:
+            return 0
+        try:
+            conn = self.config.connect()
+            # a named cursor, so that the ids of a big survey are fetched
+            # from the server in chunks
+            cur = conn.cursor("room_filter_{}".format(self.survey_id))
+            cur.itersize = 10000
+            if self.config.ROOM_SIGHTINGS:
+                cur.execute("""
+                    select room_id from room where survey_id = %s
+                    union all
+                    select room_id from room_sighting where survey_id = %s
+                    """, (self.survey_id, self.survey_id))
+            else:
+                cur.execute("""
+                    select room_id from room where survey_id = %s
+                    """, (self.survey_id,))
+            self.add_all(row[0] for row in cur)
+            cur.close()
+            conn.commit()
+        except psycopg2.Error:
+            logger.exception("Could not load the rooms of survey %s",
+                             self.survey_id)
+            try:
+                self.config.connection.rollback()
+            except (psycopg2.Error, AttributeError):
+                del(self.config.connection)
+        logger.info("Room filter (%s): %s rooms already in survey %s",
+                    self.mode, self.size, self.survey_id)
+        return self.size
+
+    def log_summary(self):
+        """ Log how many listings the filter has dropped """
+        if not self.enabled:
+            return
+        logger.info("Room filter (%s): %s rooms, %s of %s listings "
+                    "already known (%.1f%%)", self.mode, self.size,
+                    self.hits, self.lookups,
+                    100.0 * self.hits / self.lookups if self.lookups else 0.0)
@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+"""
+Metrics for the web requests made by airbnb_ws (and for page parsing in
+surveys): counters and latency histograms, kept in an in-process registry
+and written out as Prometheus text or JSON at the end of a survey, or on
+demand by sending the process SIGUSR1.
+
+Metrics recorded:
+    ws_request_seconds              histogram of request latency, by host
+    ws_responses_total              responses by host and status code (or
+                                    exception name, for failed requests)
+    ws_response_bytes_total         bytes received, by host
+    ws_proxy_requests_total         requests by proxy and outcome
+    ws_attempts_per_page            histogram of attempts needed per page
+    ws_pages_total                  pages by result (ok, failed, cached)
+    ws_rate_limit_wait_seconds_total  time spent sleeping for the rate limit
+    ws_proxy_wait_seconds_total     time spent waiting for a free proxy
+    ws_network_seconds_total        time spent waiting on the network
+    survey_parse_seconds            histogram of time parsing pages
+    survey_save_seconds             histogram of time saving listings
+"""
+import json
+import logging
+import signal
+import threading
+import time
+
+# Set up logging
+LOGGER = logging.getLogger()
+
+METRICS_FORMAT_PROMETHEUS = "prometheus"
+METRICS_FORMAT_JSON = "json"
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ATTEMPT_BUCKETS = (1, 2, 3, 5, 10, 20)
+
+HELP = {
+    "ws_request_seconds": "Latency of individual web requests",
+    "ws_responses_total": "Web responses by status code or exception",
+    "ws_response_bytes_total": "Bytes received from the web site",
+    "ws_proxy_requests_total": "Web requests by proxy and outcome",
+    "ws_attempts_per_page": "Attempts needed to get a page",
+    "ws_pages_total": "Pages requested, by result",
+    "ws_rate_limit_wait_seconds_total": "Time spent waiting for the rate limit",
+    "ws_proxy_wait_seconds_total": "Time spent waiting for a free proxy",
+    "ws_network_seconds_total": "Time spent waiting on the network",
+    "survey_parse_seconds": "Time spent parsing pages",
+    "survey_save_seconds": "Time spent saving listings",
+}
+
+
+class Histogram():
+    """ Counts of observations in cumulative buckets, with sum and count """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for (i, bound) in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry():
+    """
+    Counters and histograms, each identified by a name and a tuple of
+    (label, value) pairs. Safe to update from several threads.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.signal_handler_set = False
+        # reentrant, so that a dump from the SIGUSR1 handler cannot
+        # deadlock against an update in progress in the main thread
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _key(labels):
+        # label values are kept as strings, so that keys always sort
+        return tuple(sorted((k, str(v)) for (k, v) in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, self._key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, self._key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(buckets)
+                self.histograms[key] = histogram
+            histogram.observe(value)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                              for (k, v) in labels) + "}"
+
+    def to_prometheus(self):
+        """ The metrics in the Prometheus text exposition format """
+        lines = []
+        with self._lock:
+            names = sorted(set([name for (name, _) in self.counters] +
+                               [name for (name, _) in self.histograms]))
+            for name in names:
+                lines.append("# HELP {} {}".format(name, HELP.get(name, name)))
+                counters = sorted((labels, value) for ((n, labels), value)
+                                  in self.counters.items() if n == name)
+                histograms = sorted(((labels, histogram) for ((n, labels),
+                                     histogram) in self.histograms.items()
+                                     if n == name), key=lambda x: x[0])
+                if counters:
+                    lines.append("# TYPE {} counter".format(name))
+                    for (labels, value) in counters:
+                        lines.append("{}{} {}".format(
+                            name, self._labels(labels), value))
+                if histograms:
+                    lines.append("# TYPE {} histogram".format(name))
+                    for (labels, histogram) in histograms:
+                        for (bound, count) in zip(histogram.buckets,
+                                                  histogram.counts):
+                            lines.append("{}_bucket{} {}".format(
+                                name, self._labels(labels, (("le", bound),)),
+                                count))
+                        lines.append("{}_bucket{} {}".format(
+                            name, self._labels(labels, (("le", "+Inf"),)),
+                            histogram.count))
+                        lines.append("{}_sum{} {}".format(
+                            name, self._labels(labels), histogram.sum))
+                        lines.append("{}_count{} {}".format(
+                            name, self._labels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        """ The metrics as a dictionary, ready for JSON """
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for ((name, labels), value)
+                        in sorted(self.counters.items())]
+            histograms = [{"name": name, "labels": dict(labels),
+                           "buckets": dict(zip([str(b) for b in
+                                                histogram.buckets],
+                                               histogram.counts)),
+                           "sum": histogram.sum, "count": histogram.count}
+                          for ((name, labels), histogram)
+                          in sorted(self.histograms.items(),
+                                    key=lambda x: x[0])]
+        return {"started": self.started, "dumped": time.time(),
+                "counters": counters, "histograms": histograms}
+
+    def dump(self, file_name=None, metrics_format=None):
+        """
+        Write the metrics to file_name (default: metrics_file in the config)
+        as Prometheus text or JSON (default: metrics_format in the config).
+        Does nothing if there is no file name.
+        """
+        file_name = file_name or self.config.METRICS_FILE
+        metrics_format = metrics_format or self.config.METRICS_FORMAT
+        if not file_name:
+            return
+        try:
+            if metrics_format == METRICS_FORMAT_JSON:
+                text = json.dumps(self.to_dict(), indent=4)
+            else:
+                text = self.to_prometheus()
+            with open(file_name, "w", encoding="utf-8") as metrics_file:
+                metrics_file.write(text)
+            LOGGER.info("Metrics written to %s", file_name)
+        except Exception:
+            LOGGER.exception("Could not write metrics to %s", file_name)
+
+
+METRICS_LOCK = threading.Lock()
+
+
+def get_metrics(config):
+    """
+    Return the metrics registry for this config, creating it if need be.
+    SIGUSR1 is set up to dump it the first time it is asked for from the
+    main thread (signal handlers can only be set there).
+    """
+    with METRICS_LOCK:
+        metrics = getattr(config, "metrics", None)
+        if metrics is None:
+            metrics = MetricsRegistry(config)
+            config.metrics = metrics
+        if (not metrics.signal_handler_set and hasattr(signal, "SIGUSR1")
+                and threading.current_thread() is threading.main_thread()):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: metrics.dump())
+            metrics.signal_handler_set = True
+        return metrics
@@ -0,0 +1,349 @@
+#!/usr/bin/python3
+"""
+Work queues in the database, so that work can be shared by any number of
+collector processes, on any number of hosts, at the same time.
+
+ABSurveyQueue: the bounding box surveys of a super survey (one for each
+sublocality of a city). Surveys are added to the survey_queue table. Each
+worker claims one survey at a time with SELECT ... FOR UPDATE SKIP LOCKED,
+so that no two workers claim the same one, and holds it under a lease that
+a background thread renews (the heartbeat) while the survey runs. If a
+worker dies, its lease expires after queue_lease seconds and the survey is
+claimed again by another worker, which resumes it from its progress log.
+
+ABFillQueue: the rooms to fill in (-f). Rooms are added to the fill_queue
+table once, each with a sort key computed then, and workers claim them in
+batches in the same way, so that claiming rooms does not get slower as the
+room table grows. A room stays done once filled, unless the fill is
+restarted (-fr).
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import psycopg2
+from airbnb_listing import ABListing
+from airbnb_survey import ABSurveyByBoundingBox
+
+logger = logging.getLogger()
+
+STATUS_QUEUED = 0
+STATUS_RUNNING = 1
+STATUS_DONE = 2
+STATUS_FAILED = 3
+
+
+def _execute(config, sql, params=None, fetch=False):
+    # one statement in its own transaction
+    conn = config.connect()
+    cur = conn.cursor()
+    try:
+        cur.execute(sql, params)
+        result = cur.fetchall() if fetch else cur.rowcount
+        cur.close()
+        conn.commit()
+        return result
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+
+
+class ABSurveyQueue():
+    """
+    The survey_queue table, seen from one worker process.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.worker = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.lease = config.QUEUE_LEASE
+        self.heartbeat_interval = min(config.QUEUE_HEARTBEAT,
+                                      max(1, self.lease / 3))
+        self.lease_lost = threading.Event()
+
+    def add_surveys(self, survey_ids, ss_id=None):
+        """
+        Queue surveys, unless they are already queued. Returns the number
+        of surveys added.
+        """
+        added = 0
+        for survey_id in survey_ids:
+            added += _execute(self.config, """
+                insert into survey_queue (survey_id, ss_id, status)
+                values (%s, %s, %s)
+                on conflict (survey_id) do nothing
+                """, (survey_id, ss_id, STATUS_QUEUED))
+        logger.info("%s surveys added to the queue", added)
+        return added
+
+    def add_super_survey(self, ss_id):
+        """ Queue all the surveys of a super survey """
+        rows = _execute(self.config, """
+            select survey_id from survey
+            where ss_id = %s
+            order by survey_id
+            """, (ss_id,), fetch=True)
+        return self.add_surveys([row[0] for row in rows], ss_id)
+
+    def claim(self):
+        """
+        Claim the next queued survey, or one whose lease has expired.
+        Returns its survey_id, or None if there is nothing to claim.
+        """
+        rows = _execute(self.config, """
+            update survey_queue
+            set status = %(running)s, worker = %(worker)s,
+                claimed = now(), heartbeat = now(),
+                lease_expires = now() + %(lease)s * interval '1 second',
+                attempts = attempts + 1
+            where survey_id = (
+                select survey_id from survey_queue
+                where status = %(queued)s
+                or (status = %(running)s and lease_expires < now())
+                order by survey_id
+                limit 1
+                for update skip locked)
+            returning survey_id, attempts
+            """, {"running": STATUS_RUNNING, "queued": STATUS_QUEUED,
+                  "worker": self.worker, "lease": self.lease}, fetch=True)
+        if not rows:
+            return None
+        (survey_id, attempts) = rows[0]
+        if attempts > 1:
+            logger.info("Survey %s reclaimed (attempt %s)", survey_id,
+                        attempts)
+        return survey_id
+
+    def renew(self, survey_id):
+        """
+        Extend the lease on a survey. Returns False if the survey is no
+        longer held by this worker.
+        """
+        return _execute(self.config, """
+            update survey_queue
+            set heartbeat = now(),
+                lease_expires = now() + %s * interval '1 second'
+            where survey_id = %s and worker = %s and status = %s
+            """, (self.lease, survey_id, self.worker, STATUS_RUNNING)) > 0
+
+    def release(self, survey_id, status):
+        """ Give up a survey, with its new status """
+        return _execute(self.config, """
+            update survey_queue
+            set status = %s, heartbeat = now(), lease_expires = null
+            where survey_id = %s and worker = %s and status = %s
+            """, (status, survey_id, self.worker, STATUS_RUNNING)) > 0
+
+    def pending(self):
+        """ The number of surveys queued or running """
+        rows = _execute(self.config, """
+            select count(*) from survey_queue where status in (%s, %s)
+            """, (STATUS_QUEUED, STATUS_RUNNING), fetch=True)
+        return rows[0][0]
+
+    def _heartbeat(self, survey_id, stop):
+        # runs in its own thread, so on its own database connection
+        try:
+            while not stop.wait(self.heartbeat_interval):
+                try:
+                    if not self.renew(survey_id):
+                        logger.warning("Lease on survey %s lost to another "
+                                       "worker: stopping it", survey_id)
+                        # the survey stops at its next node
+                        self.lease_lost.set()
+                        return
+                except psycopg2.Error:
+                    logger.exception("Could not renew the lease on survey %s",
+                                     survey_id)
+        finally:
+            if self.config.connection is not None:
+                self.config.connection.close()
+                del self.config.connection
+
+    def survey_finished(self, survey_id):
+        # ABSurvey.fini sets the status of a survey to 1 when it completes
+        rows = _execute(self.config, """
+            select status from survey where survey_id = %s
+            """, (survey_id,), fetch=True)
+        return bool(rows) and rows[0][0] == 1
+
+    def run_survey(self, survey_id):
+        """ Run a claimed survey, renewing its lease while it runs """
+        logger.info("Worker %s running survey %s", self.worker, survey_id)
+        self.lease_lost = threading.Event()
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat,
+                                     args=(survey_id, stop), daemon=True)
+        heartbeat.start()
+        finished = False
+        survey = None
+        try:
+            survey = ABSurveyByBoundingBox(self.config, survey_id)
+            survey.stop_event = self.lease_lost
+            survey.search(self.config.FLAGS_ADD)
+            finished = self.survey_finished(survey_id)
+        except (KeyboardInterrupt, SystemExit):
+            # let another worker have it straight away
+            stop.set()
+            heartbeat.join()
+            self.release(survey_id, STATUS_QUEUED)
+            raise
+        except Exception:
+            logger.exception("Survey %s failed", survey_id)
+        finally:
+            if survey is not None:
+                survey.close_log()
+        stop.set()
+        heartbeat.join()
+        if self.lease_lost.is_set():
+            # the survey belongs to another worker now
+            logger.warning("Survey %s was taken over by another worker",
+                           survey_id)
+            return False
+        if finished:
+            status = STATUS_DONE
+        else:
+            rows = _execute(self.config, """
+                select attempts from survey_queue where survey_id = %s
+                """, (survey_id,), fetch=True)
+            attempts = rows[0][0] if rows else 0
+            status = (STATUS_FAILED if attempts >= self.config.QUEUE_MAX_ATTEMPTS
+                      else STATUS_QUEUED)
+            logger.warning("Survey %s did not finish: %s", survey_id,
+                           "giving up" if status == STATUS_FAILED
+                           else "queued again")
+        self.release(survey_id, status)
+        return finished
+
+    def work(self):
+        """
+        Run surveys from the queue until there are none left queued or
+        running. While other workers hold the only surveys left, wait for
+        them, in case a lease expires.
+        """
+        logger.info("Worker %s started", self.worker)
+        survey_count = 0
+        while True:
+            survey_id = self.claim()
+            if survey_id is None:
+                if self.pending() == 0:
+                    break
+                time.sleep(self.config.QUEUE_POLL)
+                continue
+            self.run_survey(survey_id)
+            survey_count += 1
+        logger.info("Worker %s finished: %s surveys run", self.worker,
+                    survey_count)
+        return survey_count
+
+
+class ABFillQueue():
+    """
+    The fill_queue table, seen from one worker process: the rooms of a
+    survey (or of all surveys, for survey_id 0) waiting to be filled in.
+    The order in which rooms are claimed is set by fill_order:
+        random  in random order (the default)
+        newest  the rooms of the most recent surveys first, in random
+                order within each survey
+    """
+    FILL_ORDER_RANDOM = "random"
+    FILL_ORDER_NEWEST = "newest"
+
+    def __init__(self, config, survey_id):
+        self.config = config
+        self.survey_id = survey_id
+        self.worker = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.lease = config.QUEUE_LEASE
+
+    def _fill_key(self):
+        # the sort key of a room, computed once when it is queued
+        if self.config.FILL_ORDER == self.FILL_ORDER_NEWEST:
+            return "random() - survey_id"
+        return "random()"
+
+    def _survey_filter(self):
+        return "" if self.survey_id == 0 else "and survey_id = %(survey_id)s"
+
+    def add_new_rooms(self):
+        """
+        Queue the rooms (not marked deleted) that are not in the fill queue
+        yet: those added since the last fill started. Rooms a fill has
+        already done are left as they are, so a fill started while another
+        is running shares its work. Returns the number of rooms added.
+        """
+        # with room sightings, the rooms of a survey are in the
+        # room_by_survey view
+        added = _execute(self.config, """
+            insert into fill_queue (room_id, survey_id, fill_key)
+            select room_id, survey_id, {fill_key}
+            from {room_table}
+            where deleted is null
+            {survey_filter}
+            on conflict on constraint fill_queue_pkey do nothing
+            """.format(fill_key=self._fill_key(),
+                       room_table="room_by_survey"
+                       if self.config.ROOM_SIGHTINGS else "room",
+                       survey_filter=self._survey_filter()),
+            {"survey_id": self.survey_id})
+        logger.info("%s new rooms added to the fill queue", added)
+        return added
+
+    def restart(self):
+        """
+        Queue again the rooms an earlier fill has done, so that they are
+        filled again. Returns the number of rooms queued.
+        """
+        queued = _execute(self.config, """
+            update fill_queue
+            set status = %(queued)s, fill_key = {fill_key},
+                worker = null, lease_expires = null
+            where status = %(done)s
+            {survey_filter}
+            """.format(fill_key=self._fill_key(),
+                       survey_filter=self._survey_filter()),
+            {"survey_id": self.survey_id, "queued": STATUS_QUEUED,
+             "done": STATUS_DONE})
+        logger.info("Fill restarted: %s rooms queued again", queued)
+        return queued
+
+    def claim(self, room_count):
+        """
+        Claim up to room_count rooms: queued rooms, or rooms whose lease has
+        expired, in fill_key order. Returns them as a list of ABListings.
+        """
+        rows = _execute(self.config, """
+            update fill_queue
+            set status = %(claimed)s, worker = %(worker)s,
+                lease_expires = now() + %(lease)s * interval '1 second'
+            where (room_id, survey_id) in (
+                select room_id, survey_id
+                from fill_queue
+                where status < %(done)s
+                and (status = %(queued)s or lease_expires < now())
+                {survey_filter}
+                order by fill_key
+                limit %(room_count)s
+                for update skip locked)
+            returning room_id, survey_id
+            """.format(survey_filter=self._survey_filter()),
+            {"claimed": STATUS_RUNNING, "queued": STATUS_QUEUED,
+             "done": STATUS_DONE, "worker": self.worker, "lease": self.lease,
+             "survey_id": self.survey_id, "room_count": room_count},
+            fetch=True)
+        return [ABListing(self.config, room_id, survey_id)
+                for (room_id, survey_id) in rows]
+
+    def mark_done(self, listings):
+        """ Take rooms that have been filled in off the queue """
+        if not listings:
+            return 0
+        return _execute(self.config, """
+            update fill_queue
+            set status = %s, lease_expires = null
+            from (select unnest(%s) as room_id,
+                         unnest(%s) as survey_id) as filled
+            where fill_queue.room_id = filled.room_id
+            and fill_queue.survey_id = filled.survey_id
+            """, (STATUS_DONE, [listing.room_id for listing in listings],
+                  [listing.survey_id for listing in listings]))
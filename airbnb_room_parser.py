@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+"""
+Extract the properties of a room from its web page in one pass.
+
+Room pages carry their data as JSON embedded in the page: the data-state
+script (pages since 2020) or the _bootstrap-listing meta tag with the
+airbedandbreakfast meta properties (pages since 2016). Each page layout is
+registered with the date it appeared. A layout finds its JSON by scanning
+the page bytes, decodes it once and reads every field from that one
+document, so the page does not have to be parsed into an lxml tree. The
+layout that matched the last page is tried first, as consecutive pages
+nearly always share a layout.
+
+Pages that match no layout are left to the XPath helpers of ABListing.
+"""
+import html
+import logging
+import re
+import airbnb_json
+
+logger = logging.getLogger()
+
+# (date, name, function) for each layout, newest first
+LAYOUTS = []
+
+# Values of room_type_category in the data-state listing, as room types
+ROOM_TYPE_CATEGORIES = {
+    "entire_home": "Entire home/apt",
+    "private_room": "Private room",
+    "shared_room": "Shared room",
+    "hotel_room": "Hotel room",
+}
+
+NUMBER = re.compile(r"\d+(\.\d+)?")
+
+_last_layout = None
+
+
+class RoomPage():
+    """
+    What a layout found on a room page: the name of the layout, the room
+    properties (keyed by ABListing attribute name; a property that is not
+    on the page is left out) and the reviews on the page.
+    """
+
+    def __init__(self, layout, fields, reviews=None):
+        self.layout = layout
+        self.fields = fields
+        self.reviews = reviews or []
+
+
+def register_layout(date, name):
+    """
+    Decorator that registers a layout function. The function takes the
+    page as bytes and returns a RoomPage, or None if the page does not have
+    its layout.
+    """
+    def register(function):
+        LAYOUTS.append((date, name, function))
+        LAYOUTS.sort(key=lambda layout: layout[0], reverse=True)
+        return function
+    return register
+
+
+def parse_room_page(content):
+    """
+    Return a RoomPage for a room page (bytes), or None if the page matches
+    none of the registered layouts.
+    """
+    global _last_layout
+    layouts = sorted(LAYOUTS, key=lambda layout: layout[1] != _last_layout)
+    for (date, name, function) in layouts:
+        try:
+            room_page = function(content)
+        except Exception:
+            logger.exception("Room page layout %s failed", name)
+            continue
+        if room_page is not None:
+            _last_layout = name
+            return room_page
+    return None
+
+
+def _get(json_doc, *path):
+    # follow path through nested dicts, or return None
+    for key in path:
+        if not isinstance(json_doc, dict):
+            return None
+        json_doc = json_doc.get(key)
+    return json_doc
+
+
+def _number(value, cast=int):
+    # numbers may be given as labels, such as "2 bedrooms" or "1.5 baths"
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return cast(value)
+    match = NUMBER.search(str(value))
+    if match is None:
+        return None
+    return cast(float(match.group(0)))
+
+
+def _meta_content(content, attribute):
+    # the content attribute of the first meta tag with attribute, or None
+    key = attribute.encode("ascii")
+    key_position = content.find(key)
+    while key_position >= 0:
+        tag_start = content.rfind(b"<", 0, key_position)
+        tag_end = content.find(b">", key_position)
+        if content.startswith(b"<meta", tag_start) and tag_end >= 0:
+            tag = content[tag_start:tag_end]
+            value_start = tag.find(b'content="')
+            if value_start < 0:
+                return None
+            value_start += len(b'content="')
+            value_end = tag.find(b'"', value_start)
+            if value_end < 0:
+                return None
+            return html.unescape(
+                tag[value_start:value_end].decode("utf-8", "replace"))
+        key_position = content.find(key, key_position + len(key))
+    return None
+
+
+def _without_none(fields):
+    return dict((name, value) for (name, value) in fields.items()
+                if value is not None)
+
+
+@register_layout("2020-05-09", "data-state")
+def data_state_layout(content):
+    """ The data-state script: the listing is in the homePDP redux data """
+    json_text = airbnb_json.json_text_from_script(
+        content, 'id="data-state"')
+    if json_text is None:
+        return None
+    json_doc = airbnb_json.loads(json_text)
+    redux_data = _get(json_doc, "bootstrapData", "reduxData")
+    listing = _get(redux_data, "homePDP", "listingInfo", "listing")
+    if not isinstance(listing, dict):
+        # 2020-05-17: a host page, with the reviews of the host
+        profile = _get(redux_data, "userProfile", "api", "serverData",
+                       "user_profile")
+        if not isinstance(profile, dict):
+            return None
+        reviews = (profile.get("recent_reviews_from_guest") or
+                   profile.get("recent_reviews_from_host") or [])
+        return RoomPage("data-state", {}, reviews)
+    host = listing.get("primary_host") or listing.get("user") or {}
+    room_type = listing.get("room_type")
+    if room_type is None:
+        room_type = ROOM_TYPE_CATEGORIES.get(
+            listing.get("room_type_category"))
+    reviews = listing.get("visible_review_count")
+    if reviews is None:
+        reviews = listing.get("review_count")
+    fields = {
+        "country": listing.get("country"),
+        "city": listing.get("localized_city") or listing.get("city"),
+        "overall_satisfaction": listing.get("star_rating"),
+        "latitude": listing.get("lat"),
+        "longitude": listing.get("lng"),
+        "host_id": host.get("id"),
+        "room_type": room_type,
+        "neighborhood": listing.get("neighborhood"),
+        "address": listing.get("address"),
+        "reviews": _number(reviews),
+        "accommodates": _number(listing.get("person_capacity")),
+        "bedrooms": _number(listing.get("bedroom_label") or
+                            listing.get("bedrooms"), float),
+        "bathrooms": _number(listing.get("bathroom_label") or
+                             listing.get("bathrooms"), float),
+        "minstay": _number(listing.get("min_nights")),
+        "name": listing.get("name"),
+        "property_type": listing.get("room_and_property_type"),
+    }
+    if fields["neighborhood"] is not None:
+        fields["neighborhood"] = fields["neighborhood"][:50]
+    return RoomPage("data-state", _without_none(fields),
+                    listing.get("sorted_reviews"))
+
+
+@register_layout("2016-04-10", "bootstrap-listing")
+def bootstrap_listing_layout(content):
+    """
+    The _bootstrap-listing meta tag, with the location in
+    airbedandbreakfast meta properties
+    """
+    bootstrap = _meta_content(content, 'id="_bootstrap-listing"')
+    if bootstrap is None:
+        return None
+    listing = _get(airbnb_json.loads(bootstrap), "listing")
+    if not isinstance(listing, dict):
+        return None
+    fields = {
+        "country": _meta_content(
+            content, "airbedandbreakfast:country"),
+        "city": _meta_content(
+            content, "airbedandbreakfast:city"),
+        "latitude": _meta_content(
+            content, "airbedandbreakfast:location:lat"),
+        "longitude": _meta_content(
+            content, "airbedandbreakfast:location:longitude"),
+        "overall_satisfaction": listing.get("star_rating"),
+        "host_id": _get(listing, "user", "id"),
+        "room_type": listing.get("room_type"),
+        "reviews": _number(_get(listing, "review_details_interface",
+                                "review_count")),
+        "accommodates": _number(listing.get("person_capacity")),
+        "bedrooms": _number(listing.get("bedrooms"), float),
+        "bathrooms": _number(listing.get("bathrooms"), float),
+        "name": listing.get("name"),
+    }
+    return RoomPage("bootstrap-listing", _without_none(fields))
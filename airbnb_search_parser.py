@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+"""
+Extract listings from the JSON returned by Airbnb searches (explore_tabs),
+either directly by the API or inside a script tag of a search web page.
+
+The listings are found by following the known layout of the response,
+explore_tabs -> sections -> listings, falling back to a walk through the
+whole document only if the layout has changed. Each listing becomes a row
+of values for the room table, in the order of
+airbnb_listing.ROOM_COLUMNS, without building an ABListing.
+"""
+import logging
+from lxml import html
+import airbnb_json
+import airbnb_listing
+
+logger = logging.getLogger()
+
+# Where the listings are in a search response. Lists along the path are
+# followed item by item.
+LISTINGS_PATH = ("explore_tabs", "sections", "listings")
+
+# The script tag of a search web page that holds the search results
+HYPERNOVA_KEY = "spaspabundlejs"
+HYPERNOVA_XPATH = ('//script[@type="application/json"]'
+                   '[@data-hypernova-key="{}"]/text()'.format(HYPERNOVA_KEY))
+
+# Positions of the values used by the survey in a room row
+ROW_ROOM_ID = airbnb_listing.ROOM_COLUMNS.index("room_id")
+ROW_HOST_ID = airbnb_listing.ROOM_COLUMNS.index("host_id")
+ROW_ROOM_TYPE = airbnb_listing.ROOM_COLUMNS.index("room_type")
+ROW_LATITUDE = airbnb_listing.ROOM_COLUMNS.index("latitude")
+ROW_LONGITUDE = airbnb_listing.ROOM_COLUMNS.index("longitude")
+ROW_SURVEY_ID = airbnb_listing.ROOM_COLUMNS.index("survey_id")
+
+# Some fields occasionally extend beyond the varchar(255) limit
+MAX_FIELD_LENGTH = 254
+
+
+# Steal a function from StackOverflow which searches for items
+# with a given list of keys (in this case just one: "listing")
+# https://stackoverflow.com/questions/14048948/how-to-find-a-particular-json-value-by-key
+def search_json_keys(key, json_doc):
+    """ Return a list of the values for each occurrence of key
+    in json_doc, at all levels. In particular, "listings"
+    occurs more than once, and we need to get them all."""
+    found = []
+    if isinstance(json_doc, dict):
+        if key in json_doc.keys():
+            found.append(json_doc[key])
+        elif json_doc.keys():
+            for json_key in json_doc.keys():
+                result_list = search_json_keys(key, json_doc[json_key])
+                if result_list:
+                    found.extend(result_list)
+    elif isinstance(json_doc, list):
+        for item in json_doc:
+            result_list = search_json_keys(key, item)
+            if result_list:
+                found.extend(result_list)
+    return found
+
+
+def json_text_from_search_html(content):
+    """
+    Return the text of the JSON search results in a search web page (the
+    hypernova spaspabundlejs script), or None if the page does not have it.
+    content is the page as bytes. The page is scanned for the script tag
+    without being parsed; only if that fails is it parsed with lxml.
+    """
+    json_text = airbnb_json.json_text_from_script(
+        content, 'data-hypernova-key="{}"'.format(HYPERNOVA_KEY))
+    if json_text is not None:
+        return json_text
+    try:
+        scripts = html.fromstring(content).xpath(HYPERNOVA_XPATH)
+    except Exception:
+        logger.exception("Could not parse search page")
+        return None
+    if scripts:
+        return airbnb_json.strip_comment(scripts[0])
+    return None
+
+
+def follow_path(json_doc, path):
+    """
+    Return the values at path in json_doc, as a list. Where a value along
+    the path is a list, each of its items is followed.
+    """
+    nodes = [json_doc]
+    for key in path:
+        next_nodes = []
+        for node in nodes:
+            if not isinstance(node, dict):
+                continue
+            value = node.get(key)
+            if isinstance(value, list):
+                next_nodes.extend(value)
+            elif value is not None:
+                next_nodes.append(value)
+        nodes = next_nodes
+    return nodes
+
+
+def find_listings(json_doc):
+    """
+    Return the listings in a search response, each a
+    {listing, pricing_quote, verified} dict.
+    """
+    listings = follow_path(json_doc, LISTINGS_PATH)
+    if listings:
+        return listings
+    # The layout is not the one we know: look everywhere
+    logger.debug("Listings not found at %s: searching the whole document",
+                 "/".join(LISTINGS_PATH))
+    listings = []
+    for json_listings in search_json_keys("listings", json_doc):
+        if json_listings:
+            listings.extend(json_listings)
+    return listings
+
+
+def _truncate(value):
+    if value is not None and len(value) > MAX_FIELD_LENGTH:
+        return value[:MAX_FIELD_LENGTH]
+    return value
+
+
+def room_row(json_listing, survey_id):
+    """
+    Return the values for the room table (in the order of
+    airbnb_listing.ROOM_COLUMNS) for one listing of a search
+    response, or None if it has no listing.
+    """
+    listing = json_listing.get("listing")
+    if not listing or listing.get("id") is None:
+        return None
+    user = listing.get("user") or {}
+    pricing = json_listing.get("pricing_quote") or {}
+    rate = pricing.get("rate") or {}
+    host_id = user.get("id")
+    values = {
+        "room_id": int(listing["id"]),
+        "host_id": host_id,
+        "room_type": listing.get("room_type"),
+        "country": None,
+        "city": None,
+        "neighborhood": None,
+        "address": listing.get("public_address"),
+        "reviews": listing.get("reviews_count"),
+        "overall_satisfaction": listing.get("star_rating"),
+        "accommodates": listing.get("person_capacity"),
+        "bedrooms": listing.get("bedrooms"),
+        "bathrooms": listing.get("bathrooms"),
+        "price": rate.get("amount"),
+        "deleted": 0 if host_id is not None else None,
+        "minstay": listing.get("min_nights"),
+        "latitude": listing.get("lat"),
+        "longitude": listing.get("lng"),
+        "survey_id": survey_id,
+        "coworker_hosted": listing.get("coworker_hosted"),
+        "extra_host_languages": _truncate(listing.get("host_languages")),
+        "name": _truncate(listing.get("name")),
+        "property_type": _truncate(listing.get("room_and_property_type")),
+        "currency": rate.get("currency"),
+        "rate_type": pricing.get("rate_type"),
+        "sublocality": None,
+        "route": None,
+        "is_superhost": listing.get("is_superhost"),
+        "max_nights": listing.get("max_nights"),
+        "avg_rating": listing.get("avg_rating"),
+        "pictures": listing.get("picture_urls"),
+    }
+    # a column of ROOM_COLUMNS that is not set here is a KeyError, rather
+    # than a row with its values out of place
+    return tuple(values[column] for column in airbnb_listing.ROOM_COLUMNS)
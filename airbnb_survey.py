@@ -13,15 +13,43 @@ import logging
 import sys
 import random
 import psycopg2
+import heapq
+import itertools
+import threading
 import time
 from datetime import date
-from bs4 import BeautifulSoup
-import json
-from airbnb_listing import ABListing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from airbnb_listing import ABListing, ABListingBatchWriter, ABRoomIdFilter
 import airbnb_ws
+import airbnb_cache
+import airbnb_metrics
+import airbnb_json
+import airbnb_search_parser
 
 logger = logging.getLogger()
 
+
+def quadkey_from_quadtree_node(quadtree_node):
+    """
+    Encode a quadtree node ([[0, 1], [1, 1], ...]) as an integer: a leading
+    1 bit for the root (the bounding box), then two bits for each level.
+    Nodes down to zoom level 31 fit in a PostgreSQL bigint.
+    """
+    quadkey = 1
+    for leaf in quadtree_node:
+        quadkey = (quadkey << 2) | (leaf[0] << 1) | leaf[1]
+    return quadkey
+
+
+def quadtree_node_from_quadkey(quadkey):
+    """ The inverse of quadkey_from_quadtree_node """
+    quadtree_node = []
+    while quadkey > 1:
+        quadtree_node.insert(0, [(quadkey >> 1) & 1, quadkey & 1])
+        quadkey >>= 2
+    return quadtree_node
+
+
 class Timer:
     def __enter__(self):
         self.start = time.clock()
@@ -47,6 +75,10 @@ class ABSurvey():
         self.search_area_name = None
         self.set_search_area()
         self.room_types = ["Private room", "Entire home/apt", "Shared room"]
+        self.page_progress = PageProgress(config, survey_id)
+        self.room_filter = ABRoomIdFilter(config, survey_id)
+        # neighborhood name -> neighborhood_id, for neighborhood surveys
+        self.neighborhood_ids = {}
 
         # Set up logging
         logger.setLevel(config.log_level)
@@ -60,12 +92,25 @@ class ABSurvey():
 
         # logging: set log file name, format, and level
         logger.addHandler(filelog_handler)
+        self.log_handler = filelog_handler
 
         # Suppress informational logging from requests module
         logging.getLogger("requests").setLevel(logging.WARNING)
         logging.getLogger("urllib3").setLevel(logging.WARNING)
         logger.propagate = False
 
+        # Set up metrics now, from the main thread, so that SIGUSR1 dumps them
+        airbnb_metrics.get_metrics(config)
+
+    def close_log(self):
+        """
+        Stop writing to the survey log file. A process that runs several
+        surveys (see airbnb_queue) closes each log when its survey is done,
+        so that later surveys do not write to it.
+        """
+        logger.removeHandler(self.log_handler)
+        self.log_handler.close()
+
     def set_search_area(self):
         """
         Compute the search area ID and name.
@@ -108,169 +153,110 @@ class ABSurvey():
             conn.rollback()
             return False
 
-    def listing_from_search_page_json(self, json, room_id):
+    def save_search_listings(self, json_listings, flag, writer,
+                             median_lists=None):
         """
-        Some fields occasionally extend beyond the varchar(255) limit.
+        Save (or print) listings from a search response, each a
+        {listing, pricing_quote, verified} dict. The listings are extracted
+        straight into rows for the room table (see airbnb_search_parser)
+        and saved through writer, an ABListingBatchWriter, which counts the
+        new rooms. If median_lists is given, the locations of the listings
+        are added to it. Returns the number of listings.
         """
-        try:
-            listing = ABListing(self.config, room_id, self.survey_id)
-            # listing
-            json_listing = json["listing"] if "listing" in json else None
-            if json_listing is None:
-                return None
-            if "room_type" in json_listing:
-                listing.room_type = json_listing["room_type"]
-            else:
-                listing.room_type = None
-            if "user" in json_listing:
-                listing.host_id = json_listing["user"]["id"]
-            else:
-                listing.host_id = None
-            if "public_address" in json_listing:
-                listing.address = json_listing["public_address"]
-            else:
-                listing.address = None
-            if "reviews_count" in json_listing:
-                listing.reviews = json_listing["reviews_count"]
-            else:
-                listing.reviews = None
-            if "star_rating" in json_listing:
-                listing.overall_satisfaction = json_listing["star_rating"]
-            else:
-                listing.overall_satisfaction = None
-            if "person_capacity" in json_listing:
-                listing.accommodates = json_listing["person_capacity"]
-            else:
-                listing.accommodates = None
-            if "bedrooms" in json_listing:
-                listing.bedrooms = json_listing["bedrooms"]
-            else:
-                listing.bedrooms = None
-            if "bathrooms" in json_listing:
-                listing.bathrooms = json_listing["bathrooms"]
-            else:
-                listing.bathrooms = None
-            if "lat" in json_listing:
-                listing.latitude = json_listing["lat"]
-            else:
-                listing.latitude = None
-            if "lng" in json_listing:
-                listing.longitude = json_listing["lng"]
-            else:
-                listing.longitude = None
-            # The coworker_hosted item is missing or elsewhere
-            if "coworker_hosted" in json_listing:
-                listing.coworker_hosted = json_listing["coworker_hosted"]
-            else:
-                listing.coworker_hosted = None
-            # The extra_host_language item is missing or elsewhere
-            if "host_languages" in json_listing:
-                ehl = json_listing["host_languages"]
-                if len(ehl) > 254:
-                    listing.extra_host_languages = ehl[:254]
-                else:
-                    listing.extra_host_languages = ehl
-            else:
-                listing.extra_host_languages = None
-            if "name" in json_listing:
-                lname = json_listing["name"]
-                if len(lname) > 254:
-                    listing.name = lname[:254]
-                else:
-                    listing.name = lname
-            else:
-                listing.name = None
-            if "room_and_property_type" in json_listing:
-                pt = json_listing["room_and_property_type"]
-                if len(pt) > 254:
-                    listing.property_type = pt[:254]
-                else:
-                    listing.property_type = pt
-            if "is_superhost" in json_listing:
-                listing.is_superhost = json_listing["is_superhost"]
-            if "min_nights" in json_listing:
-                listing.minstay = json_listing["min_nights"]
-            if "max_nights" in json_listing:
-                listing.max_nights = json_listing["max_nights"]
-            if "avg_rating" in json_listing:
-                listing.avg_rating = json_listing["avg_rating"]
-            if "picture_urls" in json_listing:
-                listing.pictures = json_listing["picture_urls"]
-            else:
-                listing.pictures = None
-            
-            # pricing
-            json_pricing = json["pricing_quote"]
-            listing.price = json_pricing["rate"]["amount"] if "rate" in json_pricing else None
-            listing.currency = json_pricing["rate"]["currency"] if "rate" in json_pricing else None
-            listing.rate_type = json_pricing["rate_type"] if "rate_type" in json_pricing else None
-
-            return listing
-        except:
-            logger.exception("Error in survey.listing_from_search_page_json: returning None")
-            sys.exit(-1)
-            return None
+        room_count = 0
+        for json_listing in json_listings:
+            row = airbnb_search_parser.room_row(json_listing, self.survey_id)
+            if row is None:
+                continue
+            room_count += 1
+            if median_lists is not None:
+                latitude = row[airbnb_search_parser.ROW_LATITUDE]
+                longitude = row[airbnb_search_parser.ROW_LONGITUDE]
+                # in pairs, as they are also used for the location of each
+                # listing (see listings_are_concentrated)
+                if latitude is not None and longitude is not None:
+                    median_lists["latitude"].append(latitude)
+                    median_lists["longitude"].append(longitude)
+            if row[airbnb_search_parser.ROW_HOST_ID] is not None:
+                if flag == self.config.FLAGS_ADD:
+                    writer.add_row(row)
+                elif flag == self.config.FLAGS_PRINT:
+                    print(row[airbnb_search_parser.ROW_ROOM_TYPE],
+                          row[airbnb_search_parser.ROW_ROOM_ID])
+        return room_count
 
     def log_progress(self, room_type, neighborhood_id,
                      guests, section_offset, has_rooms):
-        """ Add an entry to the survey_progress_log table to record the fact
-        that a page has been visited.
+        """ Record the fact that a page has been visited, in the
+        survey_progress_log table (see PageProgress).
         This does not apply to search by bounding box, but does apply to both
         neighborhood and zipcode searches, which is why it is in ABSurvey.
         """
-        try:
-            page_info = (self.survey_id, room_type, neighborhood_id,
-                         guests, section_offset, has_rooms)
-            logger.debug("Search page: " + str(page_info))
-            sql = """
-            insert into survey_progress_log
-            (survey_id, room_type, neighborhood_id,
-            guests, page_number, has_rooms)
-            values (%s, %s, %s, %s, %s, %s)
-            """
-            conn = self.config.connect()
-            cur = conn.cursor()
-            cur.execute(sql, page_info)
-            cur.close()
-            conn.commit()
-            logger.debug("Logging survey search page for neighborhood " +
-                         str(neighborhood_id))
-            return True
-        except psycopg2.Error as pge:
-            logger.error(pge.pgerror)
-            cur.close()
-            conn.rollback()
-            return False
-        except Exception:
-            logger.error("Save survey search page failed")
-            return False
-
-    def fini(self):
+        logger.debug("Search page: %s", (self.survey_id, room_type,
+                                          neighborhood_id, guests,
+                                          section_offset, has_rooms))
+        self.page_progress.log(room_type, neighborhood_id, guests,
+                               section_offset, has_rooms)
+        return True
+
+    def fini(self, complete=True):
         """
-        Wrap up a survey: correcting status and survey_date
+        Wrap up a survey: correcting status and survey_date. A survey that
+        stopped before it was complete keeps its status, so that it is
+        resumed rather than taken as complete.
         """
         try:
             logger.info("Finishing survey %s, for %s",
                         self.survey_id, self.search_area_name)
+            # with room sightings, the rooms of the survey are in the
+            # room_by_survey view
             sql_update = """
             update survey
             set survey_date = (
             select min(last_modified)
-            from room
+            from {room_table} room
             where room.survey_id = survey.survey_id
-            ), status = 1
+            ), status = case when %s then 1 else status end
             where survey_id = %s
-            """
+            """.format(room_table="room_by_survey"
+                       if self.config.ROOM_SIGHTINGS else "room")
             conn = self.config.connect()
             cur = conn.cursor()
-            cur.execute(sql_update, (self.survey_id, ))
+            cur.execute(sql_update, (complete, self.survey_id))
             cur.close()
             conn.commit()
+            self.page_progress.flush()
+            airbnb_ws.get_proxy_scheduler(self.config).log_summary()
+            airbnb_ws.get_rate_limiter(self.config).log_summary()
+            airbnb_cache.get_response_cache(self.config).log_summary()
+            airbnb_metrics.get_metrics(self.config).dump()
             return True
         except:
             logger.exception("Survey fini failed")
             return False
 
+    def search_branches(self, branches, search_branch, flag):
+        """
+        Used with neighborhood and zipcode searches: call search_branch for
+        each of branches (tuples of arguments). The branches are
+        independent, so up to search_branch_workers of them are searched
+        at a time; each branch reads its own pages in order.
+        """
+        workers = self.config.SEARCH_BRANCH_WORKERS
+        if workers <= 1 or flag != self.config.FLAGS_ADD:
+            # FLAGS_PRINT stops after one page, which needs the main thread
+            for branch in branches:
+                search_branch(*branch)
+            return
+        logger.info("Searching %s branches, %s at a time",
+                    len(branches), workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(search_branch, *branch)
+                       for branch in branches]
+            for future in futures:
+                # raise any exception from a branch
+                future.result()
+
     def page_has_been_retrieved(self, room_type, neighborhood_or_zipcode,
                                 guests, page_number, search_by):
         """
@@ -279,105 +265,416 @@ class ABSurvey():
         Returns 0 if the page has been retrieved previously and has no rooms
         Returns -1 if the page has not been retrieved previously
         """
-        conn = self.config.connect()
-        cur = conn.cursor()
-        has_rooms = 0
+        if search_by == self.config.SEARCH_BY_NEIGHBORHOOD:
+            # TODO: Currently fails when there are no neighborhoods
+            neighborhood_id = self.neighborhood_ids.get(neighborhood_or_zipcode)
+            if neighborhood_id is None:
+                return -1
+        else:  # SEARCH_BY_ZIPCODE
+            neighborhood_id = int(neighborhood_or_zipcode)
+        has_rooms = self.page_progress.get(room_type, neighborhood_id,
+                                           guests, page_number)
+        logger.debug("has_rooms = %s for %s %s", has_rooms, search_by,
+                     neighborhood_or_zipcode)
+        return has_rooms
+
+
+class PageProgress():
+    """
+    The progress of a neighborhood or zipcode survey: the pages visited,
+    with whether they had rooms, for each room type, neighborhood (or
+    zipcode), number of guests and page number. The survey_progress_log
+    rows of the survey are loaded once, when it starts, and looked up in
+    memory; new rows are kept in memory and written in batches by flush.
+    """
+
+    def __init__(self, config, survey_id):
+        self.config = config
+        self.survey_id = survey_id
+        # (room_type, neighborhood_id, guests, page_number) -> has_rooms
+        self.pages = {}
+        self.unsaved = []
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ Read the pages already visited. Returns the number of pages """
         try:
-            if search_by == self.config.SEARCH_BY_NEIGHBORHOOD:
-                neighborhood = neighborhood_or_zipcode
-                # TODO: Currently fails when there are no neighborhoods
-                if neighborhood is None:
-                    has_rooms = -1
-                else:
-                    params = (self.survey_id, room_type, neighborhood, guests,
-                              page_number,)
-                    logger.debug("Params: " + str(params))
-                    sql = """
-                    select spl.has_rooms
-                    from survey_progress_log spl
-                    join neighborhood nb
-                    on spl.neighborhood_id = nb.neighborhood_id
-                    where survey_id = %s
-                    and room_type = %s
-                    and nb.name = %s
-                    and guests = %s
-                    and page_number = %s"""
-                    cur.execute(sql, params)
-                    has_rooms = cur.fetchone()[0]
-                    logger.debug("has_rooms = %s for neighborhood %s",
-                                 str(has_rooms), neighborhood)
-            else:  # SEARCH_BY_ZIPCODE
-                zipcode = int(neighborhood_or_zipcode)
-                params = (self.survey_id, room_type, zipcode, guests, page_number,)
-                logger.debug(params)
-                sql = """
-                    select spl.has_rooms
-                    from survey_progress_log spl
-                    where survey_id = %s
-                    and room_type = %s
-                    and neighborhood_id = %s
-                    and guests = %s
-                    and page_number = %s"""
-                cur.execute(sql, params)
-                has_rooms = cur.fetchone()[0]
-                logger.debug("has_rooms = %s for zipcode %s",
-                             str(has_rooms), str(zipcode))
-        except Exception:
-            has_rooms = -1
-            logger.debug("Page has not been retrieved previously")
-        finally:
+            conn = self.config.connect()
+            cur = conn.cursor()
+            cur.execute("""
+                select room_type, neighborhood_id, guests, page_number,
+                has_rooms
+                from survey_progress_log
+                where survey_id = %s
+                """, (self.survey_id,))
+            with self._lock:
+                for (room_type, neighborhood_id, guests, page_number,
+                     has_rooms) in cur.fetchall():
+                    self.pages[(room_type, neighborhood_id, guests,
+                                page_number)] = has_rooms
             cur.close()
-            return has_rooms
-
+            conn.commit()
+        except psycopg2.Error:
+            logger.exception("Could not read progress of survey %s",
+                             self.survey_id)
+            self.config.connection.rollback()
+        return len(self.pages)
+
+    def get(self, room_type, neighborhood_id, guests, page_number):
+        """ has_rooms for a page, or -1 if it has not been visited """
+        has_rooms = self.pages.get((room_type, neighborhood_id, guests,
+                                    page_number))
+        return -1 if has_rooms is None else has_rooms
+
+    def log(self, room_type, neighborhood_id, guests, page_number, has_rooms):
+        """ Record a visited page, to be written by the next flush """
+        with self._lock:
+            self.pages[(room_type, neighborhood_id, guests,
+                        page_number)] = has_rooms
+            self.unsaved.append((self.survey_id, room_type, neighborhood_id,
+                                 guests, page_number, has_rooms))
+
+    def flush(self):
+        """
+        Write the pages logged since the last flush. Returns False if they
+        could not be written: the survey is not affected, but those pages
+        will be visited again if it is resumed.
+        """
+        with self._lock:
+            rows = self.unsaved
+            self.unsaved = []
+        if not rows:
+            return True
+        try:
+            conn = self.config.connect()
+            cur = conn.cursor()
+            values = b",".join(cur.mogrify("(%s, %s, %s, %s, %s, %s)", row)
+                               for row in rows)
+            cur.execute(b"""
+                insert into survey_progress_log
+                (survey_id, room_type, neighborhood_id,
+                guests, page_number, has_rooms)
+                values """ + values)
+            cur.close()
+            conn.commit()
+            logger.debug("Progress logged: %s pages", len(rows))
+            return True
+        except psycopg2.Error as pge:
+            logger.error("Progress not logged: %s", pge.pgerror)
+            self.config.connection.rollback()
+            return False
 
 
-class ABSurveyByBoundingBox(ABSurvey):
+class QuadtreeProgress():
     """
-    Subclass of Survey that carries out a survey by a quadtree of bounding
-    boxes: recursively searching rectangles.
+    The progress of a bounding box survey, as a set of quadtree nodes, kept
+    in the survey_progress_log_quadtree table and in memory. Each node, for
+    each room type, is either
+    - searched: the node itself has been searched, and is zoomable, but the
+      search of its quadrants is not finished, or
+    - completed: the node and every node below it have been searched, or
+    - unexplored: the node was waiting to be searched when a best-first
+      search ran out of budget (it is searched if the survey is resumed).
+    Nodes may be searched and completed in any order, so the log works for
+    concurrent searches as well as depth-first ones. An interrupted survey
+    resumes by skipping completed subtrees and re-using the results of
+    searched nodes, so no node is searched twice. The medians of searched
+    nodes, and the split mode of the survey, are logged too, so that the
+    quadrants of a resumed survey are the same rectangles.
     """
 
+    STATUS_UNEXPLORED = 0
+    STATUS_SEARCHED = 1
+    STATUS_COMPLETED = 2
 
     def __init__(self, config, survey_id):
-        super().__init__(config, survey_id)
-        self.search_node_counter = 0
-        self.logged_progress = self.get_logged_progress()
-        self.bounding_box = self.get_bounding_box()
-
-    def get_logged_progress(self):
+        self.config = config
+        self.survey_id = survey_id
+        # (room_type, quadkey) pairs for completed subtrees
+        self.completed = set()
+        # (room_type, quadkey) -> (zoomable, median_leaf) for searched nodes
+        self.searched = {}
+        # (room_type, quadkey) pairs for nodes left unexplored
+        self.unexplored = set()
+        # the split mode used by the survey (from the log, if resuming)
+        self.split_mode = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _room_type_key(room_type):
+        # room_type is part of the primary key, so it cannot be null
+        return "" if room_type is None else room_type
+
+    def load(self):
         """
-        Retrieve from the database the progress logged in previous attempts to
-        carry out this survey, to pick up where we left off.
-        Returns None if there is no progress logged.
+        Read the progress logged in previous attempts to carry out this
+        survey. Returns the number of nodes read.
         """
         try:
             sql = """
-            select room_type, quadtree_node, median_node
-            from survey_progress_log_bb
+            select room_type, quadkey, status, zoomable, median_lat, median_lng,
+            split_mode
+            from survey_progress_log_quadtree
             where survey_id = %s
             """
             conn = self.config.connect()
             cur = conn.cursor()
             cur.execute(sql, (self.survey_id,))
-            row = cur.fetchone()
+            rows = cur.fetchall()
             cur.close()
             conn.commit()
-            if row is None:
-                logger.debug("No progress logged for survey %s", self.survey_id)
-                self.logged_progress = None
-            else:
-                logged_progress = {}
-                logged_progress["room_type"] = row[0]
-                logged_progress["quadtree"] = eval(row[1])
-                logged_progress["median"] = eval(row[2])
-                logger.info("Resuming survey - retrieved logged progress")
-                logger.info("\troom_type=%s", logged_progress["room_type"])
-                logger.info("\tquadtree node=%s", logged_progress["quadtree"])
-                logger.info("\tmedian node=%s", logged_progress["median"])
-                return logged_progress
+            with self._lock:
+                for (room_type, quadkey, status, zoomable,
+                     median_lat, median_lng, split_mode) in rows:
+                    if split_mode is not None:
+                        self.split_mode = split_mode
+                    if status == self.STATUS_COMPLETED:
+                        self.completed.add((room_type, quadkey))
+                    elif status == self.STATUS_UNEXPLORED:
+                        self.unexplored.add((room_type, quadkey))
+                    else:
+                        self.searched[(room_type, quadkey)] = (
+                            zoomable, [median_lat, median_lng])
+            return len(rows)
         except Exception:
-            logger.exception("Exception in get_progress: setting logged progress to None")
-            return None
+            logger.exception("Exception loading quadtree progress: "
+                             "searching the whole bounding box")
+            try:
+                self.config.connection.rollback()
+            except (psycopg2.Error, AttributeError):
+                del(self.config.connection)
+            return 0
+
+    def find_previous_survey(self, search_area_id, split_mode):
+        """
+        The most recent completed survey of the same search area, with
+        the same split mode, that logged zoomable nodes, or None.
+        """
+        sql = """
+        select s.survey_id
+        from survey s
+        where s.search_area_id = %s
+        and s.survey_id <> %s
+        and s.status = 1
+        and exists (
+            select 1 from survey_progress_log_quadtree spl
+            where spl.survey_id = s.survey_id
+            and spl.zoomable
+            and coalesce(spl.split_mode, %s) = %s)
+        order by s.survey_date desc nulls last, s.survey_id desc
+        limit 1
+        """
+        conn = self.config.connect()
+        cur = conn.cursor()
+        cur.execute(sql, (search_area_id, self.survey_id,
+                          self.config.SEARCH_SPLIT_GEOMETRIC, split_mode))
+        row = cur.fetchone()
+        cur.close()
+        conn.commit()
+        return None if row is None else row[0]
+
+    def load_previous_zoomable(self, search_area_id, split_mode):
+        """
+        The zoomable nodes of the previous survey of the search area (see
+        find_previous_survey), as a set of (room_type, quadkey) pairs:
+        those rectangles were full last time.
+        """
+        try:
+            previous_survey_id = self.find_previous_survey(search_area_id,
+                                                           split_mode)
+            if previous_survey_id is None:
+                return set()
+            conn = self.config.connect()
+            cur = conn.cursor()
+            cur.execute("""
+                select room_type, quadkey
+                from survey_progress_log_quadtree
+                where survey_id = %s
+                and zoomable
+                """, (previous_survey_id,))
+            zoomable = set(cur.fetchall())
+            cur.close()
+            conn.commit()
+            logger.info("Previous survey %s: %s full rectangles",
+                        previous_survey_id, len(zoomable))
+            return zoomable
+        except Exception:
+            logger.exception("Could not read the previous survey")
+            self.config.connection.rollback()
+            return set()
+
+    def seed_from_previous_survey(self, search_area_id, split_mode):
+        """
+        Warm start: copy the zoomable nodes of the most recent completed
+        survey of the same search area into this survey's log, as searched
+        nodes. Those nodes were full last time, so rather than requesting
+        all their pages again the search goes straight to their quadrants,
+        down to the nodes that were not full, which are searched as usual.
+        Every listing is still found, because the quadrants of a node cover
+        the whole node. Only a survey with the same split mode is used, so
+        that the rectangles are the same.
+        Returns the number of nodes copied.
+        """
+        try:
+            previous_survey_id = self.find_previous_survey(search_area_id,
+                                                           split_mode)
+            if previous_survey_id is None:
+                logger.info("Warm start: no previous survey of this search area")
+                return 0
+            conn = self.config.connect()
+            cur = conn.cursor()
+            sql = """
+            insert into survey_progress_log_quadtree
+            (survey_id, room_type, quadkey, status, zoomable,
+             median_lat, median_lng, split_mode)
+            select %s, room_type, quadkey, %s, true,
+                median_lat, median_lng, %s
+            from survey_progress_log_quadtree
+            where survey_id = %s
+            and zoomable
+            on conflict on constraint survey_progress_log_quadtree_pkey
+            do nothing
+            """
+            cur.execute(sql, (self.survey_id, self.STATUS_SEARCHED,
+                              split_mode, previous_survey_id))
+            seeded_node_count = cur.rowcount
+            cur.close()
+            conn.commit()
+            logger.info("Warm start from survey %s: %s nodes seeded",
+                        previous_survey_id, seeded_node_count)
+            return seeded_node_count
+        except Exception:
+            logger.exception("Warm start failed: searching from the top")
+            try:
+                self.config.connection.rollback()
+            except (psycopg2.Error, AttributeError):
+                del(self.config.connection)
+            return 0
+
+    def is_completed(self, room_type, quadtree_node):
+        key = (self._room_type_key(room_type),
+               quadkey_from_quadtree_node(quadtree_node))
+        with self._lock:
+            return key in self.completed
+
+    def get_searched(self, room_type, quadtree_node):
+        """
+        Return (zoomable, median_leaf) if this node was searched before,
+        or None
+        """
+        key = (self._room_type_key(room_type),
+               quadkey_from_quadtree_node(quadtree_node))
+        with self._lock:
+            return self.searched.get(key)
+
+    def mark_searched(self, room_type, quadtree_node, zoomable, median_leaf):
+        """
+        Log a node that has just been searched. A node that is not zoomable
+        has no quadrants to search, so it is completed.
+        """
+        status = self.STATUS_SEARCHED if zoomable else self.STATUS_COMPLETED
+        return self._log(room_type, quadtree_node, status, zoomable,
+                         median_leaf)
+
+    def mark_completed(self, room_type, quadtree_node):
+        """ Log a node whose quadrants have all been completed """
+        return self._log(room_type, quadtree_node, self.STATUS_COMPLETED)
+
+    def mark_unexplored(self, room_type, quadtree_node):
+        """ Log a node that was left unsearched when a budget ran out """
+        return self._log(room_type, quadtree_node, self.STATUS_UNEXPLORED)
+
+    def _log(self, room_type, quadtree_node, status, zoomable=None,
+             median_leaf=None):
+        room_type = self._room_type_key(room_type)
+        quadkey = quadkey_from_quadtree_node(quadtree_node)
+        (median_lat, median_lng) = (median_leaf if median_leaf
+                                    else (None, None))
+        with self._lock:
+            self.unexplored.discard((room_type, quadkey))
+            if status == self.STATUS_COMPLETED:
+                self.completed.add((room_type, quadkey))
+                self.searched.pop((room_type, quadkey), None)
+            elif status == self.STATUS_UNEXPLORED:
+                self.unexplored.add((room_type, quadkey))
+            else:
+                self.searched[(room_type, quadkey)] = (zoomable, median_leaf)
+        try:
+            # This upsert statement requires PostgreSQL 9.5
+            sql = """
+            insert into survey_progress_log_quadtree as spl
+            (survey_id, room_type, quadkey, status, zoomable,
+             median_lat, median_lng, split_mode)
+            values (%s, %s, %s, %s, %s, %s, %s, %s)
+            on conflict on constraint survey_progress_log_quadtree_pkey
+            do update
+                set status = excluded.status
+                , zoomable = coalesce(excluded.zoomable, spl.zoomable)
+                , median_lat = coalesce(excluded.median_lat, spl.median_lat)
+                , median_lng = coalesce(excluded.median_lng, spl.median_lng)
+                , split_mode = excluded.split_mode
+                , last_modified = now()
+            """
+            conn = self.config.connect()
+            cur = conn.cursor()
+            cur.execute(sql, (self.survey_id, room_type, quadkey, status,
+                              zoomable, median_lat, median_lng,
+                              self.split_mode))
+            cur.close()
+            conn.commit()
+            logger.debug("Progress logged")
+            return True
+        except Exception as e:
+            logger.warning("""Progress not logged: survey not affected, but
+                    resume will not be available if survey is truncated.""")
+            logger.exception("Exception in log_progress: {e}".format(e=type(e)))
+            try:
+                self.config.connection.rollback()
+            except (psycopg2.Error, AttributeError):
+                del(self.config.connection)
+            return False
+
+
+class ABSurveyByBoundingBox(ABSurvey):
+    """
+    Subclass of Survey that carries out a survey by a quadtree of bounding
+    boxes: recursively searching rectangles.
+    """
+    # share of a rectangle's listings in one quadrant above which the
+    # hybrid room type mode splits it by room type (see is_room_type_split)
+    ROOM_TYPE_SPLIT_SHARE = 0.9
+
+    def __init__(self, config, survey_id):
+        super().__init__(config, survey_id)
+        # search pages requested, counted by every worker
+        self.search_node_counter = 0
+        self._search_node_counter_lock = threading.Lock()
+        # set once the best-first search budget has run out, for the rest
+        # of the survey (every room type)
+        self.out_of_budget = False
+        # set from another thread (see ABSurveyQueue) to stop the search
+        # between nodes, without logging anything more for the survey
+        self.stop_event = threading.Event()
+        self.progress = QuadtreeProgress(config, survey_id)
+        self.split_mode = config.SEARCH_SPLIT_MODE
+        # (room_type, quadkey) -> (pages, new rooms) for nodes searched in
+        # this run, and the (room_type, quadkey) of the full nodes of the
+        # previous survey: used to order the best-first traversal
+        self.node_stats = {}
+        self._node_stats_lock = threading.Lock()
+        self.previous_zoomable = set()
+        # quadkeys of the nodes searched for all room types in this run
+        # that are split by room type (see is_room_type_split)
+        self.room_type_split_nodes = set()
+        self.search_started = None
+        # zoom level -> [nodes, pages, new rooms, zoomable nodes], and
+        # (room_type, quadkey) -> number of low-yield nodes in a row ending
+        # at the node, for the zoom cutoff (see zoom_cutoff)
+        self.level_stats = {}
+        self.low_yield_runs = {}
+        # (zoom level, pages) of the nodes not split because of the cutoff
+        self.cutoff_nodes = []
+        self.bounding_box = self.get_bounding_box()
 
     def get_bounding_box(self):
         try:
@@ -430,25 +727,411 @@ class ABSurveyByBoundingBox(ABSurvey):
             # Initialize search parameters
             # quadtree_node holds the quadtree: each rectangle is
             # divided into 00 | 01 | 10 | 11, and the next level down adds
-            # set starting point
-            quadtree_node = [] # list of [0,0] etc coordinates
-            median_node = [] # median lat, long to define optimal quadrants
             # set starting point for survey being resumed
-            if self.logged_progress:
-                logger.info("Restarting incomplete survey")
-            if self.config.SEARCH_DO_LOOP_OVER_ROOM_TYPES:
+            logged_node_count = self.progress.load()
+            if logged_node_count > 0:
+                logger.info("Restarting incomplete survey: "
+                            "%s nodes previously searched", logged_node_count)
+            elif self.config.SEARCH_WARM_START:
+                if self.progress.seed_from_previous_survey(
+                        self.search_area_id, self.split_mode) > 0:
+                    self.progress.load()
+            if (self.progress.split_mode is not None
+                    and self.progress.split_mode != self.split_mode):
+                logger.warning("Survey was started with split mode %s: "
+                               "continuing with it", self.progress.split_mode)
+                self.split_mode = self.progress.split_mode
+            self.progress.split_mode = self.split_mode
+            logger.info("Split mode: %s", self.split_mode)
+            self.search_started = time.time()
+            if self.is_best_first_traversal():
+                self.previous_zoomable = self.progress.load_previous_zoomable(
+                    self.search_area_id, self.split_mode)
+            self.room_filter.load()
+            if self.is_hybrid_room_types():
+                logger.info("Searching for all room types, split by room "
+                            "type where listings are concentrated, or at "
+                            "zoom %s", self.config.SEARCH_ROOM_TYPE_SPLIT_ZOOM)
+                self.search_quadtree(None, flag)
+            elif self.config.SEARCH_DO_LOOP_OVER_ROOM_TYPES:
                 for room_type in self.room_types:
+                    if self.stop_event.is_set():
+                        break
                     logger.info("-" * 70)
+                    if self.out_of_budget:
+                        logger.info("Search budget used up: %s not searched",
+                                    room_type)
+                        continue
                     logger.info("Beginning of search for %s", room_type)
-                    self.recurse_quadtree(quadtree_node, median_node, room_type, flag)
+                    self.search_quadtree(room_type, flag)
             else:
-                self.recurse_quadtree(quadtree_node, median_node, None, flag)
-            self.fini()
+                self.search_quadtree(None, flag)
+            self.room_filter.log_summary()
+            self.log_zoom_yield()
+            if self.stop_event.is_set():
+                logger.warning("Survey %s stopped: not finished",
+                               self.survey_id)
+            elif self.out_of_budget or self.progress.unexplored:
+                logger.warning("Survey %s stopped before it was complete "
+                               "(%s rectangles unexplored): search it again "
+                               "to resume it", self.survey_id,
+                               len(self.progress.unexplored))
+                self.fini(complete=False)
+            else:
+                self.fini()
         except (SystemExit, KeyboardInterrupt):
             raise
         except Exception:
             logger.exception("Error")
 
+    def is_concurrent_traversal(self):
+        return (self.config.SEARCH_TRAVERSAL ==
+                self.config.SEARCH_TRAVERSAL_CONCURRENT)
+
+    def is_best_first_traversal(self):
+        return (self.config.SEARCH_TRAVERSAL ==
+                self.config.SEARCH_TRAVERSAL_BEST_FIRST)
+
+    def is_hybrid_room_types(self):
+        return (self.config.SEARCH_DO_LOOP_OVER_ROOM_TYPES ==
+                self.config.SEARCH_ROOM_TYPES_HYBRID)
+
+    def is_room_type_split(self, room_type, quadtree_node):
+        """
+        In the hybrid room type mode, a zoomable node searched for all room
+        types is split into a node for each room type (the same rectangle),
+        rather than into quadrants, once splitting it into quadrants would
+        not help: its listings are concentrated in one quadrant (see
+        listings_are_concentrated), or it is at
+        search_room_type_split_zoom.
+        """
+        if not self.is_hybrid_room_types() or room_type is not None:
+            return False
+        if (self.progress.get_searched(None, quadtree_node) is None
+                and not self.progress.is_completed(None, quadtree_node)):
+            # no node for all room types here: the rectangle is below one
+            # that was split by room type
+            return False
+        if len(quadtree_node) >= self.config.SEARCH_ROOM_TYPE_SPLIT_ZOOM:
+            return True
+        with self._node_stats_lock:
+            if quadkey_from_quadtree_node(quadtree_node) in \
+                    self.room_type_split_nodes:
+                return True
+        # a node searched in an earlier run of the survey was split by room
+        # type if the search of its room type nodes was started
+        return any(self.progress.get_searched(split_room_type, quadtree_node)
+                   or self.progress.is_completed(split_room_type,
+                                                 quadtree_node)
+                   for split_room_type in self.room_types)
+
+    def listings_are_concentrated(self, rectangle, median_leaf,
+                                  median_lists):
+        """
+        True if nearly all (ROOM_TYPE_SPLIT_SHARE) of the listings found in
+        a rectangle are in one of the quadrants it would be split into, so
+        that the quadrant would be as full as the rectangle: many listings
+        at one address, for example.
+        """
+        locations = list(zip(median_lists["latitude"],
+                             median_lists["longitude"]))
+        if not locations:
+            return False
+        (mid_lat, mid_lng) = self.get_split_point(rectangle, median_leaf)
+        quadrant_counts = [0, 0, 0, 0]
+        for (latitude, longitude) in locations:
+            quadrant_counts[2 * (latitude < mid_lat)
+                            + (longitude < mid_lng)] += 1
+        return (max(quadrant_counts)
+                >= self.ROOM_TYPE_SPLIT_SHARE * len(locations))
+
+    def get_parent_node(self, room_type, quadtree_node):
+        """
+        The (room_type, quadtree_node) the node was split from, or None for
+        the bounding box
+        """
+        if room_type is not None and self.is_room_type_split(None,
+                                                             quadtree_node):
+            return (None, quadtree_node)
+        if not quadtree_node:
+            return None
+        return (room_type, quadtree_node[:-1])
+
+    def get_child_nodes(self, room_type, quadtree_node, median_node,
+                        median_leaf):
+        """
+        The (room_type, quadtree_node, median_node) nodes that a zoomable
+        node is split into, in the order they are searched: the quadrants
+        [0,0], [0,1], [1,0], [1,1] or, for a room type split, the node for
+        each room type.
+        """
+        if self.is_room_type_split(room_type, quadtree_node):
+            return [(split_room_type, quadtree_node, median_node)
+                    for split_room_type in self.room_types]
+        children = []
+        for int_leaf in range(4):
+            quadtree_leaf = [int(i) for i in str(bin(int_leaf))[2:].zfill(2)]
+            children.append((room_type, quadtree_node + [quadtree_leaf],
+                             median_node + [median_leaf]))
+        return children
+
+    def budget_exhausted(self):
+        """ True if the search has used up its time or request budget """
+        if (self.config.SEARCH_BUDGET_SECONDS and
+                time.time() - self.search_started >=
+                self.config.SEARCH_BUDGET_SECONDS):
+            return True
+        return bool(self.config.SEARCH_BUDGET_REQUESTS and
+                    self.search_node_counter >=
+                    self.config.SEARCH_BUDGET_REQUESTS)
+
+    def count_search_page(self):
+        with self._search_node_counter_lock:
+            self.search_node_counter += 1
+
+    def expected_yield(self, room_type, quadtree_node):
+        """
+        The number of new rooms expected from searching a node, for the
+        best-first traversal: a quarter of the new rooms found in its
+        parent, or the listings of a full node if the node was full in
+        the previous survey.
+        """
+        full_node = (self.config.SEARCH_LISTINGS_ON_FULL_PAGE
+                     * self.config.SEARCH_MAX_PAGES)
+        parent = self.get_parent_node(room_type, quadtree_node)
+        with self._node_stats_lock:
+            parent_stats = self.node_stats.get(
+                (parent[0], quadkey_from_quadtree_node(parent[1])))
+        if parent_stats is None:
+            # the parent was searched in an earlier run: it was full
+            expected = full_node / 4.0
+        else:
+            expected = parent_stats[1] / 4.0
+        if ((self.progress._room_type_key(room_type),
+             quadkey_from_quadtree_node(quadtree_node))
+                in self.previous_zoomable):
+            expected = max(expected, full_node)
+        return expected
+
+    def zoom_cutoff(self, room_type, quadtree_node, pages, new_rooms,
+                    zoomable):
+        """
+        Record the yield (new rooms per page requested) of a node that has
+        just been searched, and return True if it is zoomable but should
+        not be split: it and the zoom_cutoff_levels - 1 nodes above it
+        each found fewer than zoom_cutoff_yield new rooms per page.
+        """
+        zoom = len(quadtree_node)
+        low_yield = (pages > 0 and
+                     new_rooms < self.config.ZOOM_CUTOFF_YIELD * pages)
+        parent = self.get_parent_node(room_type, quadtree_node)
+        parent_key = (None if parent is None else
+                      (parent[0], quadkey_from_quadtree_node(parent[1])))
+        with self._node_stats_lock:
+            stats = self.level_stats.setdefault(zoom, [0, 0, 0, 0])
+            stats[0] += 1
+            stats[1] += pages
+            stats[2] += new_rooms
+            stats[3] += 1 if zoomable else 0
+            # nodes searched in an earlier run of the survey do not count
+            run = (self.low_yield_runs.get(parent_key, 0) + 1
+                   if low_yield and parent is not None else 0)
+            self.low_yield_runs[(room_type,
+                                 quadkey_from_quadtree_node(quadtree_node))] = run
+            cutoff = (zoomable and self.config.ZOOM_CUTOFF_LEVELS > 0
+                      and zoom >= self.config.ZOOM_CUTOFF_MIN_ZOOM
+                      and run >= self.config.ZOOM_CUTOFF_LEVELS)
+            if cutoff:
+                self.cutoff_nodes.append((zoom, pages))
+        return cutoff
+
+    def log_zoom_yield(self):
+        """
+        Log the new rooms per request at each zoom level and, if the zoom
+        cutoff stopped any node from being split, an estimate of the
+        requests saved: the subtrees below those nodes, as deep as
+        search_max_rectangle_zoom, with the pages per node and fraction of
+        full nodes seen at each level of this survey.
+        """
+        for zoom in sorted(self.level_stats):
+            (nodes, pages, new_rooms, zoomable) = self.level_stats[zoom]
+            logger.info("Zoom %2d: %5d nodes, %6d requests, %6d new rooms "
+                        "(%.2f per request), %d full", zoom, nodes, pages,
+                        new_rooms, new_rooms / pages if pages else 0.0,
+                        zoomable)
+        if not self.cutoff_nodes:
+            return
+        saved = 0.0
+        for (zoom, pages) in self.cutoff_nodes:
+            # the four quadrants are searched at least
+            nodes = 4.0
+            for level in range(zoom + 1,
+                               self.config.SEARCH_MAX_RECTANGLE_ZOOM + 1):
+                stats = self.level_stats.get(level)
+                if not stats or not stats[0]:
+                    saved += nodes * pages
+                    break
+                saved += nodes * stats[1] / stats[0]
+                nodes *= 4.0 * stats[3] / stats[0]
+                if nodes < 1:
+                    break
+        logger.info("Zoom cutoff: %s nodes not split, saving about %.0f "
+                    "requests", len(self.cutoff_nodes), saved)
+
+    def search_quadtree(self, room_type, flag):
+        """
+        Search the whole quadtree below the bounding box, for one room type
+        (or None for all room types), in the configured traversal order.
+        """
+        if self.is_concurrent_traversal() or self.is_best_first_traversal():
+            self.search_quadtree_concurrently(room_type, flag)
+        else:
+            # quadtree_node: list of [0,0] etc coordinates
+            # median_node: median lat, long to define optimal quadrants
+            self.recurse_quadtree([], [], room_type, flag)
+
+    def search_quadtree_concurrently(self, room_type, flag):
+        """
+        Search the quadtree with a pool of search_concurrency workers.
+        The frontier holds the nodes waiting to be searched, starting with
+        the bounding box itself; when a node is zoomable, its four quadrants
+        (or, in the hybrid room type mode, the node for each room type) are
+        added to the frontier. Nodes are independent searches, so they
+        can be searched in any order. A node is logged as completed when
+        all of its children are completed.
+
+        In the best-first traversal the frontier is a priority queue, by
+        expected new rooms (see expected_yield), and the search stops when
+        its budget runs out: the nodes still in the frontier are logged as
+        unexplored.
+        """
+        concurrency = max(1, self.config.SEARCH_CONCURRENCY)
+        best_first = self.is_best_first_traversal()
+        logger.info("Searching quadtree with %s concurrent workers%s",
+                    concurrency, ", best first" if best_first else "")
+        # each frontier entry is (room_type, quadtree_node, median_node), or
+        # for best first (-expected yield, sequence, room_type,
+        # quadtree_node, median_node)
+        frontier = []
+        sequence = itertools.count()
+        # (room_type, quadkey) -> number of children of the node not yet
+        # completed
+        remaining = {}
+
+        def push(node_room_type, quadtree_node, median_node):
+            if best_first:
+                priority = (self.expected_yield(node_room_type, quadtree_node)
+                            if quadtree_node else float("inf"))
+                heapq.heappush(frontier, (-priority, next(sequence),
+                                          node_room_type, quadtree_node,
+                                          median_node))
+            else:
+                frontier.append((node_room_type, quadtree_node, median_node))
+
+        def pop():
+            if best_first:
+                return heapq.heappop(frontier)[2:]
+            return frontier.pop()
+
+        def finish(node_room_type, quadtree_node):
+            # the subtree below the node is complete: so may be the
+            # subtrees of its ancestors
+            while True:
+                parent = self.get_parent_node(node_room_type, quadtree_node)
+                if parent is None:
+                    return
+                (node_room_type, quadtree_node) = parent
+                key = (node_room_type,
+                       quadkey_from_quadtree_node(quadtree_node))
+                remaining[key] -= 1
+                if remaining[key] > 0:
+                    return
+                del remaining[key]
+                self.progress.mark_completed(node_room_type, quadtree_node)
+
+        def expand(node_room_type, quadtree_node, median_node, zoomable,
+                   median_leaf):
+            if not zoomable:
+                finish(node_room_type, quadtree_node)
+                return
+            children = self.get_child_nodes(node_room_type, quadtree_node,
+                                            median_node, median_leaf)
+            remaining[(node_room_type,
+                       quadkey_from_quadtree_node(quadtree_node))] = len(children)
+            # children are taken from the frontier in order (in best-first
+            # order, among those of equal priority): so push them in
+            # reverse onto the stack
+            for child in (children if best_first else reversed(children)):
+                push(*child)
+
+        push(room_type, [], [])
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            in_flight = {}
+            while ((frontier and not self.out_of_budget
+                    and not self.stop_event.is_set()) or in_flight):
+                while (frontier and len(in_flight) < concurrency
+                       and not self.stop_event.is_set()):
+                    if best_first and self.budget_exhausted():
+                        if not self.out_of_budget:
+                            logger.info("Search budget used up: %s requests "
+                                        "in %.0f seconds",
+                                        self.search_node_counter,
+                                        time.time() - self.search_started)
+                        self.out_of_budget = True
+                        break
+                    (node_room_type, quadtree_node, median_node) = pop()
+                    if self.progress.is_completed(node_room_type,
+                                                  quadtree_node):
+                        logger.info("Resuming survey: subtree previously completed: %s",
+                                    quadtree_node)
+                        finish(node_room_type, quadtree_node)
+                        continue
+                    searched = self.progress.get_searched(node_room_type,
+                                                          quadtree_node)
+                    if searched is not None:
+                        logger.info("Resuming survey: node previously searched: %s",
+                                    quadtree_node)
+                        expand(node_room_type, quadtree_node, median_node,
+                               *searched)
+                        continue
+                    future = executor.submit(self.search_node, quadtree_node,
+                                             median_node, node_room_type, flag)
+                    in_flight[future] = (node_room_type, quadtree_node,
+                                         median_node)
+                if not in_flight:
+                    continue
+                (done, _) = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (node_room_type, quadtree_node,
+                     median_node) = in_flight.pop(future)
+                    # re-raises any exception from the worker
+                    result = future.result()
+                    if result is None:
+                        # not logged, so the node is searched again if the
+                        # survey is resumed
+                        logger.warning("Search failed for node %s",
+                                       quadtree_node)
+                        continue
+                    (zoomable, median_leaf) = result
+                    self.progress.mark_searched(node_room_type, quadtree_node,
+                                                zoomable, median_leaf)
+                    expand(node_room_type, quadtree_node, median_node,
+                           zoomable, median_leaf)
+        if frontier and self.stop_event.is_set():
+            logger.info("Search stopped: %s rectangles not searched",
+                        len(frontier))
+        elif frontier:
+            logger.info("%s rectangles left unexplored", len(frontier))
+            while frontier:
+                (node_room_type, quadtree_node, median_node) = pop()
+                logger.debug("Unexplored: %s %s", node_room_type,
+                             quadtree_node)
+                self.progress.mark_unexplored(node_room_type, quadtree_node)
+        logger.debug("Concurrent quadtree search complete")
+        if flag == self.config.FLAGS_PRINT:
+            # for FLAGS_PRINT, fetch one page and print it
+            sys.exit(0)
+
     def recurse_quadtree(self, quadtree_node, median_node, room_type, flag):
         """
         Recursive function to search for listings inside a rectangle.
@@ -464,54 +1147,48 @@ class ABSurveyByBoundingBox(ABSurvey):
                      [1, 1] (SW)   |   [1, 0] (SE)
 
         The quadrants are searched in the order [0,0], [0,1], [1,0], [1,1]
+
+        Returns True if the subtree below this node is complete.
         """
         try:
-            zoomable = True
-            if self.is_subtree_previously_completed(quadtree_node, room_type):
-                logger.info("Resuming survey: subtree previously completed: %s", quadtree_node)
+            if self.progress.is_completed(room_type, quadtree_node):
                 # This node is part of a tree that has already been searched
                 # completely in a previous attempt to run this survey.
-                # Go immediately to the next quadrant at the current level,
-                # or (if this is a [1, 1] node) go back up the tree one level.
-                # For example: if quadtree_node is [0,0] and the logged
-                # progress is [1,0] then the subtree for [0,0] is completed. If
-                # progress is [0,0][0,1] then the subtree is not completed.
-                # TODO: use the same technique as the loop, below
-                if not quadtree_node:
-                    return
-                if quadtree_node[-1] == [0, 0]:
-                    quadtree_node[-1] = [0, 1]
-                elif quadtree_node[-1] == [0, 1]:
-                    quadtree_node[-1] = [1, 0]
-                elif quadtree_node[-1] == [1, 0]:
-                    quadtree_node[-1] = [1, 1]
-                elif quadtree_node[-1] == [1, 1]:
-                    del quadtree_node[-1]
-                return
+                logger.info("Resuming survey: subtree previously completed: %s", quadtree_node)
+                return True
+            if self.stop_event.is_set():
+                return False
 
             # The subtree for this node has not been searched completely, so we
             # will continue to explore the tree. But does the current node need
-            # to be searched? Only if it is at least as far down the tree as
-            # the logged progress.
-            # TODO Currently the most recent quadrant is searched again: this
-            # is not a big problem.
-            searchable_node = (
-                self.logged_progress is None
-                or len(quadtree_node) >= len(self.logged_progress["quadtree"]))
-            if searchable_node:
-                # The logged_progress can be set to None, as the survey is now
-                # resumed. This should be done only once, but it is repeated.
-                # Still, it is cheap.
-                self.logged_progress = None
-                (zoomable, median_leaf) = self.search_node(
+            # to be searched? Not if it was searched in a previous attempt.
+            searched = self.progress.get_searched(room_type, quadtree_node)
+            if searched is None:
+                result = self.search_node(
                     quadtree_node, median_node, room_type, flag)
+                if result is None:
+                    # not logged, so the node is searched again if the
+                    # survey is resumed
+                    logger.warning("Search failed for node %s", quadtree_node)
+                    return False
+                (zoomable, median_leaf) = result
+                self.progress.mark_searched(room_type, quadtree_node,
+                                            zoomable, median_leaf)
             else:
-                median_leaf = self.logged_progress["median"][-1]
+                (zoomable, median_leaf) = searched
                 logger.info("Resuming survey: node previously searched: %s", quadtree_node)
 
             # Recurse through the tree
-            if zoomable:
-                # and len(self.logged_progress["quadtree"]) >= len(quadtree_node)):
+            subtree_completed = True
+            if zoomable and self.is_room_type_split(room_type, quadtree_node):
+                # search the same rectangle again for each room type
+                for split_room_type in self.room_types:
+                    if not self.recurse_quadtree(quadtree_node, median_node,
+                                                 split_room_type, flag):
+                        subtree_completed = False
+                if subtree_completed:
+                    self.progress.mark_completed(room_type, quadtree_node)
+            elif zoomable:
                 # append a node to the quadtree for a new level
                 quadtree_node.append([0,0])
                 median_node.append(median_leaf)
@@ -520,18 +1197,22 @@ class ABSurveyByBoundingBox(ABSurvey):
                     quadtree_leaf = [int(i)
                                      for i in str(bin(int_leaf))[2:].zfill(2)]
                     quadtree_node[-1] = quadtree_leaf
-                    self.recurse_quadtree(quadtree_node, median_node,
-                                          room_type, flag)
+                    if not self.recurse_quadtree(quadtree_node, median_node,
+                                                 room_type, flag):
+                        subtree_completed = False
                 # the search of the quadtree below this node is complete:
                 # remove the leaf element from the tree and return to go up a level
                 if len(quadtree_node) > 0:
                     del quadtree_node[-1]
                 if len(median_node) > 0:
                     del median_node[-1]
+                if subtree_completed:
+                    self.progress.mark_completed(room_type, quadtree_node)
             logger.debug("Returning from recurse_quadtree for %s", quadtree_node)
             if flag == self.config.FLAGS_PRINT:
                 # for FLAGS_PRINT, fetch one page and print it
                 sys.exit(0)
+            return subtree_completed
         except (SystemExit, KeyboardInterrupt):
             raise
         except TypeError as type_error:
@@ -555,7 +1236,9 @@ class ABSurveyByBoundingBox(ABSurvey):
             logger.debug("Rectangle: N={n:+.5f}, E={e:+.5f}, S={s:+.5f}, W={w:+.5f}"
                          .format(n=rectangle[0], e=rectangle[1],
                                  s=rectangle[2], w=rectangle[3]))
-            new_rooms = 0
+            # listings are written in batches, across the pages of the node
+            writer = ABListingBatchWriter(self.config,
+                                          room_filter=self.room_filter)
             # set zoomable to false if the search finishes without returning a
             # full complement of 20 pages, 18 listings per page
             zoomable = True
@@ -571,248 +1254,110 @@ class ABSurveyByBoundingBox(ABSurvey):
             # number of pages. Thanks to domatka78 for identifying the change.
             items_offset = 0
             room_count = 0
-            for section_offset in range(0, self.config.SEARCH_MAX_PAGES):
-                self.search_node_counter += 1
-                # section_offset is the zero-based counter used on the site
-                # page number is convenient for logging, etc
-                page_number = section_offset + 1
-                items_offset += room_count
-                room_count = 0
-
-                if self.config.API_KEY:
-                    # API (returns JSON)
-                    # set up the parameters for the request
-                    logger.debug("API key found: using API search at %s",
-                                 self.config.URL_API_SEARCH_ROOT)
-                    params = {}
-                    params["_format"] = "for_explore_search_web"
-                    params["_intents"] = "p1"
-                    params["adults"] = str(0)
-                    params["allow_override[]"] = ""
-                    params["auto_ib"] = str(False)
-                    params["children"] = str(0)
-                    params["client_session_id"] = self.config.CLIENT_SESSION_ID
-                    # params["currency"] = "CAD"
-                    params["experiences_per_grid"] = str(20)
-                    params["federated_search_session_id"] = "45de42ea-60d4-49a9-9335-9e52789cd306"
-                    params["fetch_filters"] = str(True)
-                    params["guests"] = str(0)
-                    params["guidebooks_per_grid"] = str(20)
-                    params["has_zero_guest_treatment"] = str(True)
-                    params["infants"] = str(0)
-                    params["is_guided_search"] = str(True)
-                    params["is_new_cards_experiment"] = str(True)
-                    params["is_standard_search"] = str(True)
-                    params["items_offset"] = str(18)
-                    params["items_per_grid"] = str(18)
-                    # params["locale"] = "en-CA"
-                    params["key"] = self.config.API_KEY
-                    params["luxury_pre_launch"] = str(False)
-                    params["metadata_only"] = str(False)
-                    # params["query"] = "Lisbon Portugal"
-                    params["query_understanding_enabled"] = str(True)
-                    params["refinement_paths[]"] = "/homes"
-                    if self.config.SEARCH_DO_LOOP_OVER_ROOM_TYPES:
-                        params["room_types[]"] = room_type
-                    params["search_type"] = "PAGINATION"
-                    params["search_by_map"] = str(True)
-                    params["section_offset"] = section_offset
-                    params["selected_tab_id"] = "home_tab"
-                    params["show_groupings"] = str(True)
-                    params["supports_for_you_v3"] = str(True)
-                    params["timezone_offset"] = "-240"
-                    params["ne_lat"] = str(rectangle[0])
-                    params["ne_lng"] = str(rectangle[1])
-                    params["sw_lat"] = str(rectangle[2])
-                    params["sw_lng"] = str(rectangle[3])
-                    params["screen_size"] = "medium"
-                    params["zoom"] = str(True)
-                    # params["version"] = "1.4.8"
-                    if items_offset > 0:
-                        params["items_offset"]   = str(items_offset)
-                        # params["items_offset"]   = str(18*items_offset)
-                        params["section_offset"]   = str(8)
-                    # make the http request
-
-                    response = airbnb_ws.ws_request_with_repeats(
-                        self.config, self.config.URL_API_SEARCH_ROOT, params)
-                    # process the response
-                    if response:
-                        json_doc = json.loads(response.text)
-                    else:
-                        # If no response, maybe it's a network problem rather
-                        # than a lack of data.To be conservative go to the next page
-                        # rather than the next rectangle
-                        logger.warning(
-                            "No response received from request despite multiple attempts: %s",
-                            params)
-                        continue
-                else:
-                    # Web page (returns HTML)
-                    logger.debug("No API key found in config file: using web search at %s",
-                                 self.config.URL_API_SEARCH_ROOT)
-                    logger.warning("These results are probably wrong")
-                    logger.warning("See README for how to set an API key")
-                    params = {}
-                    params["source"] = "filter"
-                    params["_format"] = "for_explore_search_web"
-                    params["experiences_per_grid"] = str(20)
-                    params["items_per_grid"] = str(18)
-                    params["guidebooks_per_grid"] = str(20)
-                    params["auto_ib"] = str(True)
-                    params["fetch_filters"] = str(True)
-                    params["has_zero_guest_treatment"] = str(True)
-                    params["is_guided_search"] = str(True)
-                    params["is_new_cards_experiment"] = str(True)
-                    params["luxury_pre_launch"] = str(False)
-                    params["query_understanding_enabled"] = str(True)
-                    params["show_groupings"] = str(True)
-                    params["supports_for_you_v3"] = str(True)
-                    params["timezone_offset"] = "-240"
-                    params["metadata_only"] = str(False)
-                    params["is_standard_search"] = str(True)
-                    params["refinement_paths[]"] = "/homes"
-                    params["selected_tab_id"] = "home_tab"
-                    params["allow_override[]"] = ""
-                    params["ne_lat"] = str(rectangle[0])
-                    params["ne_lng"] = str(rectangle[1])
-                    params["sw_lat"] = str(rectangle[2])
-                    params["sw_lng"] = str(rectangle[3])
-                    params["search_by_map"] = str(True)
-                    params["screen_size"] = "medium"
-                    if section_offset > 0:
-                        params["section_offset"] = str(section_offset)
-                    # make the http request
-                    response = airbnb_ws.ws_request_with_repeats(
-                        self.config, self.config.URL_API_SEARCH_ROOT, params)
-                    # process the response
+            page_number = 0
+            section_offset = 0
+            if self.config.API_KEY:
+                logger.debug("API key found: using API search at %s",
+                             self.config.URL_API_SEARCH_ROOT)
+            else:
+                logger.debug("No API key found in config file: using web search at %s",
+                             self.config.URL_API_SEARCH_ROOT)
+                logger.warning("These results are probably wrong")
+                logger.warning("See README for how to set an API key")
+            while section_offset < self.config.SEARCH_MAX_PAGES:
+                # Request a batch of pages at once. Each page after the first
+                # in a batch assumes that the pages before it are full, which
+                # is the only case in which it is needed: if a page turns out
+                # not to be full, the rest of the batch is discarded.
+                batch_size = min(max(1, self.config.SEARCH_PAGE_BATCH),
+                                 self.config.SEARCH_MAX_PAGES - section_offset)
+                batch = [(self.config.URL_API_SEARCH_ROOT,
+                          self.get_search_page_params(
+                              rectangle, room_type, section_offset + i,
+                              items_offset
+                              + i * self.config.SEARCH_LISTINGS_ON_FULL_PAGE))
+                         for i in range(batch_size)]
+                responses = airbnb_ws.ws_request_batch(self.config, batch)
+                final_page = False
+                for ((url, params), response) in zip(batch, responses):
+                    self.count_search_page()
+                    # section_offset is the zero-based counter used on the site
+                    # page number is convenient for logging, etc
+                    page_number = section_offset + 1
+                    section_offset += 1
+                    room_count = 0
                     if not response:
                         # If no response, maybe it's a network problem rather
                         # than a lack of data. To be conservative go to the next page
-                        # rather than the next rectangle
+                        # rather than the next rectangle. The next page uses the
+                        # same items_offset, so the rest of the batch is discarded.
                         logger.warning(
                             "No response received from request despite multiple attempts: %s",
                             params)
-                        continue
-                    soup = BeautifulSoup(response.content.decode("utf-8",
-                                                                 "ignore"),
-                                         "lxml")
-                    html_file = open("test.html", mode="w", encoding="utf-8")
-                    html_file.write(soup.prettify())
-                    html_file.close()
-                    # The returned page includes a script tag that encloses a
-                    # comment. The comment in turn includes a complex json
-                    # structure as a string, which has the data we need
-                    spaspabundlejs_set = soup.find_all("script",
-                                                       {"type": "application/json",
-                                                        "data-hypernova-key": "spaspabundlejs"})
-                    if spaspabundlejs_set:
-                        logger.debug("Found spaspabundlejs tag")
-                        comment = spaspabundlejs_set[0].contents[0]
-                        # strip out the comment tags (everything outside the
-                        # outermost curly braces)
-                        json_doc = json.loads(comment[comment.find("{"):comment.rfind("}")+1])
-                        logger.debug("results-containing json found")
-                    else:
-                        logger.warning("json results-containing script node "
-                                       "(spaspabundlejs) not found in the web page: "
-                                       "go to next page")
+                        break
+                    parse_start = time.time()
+                    json_doc = self.get_json_from_search_page(response)
+                    if json_doc is None:
+                        writer.flush()
                         return None
-                # Now we have the json. It includes a list of 18 or fewer listings
-                # if logger.isEnabledFor(logging.DEBUG):
-                    # json_file = open(
-                        # "json_listing_{}.json".format(self.search_node_counter),
-                        # mode="w", encoding="utf-8")
-                    # json_file.write(json.dumps(json_doc, indent=4, sort_keys=True))
-                    # json_file.close()
-                # Steal a function from StackOverflow which searches for items
-                # with a given list of keys (in this case just one: "listing")
-                # https://stackoverflow.com/questions/14048948/how-to-find-a-particular-json-value-by-key
-                def search_json_keys(key, json_doc):
-                    """ Return a list of the values for each occurrence of key
-                    in json_doc, at all levels. In particular, "listings"
-                    occurs more than once, and we need to get them all."""
-                    found = []
-                    if isinstance(json_doc, dict):
-                        if key in json_doc.keys():
-                            found.append(json_doc[key])
-                        elif json_doc.keys():
-                            for json_key in json_doc.keys():
-                                result_list = search_json_keys(key, json_doc[json_key])
-                                if result_list:
-                                    found.extend(result_list)
-                    elif isinstance(json_doc, list):
-                        for item in json_doc:
-                            result_list = search_json_keys(key, item)
-                            if result_list:
-                                found.extend(result_list)
-                    return found
-
-                # Get all items with tags "listings". Each json_listings is a
-                # list, and each json_listing is a {listing, pricing_quote, verified}
-                # dict for the listing in question
-                # There may be multiple lists of listings
-                json_listings_lists = search_json_keys("listings", json_doc)
-
-                # json_doc = json_doc["explore_tabs"]
-                # if json_doc: logger.debug("json: explore_tabs")
-                # json_doc = json_doc["sections"]
-                # if json_doc: logger.debug("json: sections")
-
-                if json_listings_lists is not None:
-                    room_count = 0
-                    for json_listings in json_listings_lists:
-                        if json_listings is None:
-                            continue
-                        for json_listing in json_listings:
-                            print(json_listing)
-                            room_id = int(json_listing["listing"]["id"])
-                            if room_id is not None:
-                                room_count += 1
-                                listing = self.listing_from_search_page_json(json_listing, room_id)
-                                if listing is None:
-                                    continue
-                                if listing.latitude is not None:
-                                    median_lists["latitude"].append(listing.latitude)
-                                if listing.longitude is not None:
-                                    median_lists["longitude"].append(listing.longitude)
-                                if listing.host_id is not None:
-                                    listing.deleted = 0
-                                    if flag == self.config.FLAGS_ADD:
-                                        if listing.save(self.config.FLAGS_INSERT_NO_REPLACE):
-                                            new_rooms += 1
-                                    elif flag == self.config.FLAGS_PRINT:
-                                        print(listing.room_type, listing.room_id)
-
-                # Log page-level results
-                logger.info("Page {page_number:02d} returned {room_count:02d} listings"
-                        .format(page_number=page_number, room_count=room_count))
-                if flag == self.config.FLAGS_PRINT:
-                    # for FLAGS_PRINT, fetch one page and print it
-                    sys.exit(0)
-                if room_count < self.config.SEARCH_LISTINGS_ON_FULL_PAGE:
-                    # If a full page of listings is not returned by Airbnb,
-                    # this branch of the search is complete.
-                    logger.info("Final page of listings for this search")
-                    zoomable = False
+                    save_start = time.time()
+                    room_count = self.save_search_page_listings(
+                        json_doc, flag, median_lists, writer)
+                    metrics = airbnb_metrics.get_metrics(self.config)
+                    metrics.observe("survey_parse_seconds",
+                                    save_start - parse_start)
+                    metrics.observe("survey_save_seconds",
+                                    time.time() - save_start)
+                    items_offset += room_count
+
+                    # Log page-level results
+                    logger.info("Page {page_number:02d} returned {room_count:02d} listings"
+                            .format(page_number=page_number, room_count=room_count))
+                    if flag == self.config.FLAGS_PRINT:
+                        # for FLAGS_PRINT, fetch one page and print it
+                        sys.exit(0)
+                    if room_count < self.config.SEARCH_LISTINGS_ON_FULL_PAGE:
+                        # If a full page of listings is not returned by Airbnb,
+                        # this branch of the search is complete.
+                        logger.info("Final page of listings for this search")
+                        zoomable = False
+                        final_page = True
+                        break
+                if final_page:
                     break
-            # Log node-level results
-            if self.config.SEARCH_DO_LOOP_OVER_ROOM_TYPES:
-                logger.info("Results: %s pages, %s new %s listings.",
-                            page_number, new_rooms, room_type)
+            # Write the rest of the listings, and log node-level results
+            writer.flush()
+            new_rooms = writer.new_room_count
+            with self._node_stats_lock:
+                self.node_stats[(room_type, quadkey_from_quadtree_node(
+                    quadtree_node))] = (page_number, new_rooms)
+            if self.zoom_cutoff(room_type, quadtree_node, page_number,
+                                new_rooms, zoomable):
+                logger.info("Zoom cutoff: not splitting node %s (%s new rooms "
+                            "in %s pages)", quadtree_node, new_rooms,
+                            page_number)
+                zoomable = False
+            # in the hybrid mode, nodes above the split zoom are searched
+            # for every room type at once (room_type None)
+            if room_type is not None:
+                logger.info("Results: %s pages, %s new %s listings, "
+                            "%s of %s already known (%.0f%%)",
+                            page_number, new_rooms, room_type,
+                            writer.known_room_count, writer.listing_count,
+                            writer.known_room_percent())
             else:
-                logger.info("Results: %s pages, %s new rooms",
-                            page_number, new_rooms)
+                logger.info("Results: %s pages, %s new rooms, "
+                            "%s of %s listings already known (%.0f%%)",
+                            page_number, new_rooms,
+                            writer.known_room_count, writer.listing_count,
+                            writer.known_room_percent())
 
 
 
-            # Median-based partitioning not currently in use: may use later
-            if len(median_node) == 0:
-                median_leaf = "[]"
-            else:
-                median_leaf = median_node[-1]
-            # calculate medians
-            if room_count > 0:
+            # The medians are used to split the rectangle in the median
+            # split mode (see get_rectangle_from_quadtree_node), and are
+            # collected from all the pages of the rectangle
+            if median_lists["latitude"] and median_lists["longitude"]:
                 median_lat = round(sorted(median_lists["latitude"])
                                    [int(len(median_lists["latitude"])/2)], 5
                                   )
@@ -823,8 +1368,14 @@ class ABSurveyByBoundingBox(ABSurvey):
             else:
                 # values not needed, but we need to fill in an item anyway
                 median_leaf = [0, 0]
-            # log progress
-            self.log_progress(room_type, quadtree_node, median_node)
+            if (zoomable and room_type is None and self.is_hybrid_room_types()
+                    and self.listings_are_concentrated(rectangle, median_leaf,
+                                                       median_lists)):
+                logger.info("Listings concentrated in one quadrant: "
+                            "splitting node %s by room type", quadtree_node)
+                with self._node_stats_lock:
+                    self.room_type_split_nodes.add(
+                        quadkey_from_quadtree_node(quadtree_node))
             return (zoomable, median_leaf)
         except UnicodeEncodeError:
             logger.error("UnicodeEncodeError: set PYTHONIOENCODING=utf-8")
@@ -837,6 +1388,161 @@ class ABSurveyByBoundingBox(ABSurvey):
             logger.exception("Exception in get_search_page_info_rectangle")
             raise
 
+    def get_search_page_params(self, rectangle, room_type, section_offset,
+                               items_offset):
+        """
+        The request parameters for one page of a rectangle search
+        """
+        params = {}
+        if self.config.API_KEY:
+            # API (returns JSON)
+            params["_format"] = "for_explore_search_web"
+            params["_intents"] = "p1"
+            params["adults"] = str(0)
+            params["allow_override[]"] = ""
+            params["auto_ib"] = str(False)
+            params["children"] = str(0)
+            params["client_session_id"] = self.config.CLIENT_SESSION_ID
+            # params["currency"] = "CAD"
+            params["experiences_per_grid"] = str(20)
+            params["federated_search_session_id"] = "45de42ea-60d4-49a9-9335-9e52789cd306"
+            params["fetch_filters"] = str(True)
+            params["guests"] = str(0)
+            params["guidebooks_per_grid"] = str(20)
+            params["has_zero_guest_treatment"] = str(True)
+            params["infants"] = str(0)
+            params["is_guided_search"] = str(True)
+            params["is_new_cards_experiment"] = str(True)
+            params["is_standard_search"] = str(True)
+            params["items_offset"] = str(18)
+            params["items_per_grid"] = str(18)
+            # params["locale"] = "en-CA"
+            params["key"] = self.config.API_KEY
+            params["luxury_pre_launch"] = str(False)
+            params["metadata_only"] = str(False)
+            # params["query"] = "Lisbon Portugal"
+            params["query_understanding_enabled"] = str(True)
+            params["refinement_paths[]"] = "/homes"
+            if room_type is not None:
+                params["room_types[]"] = room_type
+            params["search_type"] = "PAGINATION"
+            params["search_by_map"] = str(True)
+            params["section_offset"] = section_offset
+            params["selected_tab_id"] = "home_tab"
+            params["show_groupings"] = str(True)
+            params["supports_for_you_v3"] = str(True)
+            params["timezone_offset"] = "-240"
+            params["ne_lat"] = str(rectangle[0])
+            params["ne_lng"] = str(rectangle[1])
+            params["sw_lat"] = str(rectangle[2])
+            params["sw_lng"] = str(rectangle[3])
+            params["screen_size"] = "medium"
+            params["zoom"] = str(True)
+            # params["version"] = "1.4.8"
+            if items_offset > 0:
+                params["items_offset"]   = str(items_offset)
+                # params["items_offset"]   = str(18*items_offset)
+                params["section_offset"]   = str(8)
+        else:
+            # Web page (returns HTML)
+            params["source"] = "filter"
+            params["_format"] = "for_explore_search_web"
+            params["experiences_per_grid"] = str(20)
+            params["items_per_grid"] = str(18)
+            params["guidebooks_per_grid"] = str(20)
+            params["auto_ib"] = str(True)
+            params["fetch_filters"] = str(True)
+            params["has_zero_guest_treatment"] = str(True)
+            params["is_guided_search"] = str(True)
+            params["is_new_cards_experiment"] = str(True)
+            params["luxury_pre_launch"] = str(False)
+            params["query_understanding_enabled"] = str(True)
+            params["show_groupings"] = str(True)
+            params["supports_for_you_v3"] = str(True)
+            params["timezone_offset"] = "-240"
+            params["metadata_only"] = str(False)
+            params["is_standard_search"] = str(True)
+            params["refinement_paths[]"] = "/homes"
+            params["selected_tab_id"] = "home_tab"
+            params["allow_override[]"] = ""
+            params["ne_lat"] = str(rectangle[0])
+            params["ne_lng"] = str(rectangle[1])
+            params["sw_lat"] = str(rectangle[2])
+            params["sw_lng"] = str(rectangle[3])
+            params["search_by_map"] = str(True)
+            params["screen_size"] = "medium"
+            if section_offset > 0:
+                params["section_offset"] = str(section_offset)
+        return params
+
+    def get_json_from_search_page(self, response):
+        """
+        Return the json document with the search results from a search page
+        response, or None if the page does not have one.
+        """
+        if self.config.API_KEY:
+            return airbnb_json.loads(response.content)
+        if logger.isEnabledFor(logging.DEBUG):
+            # keep the latest page, for debugging
+            with open("test.html", mode="wb") as html_file:
+                html_file.write(response.content)
+        # The returned page includes a script tag that encloses a
+        # comment. The comment in turn includes a complex json
+        # structure as a string, which has the data we need
+        json_text = airbnb_search_parser.json_text_from_search_html(
+            response.content)
+        if json_text is not None:
+            logger.debug("Found spaspabundlejs tag")
+            json_doc = airbnb_json.loads(json_text)
+            logger.debug("results-containing json found")
+            return json_doc
+        else:
+            logger.warning("json results-containing script node "
+                           "(spaspabundlejs) not found in the web page: "
+                           "go to next page")
+            return None
+
+    def save_search_page_listings(self, json_doc, flag, median_lists, writer):
+        """
+        Save (or print) the listings in the json document from a search page,
+        and add their locations to median_lists. Listings are saved through
+        writer, an ABListingBatchWriter, which counts the new rooms.
+        Returns the number of listings on the page.
+        """
+        # Now we have the json. It includes a list of 18 or fewer listings
+        # if logger.isEnabledFor(logging.DEBUG):
+            # json_file = open(
+                # "json_listing_{}.json".format(self.search_node_counter),
+                # mode="w", encoding="utf-8")
+            # json_file.write(json.dumps(json_doc, indent=4, sort_keys=True))
+            # json_file.close()
+
+        # Get all items with tags "listings". Each json_listings is a
+        # list, and each json_listing is a {listing, pricing_quote, verified}
+        # dict for the listing in question
+        # There may be multiple lists of listings
+        return self.save_search_listings(
+            airbnb_search_parser.find_listings(json_doc), flag, writer,
+            median_lists)
+
+    def get_split_point(self, rectangle, medians):
+        """
+        The (latitude, longitude) at which a rectangle is split into
+        quadrants: its midpoint or, in median split mode, the median
+        location of the listings found in the rectangle, if it is inside it
+        """
+        [n_lat, e_lng, s_lat, w_lng] = rectangle
+        mid_lat = (n_lat + s_lat)/2.0
+        mid_lng = (e_lng + w_lng)/2.0
+        if (self.split_mode == self.config.SEARCH_SPLIT_MEDIAN
+                and medians and len(medians) == 2
+                and None not in medians):
+            if s_lat < medians[0] < n_lat:
+                mid_lat = medians[0]
+            if w_lng < medians[1] < e_lng:
+                mid_lng = medians[1]
+        return (mid_lat, mid_lng)
+
     def get_rectangle_from_quadtree_node(self, quadtree_node, median_node):
         try:
             rectangle = self.bounding_box[0:4]
@@ -845,11 +1551,7 @@ class ABSurveyByBoundingBox(ABSurvey):
                 logger.debug("Medians: %s", medians)
                 [n_lat, e_lng, s_lat, w_lng] = rectangle
                 blur = abs(n_lat - s_lat) * self.config.SEARCH_RECTANGLE_EDGE_BLUR
-                # find the mindpoints of the rectangle
-                mid_lat = (n_lat + s_lat)/2.0
-                mid_lng = (e_lng + w_lng)/2.0
-                # mid_lat = medians[0]
-                # mid_lng = medians[1]
+                (mid_lat, mid_lng) = self.get_split_point(rectangle, medians)
                 # overlap quadrants to ensure coverage at high zoom levels
                 # Airbnb max zoom (18) is about 0.004 on a side.
                 rectangle = []
@@ -879,73 +1581,6 @@ class ABSurveyByBoundingBox(ABSurvey):
             logger.exception("Exception in get_rectangle_from_quadtree_node")
             return None
 
-    def is_subtree_previously_completed(self, quadtree_node, room_type):
-        """
-        Return True if the child subtree of this node was completed
-        in a previous attempt at this survey.
-        """
-        subtree_previously_completed = False
-        if self.logged_progress:
-            # Compare the current node to the logged progress node by
-            # converting into strings, then comparing the integer value.
-            logger.debug("room_type=%s, self.logged_progress['room_type']=%s",
-                             room_type, self.logged_progress["room_type"])
-            if self.config.SEARCH_DO_LOOP_OVER_ROOM_TYPES == 1:
-                if (self.room_types.index(room_type)
-                    < self.room_types.index(self.logged_progress["room_type"])):
-                    subtree_previously_completed = True
-                    return subtree_previously_completed
-                if (self.room_types.index(room_type)
-                    > self.room_types.index(self.logged_progress["room_type"])):
-                    subtree_previously_completed = False
-                    return subtree_previously_completed
-            common_length = min(len(quadtree_node),
-                                len(self.logged_progress["quadtree"]))
-            s_this_quadrant = ''.join(str(quadtree_node[i][j])
-                                      for j in range(0, 2)
-                                      for i in range(0, common_length))
-            s_logged_progress = ''.join(
-                str(self.logged_progress["quadtree"][i][j])
-                for j in range(0, 2)
-                for i in range(0, common_length))
-            if (s_this_quadrant != ""
-                and int(s_this_quadrant) < int(s_logged_progress)):
-                subtree_previously_completed = True
-        return subtree_previously_completed
-
-
-    def log_progress(self, room_type, quadtree_node, median_node):
-        try:
-            # This upsert statement requires PostgreSQL 9.5
-            # Convert the quadrant to a string with repr() before storing it
-            sql = """
-            insert into survey_progress_log_bb
-            (survey_id, room_type, quadtree_node, median_node)
-            values (%s, %s, %s, %s)
-            on conflict ON CONSTRAINT survey_progress_log_bb_pkey
-            do update
-                set room_type = %s, quadtree_node = %s, median_node = %s
-                , last_modified = now()
-            where survey_progress_log_bb.survey_id = %s
-            """
-            conn = self.config.connect()
-            cur = conn.cursor()
-            cur.execute(sql, (self.survey_id,
-                              room_type, repr(quadtree_node), repr(median_node),
-                              room_type, repr(quadtree_node), repr(median_node),
-                              self.survey_id))
-            cur.close()
-            conn.commit()
-            logger.debug("Progress logged")
-            return True
-        except Exception as e:
-            logger.warning("""Progress not logged: survey not affected, but
-                    resume will not be available if survey is truncated.""")
-            logger.exception("Exception in log_progress: {e}".format(e=type(e)))
-            conn.close()
-            return False
-
-
 
 class ABSurveyByNeighborhood(ABSurvey):
     """
@@ -966,79 +1601,91 @@ class ABSurveyByNeighborhood(ABSurvey):
         else:
             logger.info("Searching by neighborhood")
             neighborhoods = self.get_neighborhoods_from_search_area()
+            if flag == self.config.FLAGS_ADD:
+                logger.info("%s pages previously visited",
+                            self.page_progress.load())
+                self.room_filter.load()
             # for some cities (eg Havana) the neighborhood information
             # is incomplete, and an additional search with no
             # neighborhood is useful
             neighborhoods = neighborhoods + [None]
-            for room_type in self.room_types:
-                logger.debug(
-                    "Searching for %(rt)s by neighborhood",
-                    {"rt": room_type})
-                if len(neighborhoods) > 0:
-                    self.__search_loop_neighborhoods(neighborhoods,
-                                                     room_type, flag)
-                else:
-                    self.__search_neighborhood(None, room_type, flag)
+            self.__search_loop_neighborhoods(neighborhoods, flag)
+            self.room_filter.log_summary()
         self.fini()
 
-    def __search_loop_neighborhoods(self, neighborhoods, room_type, flag):
-        """Loop over neighborhoods in a city. No return."""
+    def __search_loop_neighborhoods(self, neighborhoods, flag):
+        """Loop over room types and neighborhoods in a city. No return."""
         try:
-            for neighborhood in neighborhoods:
-                self.__search_neighborhood(neighborhood, room_type, flag)
+            # one branch per room type, neighborhood and guest count, so
+            # that the branches of every room type share the workers
+            branches = []
+            for room_type in self.room_types:
+                for neighborhood in neighborhoods:
+                    for guests in range(1, self.__max_guests(room_type)):
+                        branches.append((neighborhood, room_type, guests,
+                                         flag))
+            self.search_branches(branches, self.__search_neighborhood_guests,
+                                 flag)
         except Exception:
             raise
 
-    def __search_neighborhood(self, neighborhood, room_type, flag):
+    def __max_guests(self, room_type):
+        if room_type in ("Private room", "Shared room"):
+            return min(4, self.config.SEARCH_MAX_GUESTS)
+        return self.config.SEARCH_MAX_GUESTS
+
+    def __search_neighborhood_guests(self, neighborhood, room_type, guests,
+                                     flag):
         try:
-            if room_type in ("Private room", "Shared room"):
-                max_guests = min(4, self.config.SEARCH_MAX_GUESTS)
-            else:
-                max_guests = self.config.SEARCH_MAX_GUESTS
-            for guests in range(1, max_guests):
-                logger.debug("Searching for %(g)i guests", {"g": guests})
-                for section_offset in range(0, self.config.SEARCH_MAX_PAGES):
-                    if flag != self.config.FLAGS_PRINT:
-                        count = self.page_has_been_retrieved(
-                            room_type, neighborhood, guests, section_offset,
-                            self.config.SEARCH_BY_NEIGHBORHOOD)
-                        if count == 1:
-                            logger.info(
-                                "\t...search page has been visited previously")
-                            continue
-                        elif count == 0:
-                            logger.info(
-                                "\t...search page has been visited previously")
-                            break
-                        else:
-                            pass
-                    room_count = self.__search_neighborhood_page(
-                        room_type, neighborhood, guests, section_offset, flag)
-                    logger.info(("{room_type} ({g} guests): neighborhood {neighborhood}: "
-                                 "{room_count} rooms, {section_offset} pages").format(
-                                     room_type=room_type, g=str(guests),
-                                     neighborhood=neighborhood,
-                                     room_count=room_count,
-                                     section_offset=str(section_offset + 1)))
-                    if flag == self.config.FLAGS_PRINT:
-                        # for FLAGS_PRINT, fetch one page and (print) it
-                        sys.exit(0)
-                    if room_count < self.config.SEARCH_LISTINGS_ON_FULL_PAGE:
-                        logger.debug("Final page of listings for this search")
+            logger.debug("Searching for %(g)i guests", {"g": guests})
+            # listings are written in batches, across the pages of the branch
+            writer = ABListingBatchWriter(self.config,
+                                          room_filter=self.room_filter)
+            for section_offset in range(0, self.config.SEARCH_MAX_PAGES):
+                if flag != self.config.FLAGS_PRINT:
+                    count = self.page_has_been_retrieved(
+                        room_type, neighborhood, guests, section_offset,
+                        self.config.SEARCH_BY_NEIGHBORHOOD)
+                    if count == 1:
+                        logger.info(
+                            "\t...search page has been visited previously")
+                        continue
+                    elif count == 0:
+                        logger.info(
+                            "\t...search page has been visited previously")
                         break
+                    else:
+                        pass
+                room_count = self.__search_neighborhood_page(
+                    room_type, neighborhood, guests, section_offset, flag,
+                    writer)
+                logger.info(("{room_type} ({g} guests): neighborhood {neighborhood}: "
+                             "{room_count} rooms, {section_offset} pages").format(
+                                 room_type=room_type, g=str(guests),
+                                 neighborhood=neighborhood,
+                                 room_count=room_count,
+                                 section_offset=str(section_offset + 1)))
+                if flag == self.config.FLAGS_PRINT:
+                    # for FLAGS_PRINT, fetch one page and (print) it
+                    sys.exit(0)
+                if room_count < self.config.SEARCH_LISTINGS_ON_FULL_PAGE:
+                    logger.debug("Final page of listings for this search")
+                    break
+            # the rooms before the pages, so that a page logged as visited
+            # has its rooms saved
+            writer.flush()
+            self.page_progress.flush()
         except Exception:
             raise
 
     def __search_neighborhood_page(self, room_type, neighborhood, guests,
-                                   section_offset, flag):
+                                   section_offset, flag, writer):
         try:
             logger.info("-" * 70)
             logger.info(room_type + ", " +
                         str(neighborhood) + ", " +
                         str(guests) + " guests, " +
                         "page " + str(section_offset))
-            new_rooms = 0
-            room_count = 0
             params = {}
             params["page"] = str(section_offset)
             params["source"] = "filter"
@@ -1048,22 +1695,10 @@ class ABSurveyByNeighborhood(ABSurvey):
             response = airbnb_ws.ws_request_with_repeats(self.config,
                                                          self.config.URL_API_SEARCH_ROOT,
                                                          params)
-            json_response = response.json()
-            for result in json_response["results_json"]["search_results"]:
-                print(result)
-                room_id = int(result["listing"]["id"])
-                if room_id is not None:
-                    room_count += 1
-                    listing = self.listing_from_search_page_json(result, room_id)
-                    if listing is None:
-                        continue
-                    if listing.host_id is not None:
-                        listing.deleted = 0
-                        if flag == self.config.FLAGS_ADD:
-                            if listing.save(self.config.FLAGS_INSERT_NO_REPLACE):
-                                new_rooms += 1
-                        elif flag == self.config.FLAGS_PRINT:
-                            print(room_type, listing.room_id)
+            json_response = airbnb_json.loads(response.content)
+            room_count = self.save_search_listings(
+                json_response["results_json"]["search_results"], flag,
+                writer)
             if room_count > 0:
                 has_rooms = 1
             else:
@@ -1084,40 +1719,19 @@ class ABSurveyByNeighborhood(ABSurvey):
             raise
 
     def get_neighborhood_id(self, neighborhood):
-        try:
-            sql = """
-            select neighborhood_id
-            from neighborhood nb,
-                search_area sa,
-                survey s
-            where nb.search_area_id = sa.search_area_id
-            and sa.search_area_id = s.search_area_id
-            and s.survey_id = %s
-            and nb.name = %s
-            """
-            conn = self.config.connect()
-            cur = conn.cursor()
-            cur.execute(sql, (self.survey_id, neighborhood,))
-            neighborhood_id = cur.fetchone()[0]
-            cur.close()
-            conn.commit()
-            cur = conn.cursor()
-            cur.execute(sql, (self.survey_id, neighborhood,))
-            neighborhood_id = cur.fetchone()[0]
-            cur.close()
-            conn.commit()
-            return neighborhood_id
-        except psycopg2.Error:
-            raise
-        except Exception:
-            return None
+        """ The neighborhood_id of a neighborhood of the search area """
+        return self.neighborhood_ids.get(neighborhood)
 
     def get_neighborhoods_from_search_area(self):
+        """
+        The names of the neighborhoods of the search area. Their ids are
+        kept in self.neighborhood_ids.
+        """
         try:
             conn = self.config.connect()
             cur = conn.cursor()
             cur.execute("""
-                select name
+                select name, neighborhood_id
                 from neighborhood
                 where search_area_id =  %s
                 order by name""", (self.search_area_id,))
@@ -1127,6 +1741,7 @@ class ABSurveyByNeighborhood(ABSurvey):
                 if row is None:
                     break
                 neighborhoods.append(row[0])
+                self.neighborhood_ids[row[0]] = row[1]
             cur.close()
             return neighborhoods
         except Exception:
@@ -1150,48 +1765,59 @@ class ABSurveyByZipcode(ABSurvey):
         ABSurvey.update_survey_entry(self, self.config.SEARCH_BY_ZIPCODE)
         logger.info("Searching by zipcode")
         zipcodes = self.get_zipcodes_from_search_area()
+        if flag == self.config.FLAGS_ADD:
+            logger.info("%s pages previously visited",
+                        self.page_progress.load())
+            self.room_filter.load()
+        # one branch per room type, zipcode and guest count, so that the
+        # branches of every room type share the workers
+        branches = []
         for room_type in self.room_types:
-            try:
-                for zipcode in zipcodes:
-                    self.__search_zipcode(str(zipcode), room_type, self.survey_id,
-                                          flag, self.search_area_name)
-            except Exception:
-                raise
-        self.fini()
-
-    def __search_zipcode(self, zipcode, room_type, survey_id,
-                         flag, search_area_name):
-        try:
             if room_type in ("Private room", "Shared room"):
                 max_guests = min(4, self.config.SEARCH_MAX_GUESTS)
             else:
                 max_guests = self.config.SEARCH_MAX_GUESTS
-            for guests in range(1, max_guests):
-                logger.debug("Searching for %(g)i guests", {"g": guests})
-                for section_offset in range(0, self.config.SEARCH_MAX_PAGES):
-                    if flag != self.config.FLAGS_PRINT:
-                        # this efficiency check can be implemented later
-                        count = self.page_has_been_retrieved(
-                            room_type, str(zipcode),
-                            guests, section_offset, self.config.SEARCH_BY_ZIPCODE)
-                        if count == 1:
-                            logger.info(
-                                "\t...search page has been visited previously")
-                            continue
-                        elif count == 0:
-                            logger.info(
-                                "\t...search page has been visited previously")
-                            break
-                        else:
-                            logger.debug("\t...visiting search page")
-                    room_count = self.get_search_page_info_zipcode(
-                        room_type, zipcode, guests, section_offset, flag)
-                    if flag == self.config.FLAGS_PRINT:
-                        # for FLAGS_PRINT, fetch one page and print it
-                        sys.exit(0)
-                    if room_count < self.config.SEARCH_LISTINGS_ON_FULL_PAGE:
-                        logger.debug("Final page of listings for this search")
+            branches.extend((str(zipcode), room_type, guests, flag)
+                            for zipcode in zipcodes
+                            for guests in range(1, max_guests))
+        self.search_branches(branches, self.__search_zipcode_guests, flag)
+        self.room_filter.log_summary()
+        self.fini()
+
+    def __search_zipcode_guests(self, zipcode, room_type, guests, flag):
+        try:
+            logger.debug("Searching for %(g)i guests", {"g": guests})
+            # listings are written in batches, across the pages of the branch
+            writer = ABListingBatchWriter(self.config,
+                                          room_filter=self.room_filter)
+            for section_offset in range(0, self.config.SEARCH_MAX_PAGES):
+                if flag != self.config.FLAGS_PRINT:
+                    # this efficiency check can be implemented later
+                    count = self.page_has_been_retrieved(
+                        room_type, str(zipcode),
+                        guests, section_offset, self.config.SEARCH_BY_ZIPCODE)
+                    if count == 1:
+                        logger.info(
+                            "\t...search page has been visited previously")
+                        continue
+                    elif count == 0:
+                        logger.info(
+                            "\t...search page has been visited previously")
                         break
+                    else:
+                        logger.debug("\t...visiting search page")
+                room_count = self.get_search_page_info_zipcode(
+                    room_type, zipcode, guests, section_offset, flag, writer)
+                if flag == self.config.FLAGS_PRINT:
+                    # for FLAGS_PRINT, fetch one page and print it
+                    sys.exit(0)
+                if room_count < self.config.SEARCH_LISTINGS_ON_FULL_PAGE:
+                    logger.debug("Final page of listings for this search")
+                    break
+            # the rooms before the pages, so that a page logged as visited
+            # has its rooms saved
+            writer.flush()
+            self.page_progress.flush()
         except Exception:
             raise
 
@@ -1219,15 +1845,13 @@ class ABSurveyByZipcode(ABSurvey):
                         str(self.search_area_id))
             raise
 
-    def get_search_page_info_zipcode(self, room_type,
-                                     zipcode, guests, section_offset, flag):
+    def get_search_page_info_zipcode(self, room_type, zipcode, guests,
+                                     section_offset, flag, writer):
         try:
             logger.info("-" * 70)
             logger.info(room_type + ", zipcode " + str(zipcode) + ", " +
                         str(guests) + " guests, " + "page " +
                         str(section_offset + 1))
-            room_count = 0
-            new_rooms = 0
             params = {}
             params["guests"] = str(guests)
             params["section_offset"] = str(section_offset)
@@ -1237,28 +1861,16 @@ class ABSurveyByZipcode(ABSurvey):
             response = airbnb_ws.ws_request_with_repeats(self.config,
                                                          self.config.URL_API_SEARCH_ROOT,
                                                          params)
-            json_response = response.json()
-            for result in json_response["results_json"]["search_results"]:
-                room_id = int(result["listing"]["id"])
-                print(result)
-                if room_id is not None:
-                    room_count += 1
-                    listing = self.listing_from_search_page_json(result, room_id)
-                    if listing is None:
-                        continue
-                    if listing.host_id is not None:
-                        listing.deleted = 0
-                        if flag == self.config.FLAGS_ADD:
-                            if listing.save(self.config.FLAGS_INSERT_NO_REPLACE):
-                                new_rooms += 1
-                        elif flag == self.config.FLAGS_PRINT:
-                            print(room_type, listing.room_id)
+            json_response = airbnb_json.loads(response.content)
+            room_count = self.save_search_listings(
+                json_response["results_json"]["search_results"], flag,
+                writer)
             if room_count > 0:
                 has_rooms = 1
             else:
                 has_rooms = 0
             if flag == self.config.FLAGS_ADD:
-                self.log_progress(room_type, zipcode,
+                self.log_progress(room_type, int(zipcode),
                                   guests, section_offset, has_rooms)
             else:
                 logger.info("No rooms found")
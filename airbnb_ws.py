@@ -5,14 +5,28 @@ a set of requests.
 
 Tom Slee, 2013--2017.
 """
+import asyncio
+import http.cookiejar
 import logging
 import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 import requests
+import requests.adapters
+import airbnb_cache
+import airbnb_metrics
 
 # Set up logging
 LOGGER = logging.getLogger()
 
+# Rate limits are kept per host: this is the key for Google geocoding calls,
+# which are made through the googlemaps client rather than through requests
+GOOGLE_GEOCODING_HOST = "maps.googleapis.com"
+# Responses that mean the site wants us to slow down
+THROTTLE_STATUS_CODES = (403, 429, 503)
+
 
 def ws_request_with_repeats(config, url, params=None):
     """ An attempt to get data from Airbnb. The function wraps
@@ -20,15 +34,25 @@ def ws_request_with_repeats(config, url, params=None):
     occasionally, in an attempt to get a more reliable
     data set.
 
+    Responses go through the response cache (see airbnb_cache), which
+    may supply the page without a request, or save it.
+
     Returns None on failure
     """
     LOGGER.debug("URL for this search: %s", url)
+    cache = airbnb_cache.get_response_cache(config)
+    response = cache.get(url, params)
+    if response is not None or cache.offline:
+        ws_record_page(config, 0, response)
+        return response
     for attempt_id in range(config.MAX_CONNECTION_ATTEMPTS):
         try:
             response = ws_individual_request(config, url, attempt_id, params)
             if response is None:
                 continue
             elif response.status_code == requests.codes.ok:
+                cache.put(url, params, response)
+                ws_record_page(config, attempt_id + 1, response)
                 return response
         except (SystemExit, KeyboardInterrupt):
             raise
@@ -38,33 +62,56 @@ def ws_request_with_repeats(config, url, params=None):
             LOGGER.error("Failed to retrieve web page %s", url)
             LOGGER.exception("Exception retrieving page: %s", str(type(ex)))
             # Failed
+    ws_record_page(config, config.MAX_CONNECTION_ATTEMPTS, None)
     return None
 
 
+def ws_record_page(config, attempts, response):
+    """
+    Record the result of a request for a page, which took a number of
+    attempts (0 if it came from the cache), in the metrics.
+    """
+    metrics = airbnb_metrics.get_metrics(config)
+    if response is None:
+        result = "failed"
+    elif getattr(response, "from_cache", False):
+        result = "cached"
+    else:
+        result = "ok"
+    metrics.inc("ws_pages_total", result=result)
+    if attempts > 0:
+        metrics.observe("ws_attempts_per_page", attempts,
+                        buckets=airbnb_metrics.ATTEMPT_BUCKETS)
+
+
 def ws_individual_request(config, url, attempt_id, params=None):
     """
     Individual web request: returns a response object or None on failure
+    The proxy is chosen by the proxy scheduler, which is told the outcome of
+    the request when it is complete. Timings, status and size of the
+    request are recorded in the metrics (see airbnb_metrics).
     """
+    metrics = airbnb_metrics.get_metrics(config)
+    rate_limiter = get_rate_limiter(config)
+    host = urlsplit(url).netloc
+    # be nice: wait for the rate limit for this host
+    wait_start = time.time()
+    rate_limiter.acquire(host)
+    scheduler = get_proxy_scheduler(config)
+    # wait for a proxy (or the direct connection) that is not cooling down
+    proxy_start = time.time()
+    http_proxy = scheduler.acquire()
+    outcome = ProxyScheduler.OUTCOME_ERROR
+    throttled = False
+    status = "error"
+    start_time = time.time()
+    metrics.inc("ws_rate_limit_wait_seconds_total", proxy_start - wait_start)
+    metrics.inc("ws_proxy_wait_seconds_total", start_time - proxy_start)
     try:
-        # wait
-        sleep_time = config.REQUEST_SLEEP * random.random()
-        LOGGER.debug("sleeping " + str(sleep_time)[:7] + " seconds...")
-        time.sleep(sleep_time)  # be nice
-
         timeout = config.HTTP_TIMEOUT
 
-        # If a list of user agent strings is supplied, use it
-        if len(config.USER_AGENT_LIST) > 0:
-            user_agent = random.choice(config.USER_AGENT_LIST)
-            headers = {"User-Agent": user_agent}
-        else:
-            headers = {'User-Agent': 'Mozilla/5.0'}
-
         # If there is a list of proxies supplied, use it
-        http_proxy = None
-        LOGGER.debug("Using " + str(len(config.HTTP_PROXY_LIST)) + " proxies")
-        if len(config.HTTP_PROXY_LIST) > 0:
-            http_proxy = random.choice(config.HTTP_PROXY_LIST)
+        if http_proxy is not None:
             proxies = {
                 'http': http_proxy,
                 'https': http_proxy,
@@ -74,47 +121,35 @@ def ws_individual_request(config, url, attempt_id, params=None):
             proxies = None
             LOGGER.debug("Requesting page without using a proxy")
 
-        # Now make the request
+        # Now make the request, through the pooled session for this proxy,
+        # which supplies the user agent
         # cookie to avoid auto-redirect
         cookies = dict(sticky_locale='en')
-        response = requests.get(url, params, timeout=timeout,
-                                headers=headers, cookies=cookies, proxies=proxies)
+        session_manager = get_session_manager(config)
+        session = session_manager.get_session(http_proxy)
+        response = session.get(url, params=params, timeout=timeout,
+                               cookies=cookies, proxies=proxies)
+        status = response.status_code
+        metrics.inc("ws_response_bytes_total", len(response.content),
+                    host=host)
         if response.status_code < 300:
+            outcome = ProxyScheduler.OUTCOME_OK
             return response
         else:
+            # The scheduler puts this proxy (or the direct connection) into
+            # a cooldown of its own; other proxies carry on.
+            outcome = ProxyScheduler.OUTCOME_BLOCKED
+            throttled = response.status_code in THROTTLE_STATUS_CODES
+            # Start again with fresh connections and user agent next time
+            session_manager.discard_session(http_proxy)
             if http_proxy:
                 LOGGER.warning(
                     "HTTP status %s from web site: IP address %s may be blocked",
                     response.status_code, http_proxy)
-                if len(config.HTTP_PROXY_LIST) > 0:
-                    # randomly remove the proxy from the list, with probability 50%
-                    if random.choice([True, False]):
-                        config.HTTP_PROXY_LIST.remove(http_proxy)
-                        LOGGER.warning(
-                            "Removing %s from proxy list; %s of %s remain",
-                            http_proxy, len(config.HTTP_PROXY_LIST),
-                            len(config.HTTP_PROXY_LIST_COMPLETE))
-                    else:
-                        LOGGER.warning(
-                            "Not removing %s from proxy list this time; still %s of %s",
-                            http_proxy, len(config.HTTP_PROXY_LIST),
-                            len(config.HTTP_PROXY_LIST_COMPLETE))
-                if len(config.HTTP_PROXY_LIST) == 0:
-                    # fill proxy list again, wait a long time, then restart
-                    LOGGER.warning(("No proxies remain."
-                                    "Resetting proxy list and waiting %s minutes."),
-                                   (config.RE_INIT_SLEEP_TIME / 60.0))
-                    config.HTTP_PROXY_LIST = list(config.HTTP_PROXY_LIST_COMPLETE)
-                    time.sleep(config.RE_INIT_SLEEP_TIME)
-                    config.REQUEST_SLEEP += 1.0
-                    LOGGER.warning("Adding one second to request sleep time.  Now %s",
-                                   config.REQUEST_SLEEP)
             else:
-                LOGGER.warning(("HTTP status %s from web site: IP address blocked. "
-                                "Waiting %s minutes."),
-                               response.status_code, (config.RE_INIT_SLEEP_TIME / 60.0))
-                time.sleep(config.RE_INIT_SLEEP_TIME)
-                config.REQUEST_SLEEP += 1.0
+                LOGGER.warning(
+                    "HTTP status %s from web site: IP address may be blocked",
+                    response.status_code)
             return response
     except (SystemExit, KeyboardInterrupt):
         raise
@@ -122,25 +157,527 @@ def ws_individual_request(config, url, attempt_id, params=None):
         # For requests error and exceptions, see
         # http://docs.python-requests.org/en/latest/user/quickstart/
         # errors-and-exceptions
+        status = "ConnectionError"
+        get_session_manager(config).discard_session(http_proxy)
         LOGGER.warning("Network request %s: connectionError. Bad proxy %s?",
                        attempt_id, http_proxy)
         return None
     except requests.exceptions.HTTPError:
+        status = "HTTPError"
         LOGGER.error(
             "Network request exception %s (invalid HTTP response), for proxy %s",
             attempt_id, http_proxy)
         return None
     except requests.exceptions.Timeout:
+        throttled = True
+        status = "Timeout"
         LOGGER.warning(
             "Network request exception %s (timeout), for proxy %s",
             attempt_id, http_proxy)
         return None
     except requests.exceptions.TooManyRedirects:
+        status = "TooManyRedirects"
         LOGGER.error("Network request exception %s: too many redirects", attempt_id)
         return None
     except requests.exceptions.RequestException:
+        status = "RequestException"
         LOGGER.error("Network request exception %s: unidentified requests", attempt_id)
         return None
     except Exception as e:
+        status = type(e).__name__
         LOGGER.exception("Network request exception: type %s", type(e).__name__)
         return None
+    finally:
+        latency = time.time() - start_time
+        scheduler.release(http_proxy, outcome, latency)
+        metrics.observe("ws_request_seconds", latency, host=host)
+        metrics.inc("ws_network_seconds_total", latency)
+        metrics.inc("ws_responses_total", host=host, status=status)
+        metrics.inc("ws_proxy_requests_total",
+                    proxy=http_proxy or "direct", outcome=outcome)
+        if outcome == ProxyScheduler.OUTCOME_OK:
+            rate_limiter.increase(host)
+        elif throttled:
+            rate_limiter.decrease(host)
+
+
+class TokenBucket():
+    """
+    Token bucket for the requests to one host: tokens are added at rate per
+    second, up to burst, and each request takes one.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_update = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+
+class RateLimiter():
+    """
+    Limit the rate of requests to each host (www.airbnb.com,
+    www.airbnb.com.br, Google geocoding, ...) with a token bucket, shared by
+    every caller of airbnb_ws. The rate adapts, AIMD-style: it rises
+    additively while requests succeed (by request_rate_increase requests per
+    second for every second of successful requests) and is cut
+    multiplicatively (by request_rate_decrease) when the site blocks or
+    throttles a request (403, 429, 503) or a request times out.
+    The rate stays within [request_rate_min, request_rate_max].
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.initial_rate = config.REQUEST_RATE
+        self.min_rate = config.REQUEST_RATE_MIN
+        self.max_rate = max(config.REQUEST_RATE_MAX, self.min_rate)
+        self.increase_step = config.REQUEST_RATE_INCREASE
+        self.decrease_factor = config.REQUEST_RATE_DECREASE
+        self.burst = max(1.0, config.REQUEST_BURST)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host):
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            rate = min(self.max_rate, max(self.min_rate, self.initial_rate))
+            bucket = TokenBucket(rate, self.burst)
+            self._buckets[host] = bucket
+        return bucket
+
+    def acquire(self, host):
+        """ Wait until a request to host is allowed """
+        while True:
+            with self._lock:
+                bucket = self._bucket(host)
+                bucket.refill(time.time())
+                if bucket.tokens >= 1.0:
+                    bucket.tokens -= 1.0
+                    return
+                sleep_time = (1.0 - bucket.tokens) / bucket.rate
+            LOGGER.debug("sleeping " + str(sleep_time)[:7] + " seconds...")
+            time.sleep(sleep_time)
+
+    def increase(self, host):
+        """ A request to host succeeded: raise the rate additively """
+        with self._lock:
+            bucket = self._bucket(host)
+            bucket.refill(time.time())
+            bucket.rate = min(self.max_rate,
+                              bucket.rate + self.increase_step / bucket.rate)
+
+    def decrease(self, host):
+        """ host blocked or throttled a request: cut the rate """
+        with self._lock:
+            bucket = self._bucket(host)
+            bucket.refill(time.time())
+            previous_rate = bucket.rate
+            bucket.rate = max(self.min_rate, bucket.rate * self.decrease_factor)
+        LOGGER.warning("Request rate for %s cut from %.2f to %.2f per second",
+                       host, previous_rate, bucket.rate)
+
+    def get_rate(self, host):
+        with self._lock:
+            return self._bucket(host).rate
+
+    def log_summary(self):
+        """ Log the current rate for each host """
+        with self._lock:
+            for (host, bucket) in self._buckets.items():
+                LOGGER.info("Request rate for %s: %.2f per second",
+                            host, bucket.rate)
+
+
+RATE_LIMITER_LOCK = threading.Lock()
+
+
+def get_rate_limiter(config):
+    """ Return the rate limiter for this config, creating it if need be """
+    with RATE_LIMITER_LOCK:
+        rate_limiter = getattr(config, "rate_limiter", None)
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(config)
+            config.rate_limiter = rate_limiter
+        return rate_limiter
+
+
+def ws_rate_limited_call(config, host, function, *args, **kwargs):
+    """
+    Call function(*args, **kwargs), which makes a request to host by some
+    other means than ws_request_with_repeats (for example, a googlemaps
+    client call), under the shared rate limit for host. Over-quota and
+    timeout errors cut the rate; the exception is re-raised.
+    """
+    rate_limiter = get_rate_limiter(config)
+    rate_limiter.acquire(host)
+    try:
+        result = function(*args, **kwargs)
+    except Exception as ex:
+        if (getattr(ex, "status", None) == "OVER_QUERY_LIMIT"
+                or "OverQueryLimit" in type(ex).__name__
+                or "Timeout" in type(ex).__name__):
+            rate_limiter.decrease(host)
+        raise
+    rate_limiter.increase(host)
+    return result
+
+
+class ProxyHealth():
+    """
+    The health record of one proxy (or of the direct connection, for which
+    proxy is None), as kept by the ProxyScheduler.
+    """
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        # exponentially weighted moving averages
+        self.latency = None
+        self.error_rate = 0.0
+        # circuit breaker
+        self.consecutive_failures = 0
+        self.blocked_until = 0.0
+        self.last_blocked = None
+        self.in_flight = 0
+        self.request_count = 0
+        self.failure_count = 0
+
+
+class ProxyScheduler():
+    """
+    Choose the proxy for each request, and keep track of the health of each
+    proxy: an exponentially weighted moving average (EWMA) of its latency
+    and of its error rate, and the last time it was blocked.
+
+    Each proxy has its own circuit breaker. A proxy that is blocked by the
+    web site (a non-2xx response), or that fails proxy_failure_threshold
+    times in a row, goes into a cooldown of its own, which doubles with each
+    further failure up to proxy_max_cooldown, while the healthy proxies keep
+    working. A proxy whose last request failed is given one request at a
+    time until it succeeds again.
+
+    Among the proxies that are available, the one with the best score (see
+    score) is chosen. Requests wait only if every proxy is cooling down or
+    has max_requests_per_proxy requests in flight.
+    """
+    OUTCOME_OK = "ok"
+    OUTCOME_BLOCKED = "blocked"
+    OUTCOME_ERROR = "error"
+
+    def __init__(self, config):
+        self.config = config
+        proxies = list(config.HTTP_PROXY_LIST_COMPLETE) or [None]
+        self.proxies = [ProxyHealth(proxy) for proxy in proxies]
+        self.alpha = config.PROXY_EWMA_ALPHA
+        self.cooldown = config.PROXY_COOLDOWN
+        self.max_cooldown = max(config.PROXY_MAX_COOLDOWN, self.cooldown)
+        self.failure_threshold = max(1, config.PROXY_FAILURE_THRESHOLD)
+        self.max_in_flight = max(1, config.MAX_REQUESTS_PER_PROXY)
+        self._condition = threading.Condition()
+
+    def score(self, health):
+        """
+        Lower is better: the expected time for a request through this proxy,
+        inflated by its error rate and by the requests already in flight.
+        A proxy with no latency record yet scores zero, so that every proxy
+        is tried.
+        """
+        latency = health.latency if health.latency is not None else 0.0
+        return ((latency + health.error_rate * self.config.HTTP_TIMEOUT)
+                * (1 + health.in_flight))
+
+    def _max_in_flight(self, health):
+        if health.consecutive_failures > 0:
+            # half-open breaker: one trial request at a time
+            return 1
+        return self.max_in_flight
+
+    def acquire(self):
+        """
+        Return the proxy to use for a request (None for a direct
+        connection), waiting if none is available. Each call must be
+        matched by a call to release.
+        """
+        with self._condition:
+            while True:
+                now = time.time()
+                available = [health for health in self.proxies
+                             if health.blocked_until <= now
+                             and health.in_flight < self._max_in_flight(health)]
+                if available:
+                    # shuffle, so that ties are broken at random
+                    random.shuffle(available)
+                    health = min(available, key=self.score)
+                    health.in_flight += 1
+                    return health.proxy
+                # wait for a request to finish, or a cooldown to end
+                cooling_down = [health.blocked_until for health in self.proxies
+                                if health.blocked_until > now]
+                wait_time = min(cooling_down) - now if cooling_down else None
+                if len(cooling_down) == len(self.proxies):
+                    LOGGER.warning("All %s proxies are cooling down: waiting %.0f seconds",
+                                   len(self.proxies), wait_time)
+                self._condition.wait(wait_time)
+
+    def release(self, proxy, outcome, latency):
+        """
+        Record the outcome (OUTCOME_OK, OUTCOME_BLOCKED or OUTCOME_ERROR) and
+        latency, in seconds, of a request made through proxy.
+        """
+        with self._condition:
+            health = self._health(proxy)
+            health.in_flight -= 1
+            health.request_count += 1
+            if outcome == self.OUTCOME_OK:
+                health.error_rate = (1 - self.alpha) * health.error_rate
+                if health.latency is None:
+                    health.latency = latency
+                else:
+                    health.latency = ((1 - self.alpha) * health.latency
+                                      + self.alpha * latency)
+                health.consecutive_failures = 0
+            else:
+                health.error_rate = ((1 - self.alpha) * health.error_rate
+                                     + self.alpha)
+                health.failure_count += 1
+                health.consecutive_failures += 1
+                if (outcome == self.OUTCOME_BLOCKED
+                        or health.consecutive_failures >= self.failure_threshold):
+                    self._open_breaker(health, outcome)
+            self._condition.notify_all()
+
+    def _open_breaker(self, health, outcome):
+        now = time.time()
+        if outcome == self.OUTCOME_BLOCKED:
+            health.last_blocked = now
+        cooldown = min(self.max_cooldown,
+                       self.cooldown * 2 ** (health.consecutive_failures - 1))
+        health.blocked_until = now + cooldown
+        available = len([h for h in self.proxies if h.blocked_until <= now])
+        LOGGER.warning("Proxy %s cooling down for %.0f seconds "
+                       "(error rate %.2f); %s of %s proxies available",
+                       health.proxy, cooldown, health.error_rate,
+                       available, len(self.proxies))
+
+    def _health(self, proxy):
+        for health in self.proxies:
+            if health.proxy == proxy:
+                return health
+        raise ValueError("Unknown proxy {}".format(proxy))
+
+    def log_summary(self):
+        """ Log the health of each proxy """
+        with self._condition:
+            for health in self.proxies:
+                LOGGER.info("Proxy %s: %s requests, %s failures, "
+                            "latency %s, error rate %.2f",
+                            health.proxy, health.request_count,
+                            health.failure_count,
+                            "n/a" if health.latency is None
+                            else "{:.2f}s".format(health.latency),
+                            health.error_rate)
+
+
+PROXY_SCHEDULER_LOCK = threading.Lock()
+
+
+def get_proxy_scheduler(config):
+    """ Return the proxy scheduler for this config, creating it if need be """
+    with PROXY_SCHEDULER_LOCK:
+        scheduler = getattr(config, "proxy_scheduler", None)
+        if scheduler is None:
+            scheduler = ProxyScheduler(config)
+            config.proxy_scheduler = scheduler
+        return scheduler
+
+
+class RejectCookiesPolicy(http.cookiejar.DefaultCookiePolicy):
+    """
+    Cookie policy that does not keep cookies set by the web site, so that a
+    pooled session sends only the cookies supplied with each request, as
+    separate requests did.
+    """
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+class WSSessionManager():
+    """
+    Keep a requests.Session for each proxy (or for the direct connection), so
+    that connections are kept alive and reused from page to page and from
+    rectangle to rectangle, instead of opening a new TCP and TLS connection
+    for every request.
+
+    Each session gets a user agent from the config when it is created, and
+    keeps it, so a session belongs to a proxy/user agent pair. A session is
+    discarded (see discard_session) when a request through it is blocked or
+    fails to connect; the next request makes a new one.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get_session(self, http_proxy):
+        """ Return the session for http_proxy (None for no proxy) """
+        with self._lock:
+            session = self._sessions.get(http_proxy)
+            if session is None:
+                session = self._new_session()
+                self._sessions[http_proxy] = session
+                LOGGER.debug("New HTTP session for proxy %s (%s sessions)",
+                             http_proxy, len(self._sessions))
+            return session
+
+    def discard_session(self, http_proxy):
+        """ Close the session for http_proxy, if there is one """
+        with self._lock:
+            session = self._sessions.pop(http_proxy, None)
+        if session is not None:
+            session.close()
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions = {}
+        for session in sessions:
+            session.close()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.config.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=self.config.HTTP_POOL_MAXSIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        # If a list of user agent strings is supplied, use it
+        if len(self.config.USER_AGENT_LIST) > 0:
+            user_agent = random.choice(self.config.USER_AGENT_LIST)
+            session.headers.update({"User-Agent": user_agent})
+        else:
+            session.headers.update({'User-Agent': 'Mozilla/5.0'})
+        session.cookies.set_policy(RejectCookiesPolicy())
+        return session
+
+
+SESSION_MANAGER_LOCK = threading.Lock()
+
+
+def get_session_manager(config):
+    """ Return the session manager for this config, creating it if need be """
+    with SESSION_MANAGER_LOCK:
+        session_manager = getattr(config, "session_manager", None)
+        if session_manager is None:
+            session_manager = WSSessionManager(config)
+            config.session_manager = session_manager
+        return session_manager
+
+
+class WSFetchEngine():
+    """
+    Keep several web requests in flight at once. The engine runs an asyncio
+    event loop in a background thread; each request is an individual
+    request (see ws_individual_request) carried out in a thread pool, with the
+    same retry semantics as ws_request_with_repeats.
+
+    Concurrency is capped globally (max_concurrent_requests) by the engine,
+    and for each proxy (max_requests_per_proxy) by the proxy scheduler,
+    which also applies to requests made outside the engine. With no proxies,
+    the direct connection is treated as a single proxy. One engine is shared
+    by every thread that uses the same config: see get_fetch_engine.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.max_concurrent_requests = max(1, config.MAX_CONCURRENT_REQUESTS)
+        self.max_requests_per_proxy = max(1, config.MAX_REQUESTS_PER_PROXY)
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=self.max_concurrent_requests))
+        self._thread = threading.Thread(target=self._run_loop,
+                                        name="ws-fetch-engine", daemon=True)
+        self._thread.start()
+        # asyncio primitives must be created inside the loop that uses them
+        asyncio.run_coroutine_threadsafe(self._setup(), self._loop).result()
+        LOGGER.info("Fetch engine started: %s concurrent requests, %s per proxy",
+                    self.max_concurrent_requests, self.max_requests_per_proxy)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    async def _setup(self):
+        self._global_slots = asyncio.Semaphore(self.max_concurrent_requests)
+
+    async def _fetch(self, url, params):
+        """ The asynchronous equivalent of ws_request_with_repeats """
+        LOGGER.debug("URL for this search: %s", url)
+        cache = airbnb_cache.get_response_cache(self.config)
+        response = cache.get(url, params)
+        if response is not None or cache.offline:
+            ws_record_page(self.config, 0, response)
+            return response
+        for attempt_id in range(self.config.MAX_CONNECTION_ATTEMPTS):
+            try:
+                async with self._global_slots:
+                    response = await self._loop.run_in_executor(
+                        None, ws_individual_request, self.config, url,
+                        attempt_id, params)
+                if response is None:
+                    continue
+                elif response.status_code == requests.codes.ok:
+                    cache.put(url, params, response)
+                    ws_record_page(self.config, attempt_id + 1, response)
+                    return response
+            except Exception as ex:
+                LOGGER.error("Failed to retrieve web page %s", url)
+                LOGGER.exception("Exception retrieving page: %s", str(type(ex)))
+        ws_record_page(self.config, self.config.MAX_CONNECTION_ATTEMPTS, None)
+        return None
+
+    async def _fetch_batch(self, batch):
+        return await asyncio.gather(*[self._fetch(url, params)
+                                      for (url, params) in batch])
+
+    def fetch_batch(self, batch):
+        """
+        Request a batch of (url, params) pairs concurrently. Blocks until the
+        whole batch is done, and returns a list of responses in the same
+        order as the batch, with None for each request that failed.
+        """
+        future = asyncio.run_coroutine_threadsafe(self._fetch_batch(batch),
+                                                  self._loop)
+        return future.result()
+
+
+ENGINE_LOCK = threading.Lock()
+
+
+def get_fetch_engine(config):
+    """ Return the fetch engine for this config, starting it if need be """
+    with ENGINE_LOCK:
+        engine = getattr(config, "fetch_engine", None)
+        if engine is None:
+            engine = WSFetchEngine(config)
+            config.fetch_engine = engine
+        return engine
+
+
+def ws_request_batch(config, batch):
+    """
+    Request a batch of pages concurrently. batch is a list of (url, params)
+    pairs; the return value is a list of responses in the same order, with
+    None for each page that could not be retrieved.
+    A batch of one is sent through ws_request_with_repeats, so that no
+    engine is started unless it is needed.
+    """
+    if len(batch) == 1 or config.MAX_CONCURRENT_REQUESTS <= 1:
+        return [ws_request_with_repeats(config, url, params)
+                for (url, params) in batch]
+    return get_fetch_engine(config).fetch_batch(batch)
@@ -101,12 +101,94 @@ CREATE TABLE public.room
   property_type character varying(255),
   currency character varying(20),
   rate_type character varying(20),
+  content_hash character(32), -- see airbnb_listing.content_hash
   CONSTRAINT room_pkey PRIMARY KEY (room_id, survey_id)
 )
 WITH (
   OIDS=FALSE
 );
 
+CREATE TABLE public.room_sighting
+(
+  room_id integer NOT NULL,
+  survey_id integer NOT NULL,
+  source_survey_id integer NOT NULL, -- the room row with the same content
+  last_modified timestamp without time zone DEFAULT now(),
+  CONSTRAINT room_sighting_pkey PRIMARY KEY (room_id, survey_id)
+)
+WITH (
+  OIDS=FALSE
+);
+
+-- Rooms stored in full, with the rooms seen unchanged (room_sighting):
+-- one row for each room in each survey, in the shape of the room table.
+-- schema_update.py builds it from the columns of the room table.
+CREATE OR REPLACE VIEW public.room_by_survey AS
+SELECT
+  room.room_id,
+  room.host_id,
+  room.room_type,
+  room.country,
+  room.city,
+  room.neighborhood,
+  room.address,
+  room.reviews,
+  room.overall_satisfaction,
+  room.accommodates,
+  room.bedrooms,
+  room.bathrooms,
+  room.price,
+  room.deleted,
+  room.minstay,
+  room.last_modified,
+  room.latitude,
+  room.longitude,
+  room.survey_id,
+  room.location,
+  room.coworker_hosted,
+  room.extra_host_languages,
+  room.name,
+  room.property_type,
+  room.currency,
+  room.rate_type,
+  room.content_hash
+FROM public.room
+UNION ALL
+SELECT
+  r.room_id,
+  r.host_id,
+  r.room_type,
+  r.country,
+  r.city,
+  r.neighborhood,
+  r.address,
+  r.reviews,
+  r.overall_satisfaction,
+  r.accommodates,
+  r.bedrooms,
+  r.bathrooms,
+  r.price,
+  r.deleted,
+  r.minstay,
+  s.last_modified,
+  r.latitude,
+  r.longitude,
+  s.survey_id,
+  r.location,
+  r.coworker_hosted,
+  r.extra_host_languages,
+  r.name,
+  r.property_type,
+  r.currency,
+  r.rate_type,
+  r.content_hash
+FROM public.room_sighting s
+JOIN public.room r
+  ON r.room_id = s.room_id AND r.survey_id = s.source_survey_id
+WHERE NOT EXISTS (
+  SELECT 1 FROM public.room stored
+  WHERE stored.room_id = s.room_id AND stored.survey_id = s.survey_id);
+
 CREATE TABLE public.schema_version
 (
   version numeric(5,2) NOT NULL,
@@ -181,6 +263,59 @@ WITH (
   OIDS=FALSE
 );
 
+CREATE TABLE public.survey_progress_log_quadtree
+(
+  survey_id integer NOT NULL,
+  room_type character varying(255) NOT NULL DEFAULT '',
+  quadkey bigint NOT NULL,
+  status smallint NOT NULL,
+  zoomable boolean,
+  median_lat double precision,
+  median_lng double precision,
+  split_mode character varying(20),
+  last_modified timestamp without time zone DEFAULT now(),
+  CONSTRAINT survey_progress_log_quadtree_pkey PRIMARY KEY (survey_id, room_type, quadkey)
+)
+WITH (
+  OIDS=FALSE
+);
+
+CREATE TABLE public.survey_queue
+(
+  survey_id integer NOT NULL,
+  ss_id integer,
+  status smallint NOT NULL DEFAULT 0, -- 0 queued, 1 running, 2 done, 3 failed
+  worker character varying(255),
+  attempts integer NOT NULL DEFAULT 0,
+  claimed timestamp with time zone,
+  heartbeat timestamp with time zone,
+  lease_expires timestamp with time zone,
+  CONSTRAINT survey_queue_pkey PRIMARY KEY (survey_id)
+)
+WITH (
+  OIDS=FALSE
+);
+
+CREATE TABLE public.fill_queue
+(
+  room_id integer NOT NULL,
+  survey_id integer NOT NULL,
+  fill_key double precision,
+  status smallint NOT NULL DEFAULT 0, -- 0 queued, 1 claimed, 2 done
+  worker character varying(255),
+  lease_expires timestamp with time zone,
+  CONSTRAINT fill_queue_pkey PRIMARY KEY (room_id, survey_id)
+)
+WITH (
+  OIDS=FALSE
+);
+
+CREATE INDEX fill_queue_fill_key_idx
+  ON public.fill_queue
+  USING btree
+  (fill_key)
+  WHERE status < 2;
+
 CREATE TABLE public.zipcode
 (
   zipcode character varying(10) NOT NULL,
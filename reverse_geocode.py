@@ -7,6 +7,7 @@ import googlemaps
 import argparse
 import json
 from airbnb_config import ABConfig
+import airbnb_ws
 import sys
 import logging
 from geopy import distance
@@ -116,7 +117,9 @@ class BoundingBox():
         """
         try:
             gmaps = googlemaps.Client(key=config.GOOGLE_API_KEY)
-            results = gmaps.geocode((search_area))
+            results = airbnb_ws.ws_rate_limited_call(
+                config, airbnb_ws.GOOGLE_GEOCODING_HOST,
+                gmaps.geocode, (search_area))
 
             print(results)
 
@@ -188,7 +191,9 @@ def reverse_geocode(config, location):
     # lng = -72.693
     lat = location.lat_round
     lng = location.lng_round
-    results = gmaps.reverse_geocode((lat, lng))
+    results = airbnb_ws.ws_rate_limited_call(
+        config, airbnb_ws.GOOGLE_GEOCODING_HOST,
+        gmaps.reverse_geocode, (lat, lng))
 
     # Parsing the result is described at
     # https://developers.google.com/maps/documentation/geocoding/web-service-best-practices#ParsingJSON
@@ -213,6 +213,224 @@ def add_survey_log_bb_table():
     except:
         logger.info("Table survey_progress_log_bb already exists.")
 
+def add_survey_log_quadtree_table():
+    """
+    Progress of bounding box surveys, as a set of quadtree nodes: see
+    QuadtreeProgress in airbnb_survey.py. Replaces survey_progress_log_bb.
+    """
+    sql = """
+    SELECT column_name
+    FROM information_schema.columns
+    WHERE table_name='survey_progress_log_quadtree' and column_name='quadkey'
+    """
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute(sql)
+    test_quadkey = cur.fetchone()
+    cur.close()
+    conn.commit()
+    if test_quadkey:
+        logger.info("Check: survey_progress_log_quadtree table already has quadkey column")
+        add_survey_log_quadtree_split_mode()
+        return
+    if confirm(prompt='Create table "survey_progress_log_quadtree"?', resp=False):
+        sql = """
+        create table survey_progress_log_quadtree (
+            survey_id integer not null,
+            room_type varchar(255) not null default '',
+            quadkey bigint not null,
+            status smallint not null,
+            zoomable boolean,
+            median_lat float,
+            median_lng float,
+            split_mode varchar(20),
+            last_modified timestamp without time zone default now(),
+            constraint survey_progress_log_quadtree_pkey
+                primary key (survey_id, room_type, quadkey)
+        )
+        """
+        cur = conn.cursor()
+        cur.execute(sql)
+        cur.close()
+        conn.commit()
+    else:
+        print("Table 'survey_progress_log_quadtree' not created")
+
+def add_survey_log_quadtree_split_mode():
+    """ The rectangle split mode of a bounding box survey """
+    sql = """
+    SELECT column_name
+    FROM information_schema.columns
+    WHERE table_name='survey_progress_log_quadtree' and column_name='split_mode'
+    """
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute(sql)
+    test_split_mode = cur.fetchone()
+    cur.close()
+    conn.commit()
+    if test_split_mode:
+        logger.info("Check: survey_progress_log_quadtree table already has split_mode column")
+        return
+    logger.info("Altering table survey_progress_log_quadtree")
+    sql = """
+    alter table survey_progress_log_quadtree
+    add column split_mode varchar(20)
+    """
+    cur = conn.cursor()
+    cur.execute(sql)
+    cur.close()
+    conn.commit()
+
+def add_survey_queue_table():
+    """
+    The queue of surveys for worker processes: see airbnb_queue.py.
+    """
+    sql = """
+    SELECT column_name
+    FROM information_schema.columns
+    WHERE table_name='survey_queue' and column_name='survey_id'
+    """
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute(sql)
+    test_survey_id = cur.fetchone()
+    cur.close()
+    conn.commit()
+    if test_survey_id:
+        logger.info("Check: survey_queue table already has survey_id column")
+        return
+    if confirm(prompt='Create table "survey_queue"?', resp=False):
+        sql = """
+        create table survey_queue (
+            survey_id integer primary key,
+            ss_id integer,
+            status smallint not null default 0,
+            worker varchar(255),
+            attempts integer not null default 0,
+            claimed timestamp with time zone,
+            heartbeat timestamp with time zone,
+            lease_expires timestamp with time zone
+        )
+        """
+        cur = conn.cursor()
+        cur.execute(sql)
+        cur.close()
+        conn.commit()
+    else:
+        print("Table 'survey_queue' not created")
+
+def add_fill_queue_table():
+    """
+    The queue of rooms to fill in: see airbnb_queue.py.
+    """
+    sql = """
+    SELECT column_name
+    FROM information_schema.columns
+    WHERE table_name='fill_queue' and column_name='room_id'
+    """
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute(sql)
+    test_room_id = cur.fetchone()
+    cur.close()
+    conn.commit()
+    if test_room_id:
+        logger.info("Check: fill_queue table already has room_id column")
+        return
+    if confirm(prompt='Create table "fill_queue"?', resp=False):
+        sql = """
+        create table fill_queue (
+            room_id integer not null,
+            survey_id integer not null,
+            fill_key double precision,
+            status smallint not null default 0,
+            worker varchar(255),
+            lease_expires timestamp with time zone,
+            constraint fill_queue_pkey primary key (room_id, survey_id)
+        )
+        """
+        cur = conn.cursor()
+        cur.execute(sql)
+        cur.execute("""
+        create index fill_queue_fill_key_idx on fill_queue (fill_key)
+        where status < 2
+        """)
+        cur.close()
+        conn.commit()
+    else:
+        print("Table 'fill_queue' not created")
+
+def add_room_sighting_table():
+    """
+    Rooms seen unchanged in a survey, and the room_by_survey view that
+    puts them together with the room table: see ABListingBatchWriter in
+    airbnb_listing.py.
+    """
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute("""
+    SELECT column_name
+    FROM information_schema.columns
+    WHERE table_name='room' and column_name='content_hash'
+    """)
+    test_content_hash = cur.fetchone()
+    cur.execute("""
+    SELECT column_name
+    FROM information_schema.columns
+    WHERE table_name='room_sighting' and column_name='room_id'
+    """)
+    test_room_id = cur.fetchone()
+    cur.close()
+    conn.commit()
+    if test_content_hash and test_room_id:
+        logger.info("Check: room_sighting table and content_hash column exist")
+        return
+    if not confirm(prompt='Create table "room_sighting"?', resp=False):
+        print("Table 'room_sighting' not created")
+        return
+    cur = conn.cursor()
+    if not test_content_hash:
+        cur.execute("alter table room add column content_hash character(32)")
+    if not test_room_id:
+        cur.execute("""
+        create table room_sighting (
+            room_id integer not null,
+            survey_id integer not null,
+            source_survey_id integer not null,
+            last_modified timestamp without time zone default now(),
+            constraint room_sighting_pkey primary key (room_id, survey_id)
+        )
+        """)
+    # the view has the columns of the room table, whatever they are
+    cur.execute("""
+    SELECT column_name
+    FROM information_schema.columns
+    WHERE table_name='room'
+    ORDER BY ordinal_position
+    """)
+    columns = [row[0] for row in cur.fetchall()]
+    sighting_columns = {"survey_id": "s.survey_id",
+                        "last_modified": "s.last_modified"}
+    cur.execute("""
+    create or replace view room_by_survey as
+    select {room_columns}
+    from room
+    union all
+    select {sighting_columns}
+    from room_sighting s
+    join room r
+    on r.room_id = s.room_id and r.survey_id = s.source_survey_id
+    where not exists (
+        select 1 from room stored
+        where stored.room_id = s.room_id and stored.survey_id = s.survey_id)
+    """.format(
+        room_columns=", ".join("room." + column for column in columns),
+        sighting_columns=", ".join(sighting_columns.get(column, "r." + column)
+                                   for column in columns)))
+    cur.close()
+    conn.commit()
+
 def fix_room_table():
     try:
         sql = """
@@ -321,6 +539,10 @@ def main():
     fix_version_table()
     fix_room_table()
     add_survey_log_bb_table()
+    add_survey_log_quadtree_table()
+    add_survey_queue_table()
+    add_fill_queue_table()
+    add_room_sighting_table()
 
 
 if __name__ == "__main__":
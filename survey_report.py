@@ -53,6 +53,9 @@ def runit(survey_id, details):
             pass
         if "Page" in line:
             match = p_page.match(line)
+            if match is None:
+                # another message that mentions a page
+                continue
             dt_string = match.group(1)
             dt_objects.append([datetime.strptime(dt_string, "%Y-%m-%d %H:%M:%S"),
                                connection_error_count])
@@ -204,14 +207,68 @@ def runit(survey_id, details):
     print("*" * 80)
     print("")
 
-try:
-    survey_id = sys.argv[1]
-except:
-    survey_id = None
+def compare(survey_ids):
+    """
+    Compare the efficiency of several surveys (for example, of one area with
+    different rectangle split modes): requests spent per listing found.
+    """
+    p_result = re.compile(r"Results:\s+([0-9]+) pages, ([0-9]+) new")
+    p_survey = re.compile(r"Survey\s+([0-9]+), for (.*)")
+    p_split_mode = re.compile(r"Split mode: (\S+)")
+    rows = []
+    for survey_id in survey_ids:
+        filename = "survey-{}.log".format(survey_id)
+        search_area = "?"
+        # surveys logged before split modes existed were geometric
+        split_mode = "geometric"
+        request_count = 0
+        listing_count = 0
+        with open(filename) as log_file_object:
+            for line in log_file_object:
+                if "Results: " in line:
+                    match = p_result.search(line)
+                    if match:
+                        request_count += int(match.group(1))
+                        listing_count += int(match.group(2))
+                elif "Split mode: " in line:
+                    match = p_split_mode.search(line)
+                    if match:
+                        split_mode = match.group(1)
+                elif "Survey " in line:
+                    match = p_survey.search(line)
+                    if match:
+                        search_area = match.group(2)
+        rows.append((survey_id, search_area, split_mode,
+                     request_count, listing_count))
+
+    print("")
+    print("*" * 80)
+    print("{}\tRequests per listing, by survey{}".format(printColor.BOLD,
+                                                       printColor.END))
+    print("")
+    print("\tSurvey\tSplit mode\tRequests\tListings\tRequests per listing\tSearch area")
+    print("-" * 80)
+    for (survey_id, search_area, split_mode,
+         request_count, listing_count) in rows:
+        if listing_count > 0:
+            requests_per_listing = "{0:.3f}".format(
+                request_count / float(listing_count))
+        else:
+            requests_per_listing = "NaN"
+        print("\t{}\t{}\t{}\t\t{}\t\t{}\t\t\t{}".format(
+            survey_id, split_mode, request_count, listing_count,
+            requests_per_listing, search_area))
+    print("")
+    print("*" * 80)
+    print("")
 
-if survey_id is not None:
-    runit(survey_id, False)
+if len(sys.argv) > 2 and sys.argv[1] == "--compare":
+    compare(sys.argv[2:])
+elif len(sys.argv) > 1:
+    runit(sys.argv[1], False)
 else:
     print("\n")
     print("Usage: python survey_report.py <survey_id>")
     print("where you have a log file survey-<survey_id>.log")
+    print("or:    python survey_report.py --compare <survey_id> <survey_id> ...")
+    print("to compare requests per listing across surveys")